@@ -0,0 +1,207 @@
+from bisect import bisect_left
+from bisect import insort
+from datetime import datetime
+from datetime import timedelta
+from typing import Iterable
+from typing import Optional
+
+# recordings of a channel separated by less than this gap (s) are merged
+MERGE_GAP = 60
+
+
+class ConflictError(Exception):
+    """Raised when a recording overlaps other recordings on every adapter.
+    conflicts is a list of (adapter, id) of the overlapping recordings."""
+
+    def __init__(self, conflicts: list[tuple[int, int]]):
+        super().__init__(conflicts)
+        self.conflicts = conflicts
+
+
+class AdapterAllocator:
+    """Interval index of the recordings of every adapter.
+
+    Intervals are kept sorted by begin date. As an interval cannot be longer
+    than the longest one stored, at least max_duration, the recordings
+    overlapping an interval are found by bisection. The intervals start
+    before the recordings by the pre-roll. In multiplex mode, recordings of
+    the same frequency share an adapter. With merge, recordings of the same
+    channel not started yet share an adapter, they are captured as one
+    block."""
+
+    def __init__(
+        self, adapter_number: int, max_duration: int, multiplex: bool,
+        merge: bool = False
+    ):
+        self.adapter_number = adapter_number
+        self.max_duration = timedelta(seconds=int(max_duration))
+        # longest interval stored, a recording with its pre-roll
+        self.longest = self.max_duration
+        self.multiplex = multiplex
+        self.merge = merge and not multiplex
+        # (begin date, end date, id, frequency, channel) sorted by begin date
+        self.intervals: list[list[tuple]] = [[] for _ in range(adapter_number)]
+        self.adapters: dict[int, int] = {}
+
+    def compatible(
+        self, interval: tuple[datetime, datetime, int, int, Optional[str]],
+        frequency: Optional[int], channel: Optional[str], now: datetime
+    ) -> bool:
+        if self.multiplex:
+            return interval[3] == frequency
+        # the block of a recording started cannot be extended
+        return self.merge and interval[4] == channel and interval[0] > now
+
+    def overlapping(
+        self, intervals: list[tuple], begin_date: datetime,
+        end_date: datetime, frequency: Optional[int],
+        channel: Optional[str] = None
+    ) -> list[tuple]:
+        """Returns the intervals overlapping a recording, all of them if
+        frequency is None"""
+        now = datetime.now()
+        start = bisect_left(intervals, (begin_date - self.longest,))
+        stop = bisect_left(intervals, (end_date,))
+        return [
+            i for i in intervals[start:stop] if i[1] > begin_date and
+            not self.compatible(i, frequency, channel, now)
+        ]
+
+    def mergeable(
+        self, adapter: int, begin_date: datetime, end_date: datetime,
+        channel: Optional[str]
+    ) -> bool:
+        """Returns True if a recording of the channel not started yet on the
+        adapter is close enough to be merged with an interval"""
+        now = datetime.now()
+        gap = timedelta(seconds=MERGE_GAP)
+        return any(
+            i[4] == channel and i[0] > now and i[0] <= end_date + gap and
+            i[1] >= begin_date - gap
+            for i in self.intervals[adapter]
+        )
+
+    def is_free(
+        self, adapter: int, begin_date: datetime, end_date: datetime
+    ) -> bool:
+        """Returns True if no recording of the adapter overlaps an interval"""
+        return len(self.overlapping(
+            self.intervals[adapter], begin_date, end_date, None
+        )) == 0
+
+    def add(
+        self, id_: int, adapter: int, begin_date: datetime,
+        end_date: datetime, frequency: int, channel: Optional[str] = None
+    ):
+        self.longest = max(self.longest, end_date - begin_date)
+        insort(
+            self.intervals[adapter],
+            (begin_date, end_date, id_, frequency, channel)
+        )
+        self.adapters[id_] = adapter
+
+    def remove(self, id_: int):
+        adapter = self.adapters.pop(id_, None)
+        if adapter is not None:
+            self.intervals[adapter] = [
+                i for i in self.intervals[adapter] if i[2] != id_
+            ]
+
+    def move(self, id_: int, adapter: int):
+        begin_date, end_date, _, frequency, channel = next(
+            i for i in self.intervals[self.adapters[id_]] if i[2] == id_
+        )
+        self.remove(id_)
+        self.add(id_, adapter, begin_date, end_date, frequency, channel)
+
+    def allocate(
+        self, id_: int, begin_date: datetime, end_date: datetime,
+        frequency: int, adapter: Optional[int] = None,
+        channel: Optional[str] = None
+    ) -> tuple[int, dict[int, int]]:
+        """Allocates an adapter to a recording, the given one if any. With
+        merge, the adapters of the close recordings of the channel come first.
+
+        If no adapter is free, the recordings not started yet are repacked.
+        Returns the adapter and the moved recordings as a dict of their new
+        adapters indexed by id. Raises ConflictError if the recordings cannot
+        be repacked."""
+        self.longest = max(self.longest, end_date - begin_date)
+        if adapter is None:
+            adapters: Iterable[int] = range(self.adapter_number)
+            if self.merge:
+                adapters = sorted(adapters, key=lambda a: not self.mergeable(
+                    a, begin_date, end_date, channel
+                ))
+        else:
+            adapters = range(adapter, adapter + 1)
+
+        conflicts = []
+        for a in adapters:
+            overlapping = self.overlapping(
+                self.intervals[a], begin_date, end_date, frequency, channel
+            )
+            if len(overlapping) == 0:
+                self.add(id_, a, begin_date, end_date, frequency, channel)
+                return a, {}
+            conflicts += [(a, i[2]) for i in overlapping]
+
+        moves = self.repack(
+            id_, begin_date, end_date, frequency, channel, adapter
+        )
+        if moves is None:
+            raise ConflictError(conflicts)
+
+        adapter = moves.pop(id_)
+        for i, a in moves.items():
+            self.move(i, a)
+        self.add(id_, adapter, begin_date, end_date, frequency, channel)
+        return adapter, moves
+
+    def repack(
+        self, id_: int, begin_date: datetime, end_date: datetime,
+        frequency: int, channel: Optional[str], adapter: Optional[int]
+    ) -> Optional[dict[int, int]]:
+        """Assigns again the adapters of the recordings not started yet with
+        the new one, by begin date, each one to the first free adapter.
+        Returns the adapters of the moved recordings and of the new one, or
+        None if a recording cannot be placed."""
+        now = datetime.now()
+        intervals: list[list[tuple]] = [[] for _ in range(self.adapter_number)]
+        pending = []
+        for a, adapter_intervals in enumerate(self.intervals):
+            for i in adapter_intervals:
+                if i[0] <= now:
+                    # started recordings are not moved
+                    intervals[a].append(i)
+                else:
+                    pending.append(i)
+
+        new = (begin_date, end_date, id_, frequency, channel)
+        if adapter is not None:
+            # the requested adapter is kept
+            insort(intervals[adapter], new)
+        else:
+            pending.append(new)
+
+        # the adapter of the new recording is found below if none is given
+        moves = {} if adapter is None else {id_: adapter}
+        for interval in sorted(pending):
+            for a in range(self.adapter_number):
+                if len(self.overlapping(
+                    intervals[a], interval[0], interval[1], interval[3],
+                    interval[4]
+                )) == 0:
+                    insort(intervals[a], interval)
+                    if self.adapters.get(interval[2]) != a:
+                        moves[interval[2]] = a
+                    break
+            else:
+                return None
+
+        if adapter is not None and len(self.overlapping(
+            [i for i in intervals[adapter] if i[2] != id_],
+            begin_date, end_date, frequency, channel
+        )) != 0:
+            return None
+        return moves
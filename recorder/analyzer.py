@@ -0,0 +1,271 @@
+import argparse
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+import json
+import sys
+from typing import BinaryIO
+
+import numpy as np
+
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.multiplex import TS_SYNC_BYTE
+
+NULL_PID = 0x1fff
+PID_NUMBER = 0x2000
+PCR_FREQUENCY = 90000
+PCR_MODULO = 1 << 33
+
+# number of packets checked at once, about 770 kB
+BLOCK_PACKETS = 4096
+
+
+@dataclass
+class QualityReport:
+    packets: int = 0
+    sync_errors: int = 0
+    transport_errors: int = 0
+    cc_errors: int = 0
+    lost_packets: int = 0
+    # packets by PID
+    pids: dict[int, int] = field(default_factory=dict)
+    # bitrate in bits per second of every second of the stream, from the PCR
+    bitrates: list[float] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return (
+            self.sync_errors == 0 and self.transport_errors == 0 and
+            self.cc_errors == 0
+        )
+
+    def summary(self) -> str:
+        if len(self.bitrates) != 0:
+            bitrate = (
+                f"{min(self.bitrates) / 1e6:.2f}/"
+                f"{sum(self.bitrates) / len(self.bitrates) / 1e6:.2f}/"
+                f"{max(self.bitrates) / 1e6:.2f} Mbit/s"
+            )
+        else:
+            bitrate = "unknown bitrate"
+        return (
+            f"{self.packets} packets, {self.sync_errors} sync errors, "
+            f"{self.transport_errors} transport errors, "
+            f"{self.cc_errors} continuity errors, "
+            f"{self.lost_packets} lost packets, {bitrate}"
+        )
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+class Analyzer:
+    """Checks the integrity of a transport stream fed by blocks of data.
+
+    The packets of a block are checked at once with numpy: transport error
+    indicators, continuity counters by PID (including across blocks) and PCR
+    for the bitrate. When a sync byte is missing, the stream is aligned again
+    on the next packet and the checks go on from there. Only the incomplete
+    last packet of a block is kept for the next one, so the memory used does
+    not depend on the length of the stream."""
+
+    def __init__(self):
+        self.report: QualityReport = QualityReport()
+        self.remainder = b""
+        self.pid_packets = np.zeros(PID_NUMBER, dtype=np.int64)
+        # last continuity counter by PID, -1 if the PID was not seen yet
+        self.last_cc = np.full(PID_NUMBER, -1, dtype=np.int16)
+        # the PCR of the first PID carrying it are used for the bitrate
+        self.pcr_pid = None
+        self.last_pcr = None
+        self.last_pcr_packet = 0
+        self.pcr_time = 0.0
+        self.bitrate_bytes = np.zeros(0, dtype=np.float64)
+
+    def feed(self, data: bytes):
+        data = self.remainder + data if self.remainder else data
+        while True:
+            if len(data) != 0 and data[0] != TS_SYNC_BYTE:
+                data = self.resync(data)
+            end = len(data) - len(data) % TS_PACKET_SIZE
+            packets = np.frombuffer(
+                data, dtype=np.uint8, count=end
+            ).reshape(-1, TS_PACKET_SIZE)
+            # the packets are checked up to the first one out of sync
+            lost = np.flatnonzero(packets[:, 0] != TS_SYNC_BYTE)
+            if len(lost) != 0:
+                end = int(lost[0]) * TS_PACKET_SIZE
+            if end != 0:
+                self.check(packets[:end // TS_PACKET_SIZE])
+            if len(lost) == 0:
+                self.remainder = bytes(data[end:])
+                return
+            data = data[end:]
+
+    def resync(self, data: bytes) -> bytes:
+        """Skips the data up to the first of two sync bytes a packet apart,
+        the loss of sync is counted once"""
+        self.report.sync_errors += 1
+        offset = data.find(TS_SYNC_BYTE, 1)
+        while offset != -1:
+            if offset + TS_PACKET_SIZE >= len(data) or \
+                    data[offset + TS_PACKET_SIZE] == TS_SYNC_BYTE:
+                return data[offset:]
+            offset = data.find(TS_SYNC_BYTE, offset + 1)
+        return b""
+
+    def check(self, packets: np.ndarray):
+        """Checks packets which all start with a sync byte"""
+        report = self.report
+        first_packet = report.packets
+        report.packets += len(packets)
+
+        tei = (packets[:, 1] & 0x80) != 0
+        report.transport_errors += int(np.count_nonzero(tei))
+
+        valid = ~tei
+        pid = ((packets[:, 1].astype(np.uint16) & 0x1f) << 8) | packets[:, 2]
+        self.pid_packets += np.bincount(pid[valid], minlength=PID_NUMBER)
+
+        afc = (packets[:, 3] >> 4) & 0x03
+        has_adaptation = (afc & 0x02) != 0
+        adaptation_length = packets[:, 4]
+        flags = np.where(has_adaptation & (adaptation_length > 0), packets[:, 5], 0)
+
+        self.check_continuity(
+            pid, packets[:, 3] & 0x0f,
+            valid & ((afc & 0x01) != 0) & (pid != NULL_PID),
+            (flags & 0x80) != 0
+        )
+        self.measure_bitrate(
+            packets, pid, valid & (adaptation_length >= 7) & ((flags & 0x10) != 0),
+            first_packet
+        )
+
+    def check_continuity(
+        self, pid: np.ndarray, cc: np.ndarray, checked: np.ndarray,
+        discontinuity: np.ndarray
+    ):
+        """Counts the continuity errors of the packets with a payload"""
+        # packets grouped by PID, in the order of the stream
+        order = np.argsort(pid[checked], kind="stable")
+        p = pid[checked][order]
+        c = cc[checked][order].astype(np.int16)
+        d = discontinuity[checked][order]
+        if len(p) == 0:
+            return
+
+        first = np.ones(len(p), dtype=bool)
+        first[1:] = p[1:] != p[:-1]
+        last = np.ones(len(p), dtype=bool)
+        last[:-1] = first[1:]
+
+        previous = np.empty(len(p), dtype=np.int16)
+        previous[1:] = c[:-1]
+        previous[first] = self.last_cc[p[first]]
+
+        step = (c - previous) & 0x0f
+        # a duplicate packet has the same counter, a discontinuity is allowed
+        errors = (previous >= 0) & (step != 1) & (step != 0) & ~d
+        self.report.cc_errors += int(np.count_nonzero(errors))
+        self.report.lost_packets += int(np.sum((step[errors] - 1) & 0x0f))
+
+        self.last_cc[p[last]] = c[last]
+
+    def measure_bitrate(
+        self, packets: np.ndarray, pid: np.ndarray, has_pcr: np.ndarray,
+        first_packet: int
+    ):
+        """Adds the bytes between two PCR to the second they belong to"""
+        if self.pcr_pid is None:
+            pcr_pids = pid[has_pcr]
+            if len(pcr_pids) == 0:
+                return
+            self.pcr_pid = int(pcr_pids[0])
+
+        index = np.flatnonzero(has_pcr & (pid == self.pcr_pid))
+        if len(index) == 0:
+            return
+        p = packets[index].astype(np.int64)
+        pcr = (p[:, 6] << 25) | (p[:, 7] << 17) | (p[:, 8] << 9) | \
+            (p[:, 9] << 1) | (p[:, 10] >> 7)
+        index = index + first_packet
+
+        if self.last_pcr is not None:
+            pcr = np.concatenate(([self.last_pcr], pcr))
+            index = np.concatenate(([self.last_pcr_packet], index))
+        self.last_pcr = int(pcr[-1])
+        self.last_pcr_packet = int(index[-1])
+        if len(pcr) < 2:
+            return
+
+        dt = ((pcr[1:] - pcr[:-1]) % PCR_MODULO) / PCR_FREQUENCY
+        size = (index[1:] - index[:-1]) * TS_PACKET_SIZE
+        # a gap of more than a second is a discontinuity, not a bitrate
+        kept = (dt > 0) & (dt <= 1)
+        time = self.pcr_time + np.cumsum(np.where(kept, dt, 0))
+        self.pcr_time = float(time[-1])
+
+        seconds = time[kept].astype(np.int64)
+        if len(seconds) == 0:
+            return
+        size_by_second = np.bincount(seconds, weights=size[kept])
+        if len(size_by_second) > len(self.bitrate_bytes):
+            self.bitrate_bytes = np.concatenate((
+                self.bitrate_bytes,
+                np.zeros(len(size_by_second) - len(self.bitrate_bytes))
+            ))
+        self.bitrate_bytes[:len(size_by_second)] += size_by_second
+
+    def finish(self) -> QualityReport:
+        report = self.report
+        if len(self.remainder) != 0:
+            # truncated last packet
+            report.sync_errors += 1
+            self.remainder = b""
+        report.pids = {
+            int(pid): int(self.pid_packets[pid])
+            for pid in np.flatnonzero(self.pid_packets)
+        }
+        # the last second is not complete
+        report.bitrates = [float(b) * 8 for b in self.bitrate_bytes[:-1]]
+        return report
+
+
+def analyze_stream(stream: BinaryIO) -> QualityReport:
+    analyzer = Analyzer()
+    while True:
+        data = stream.read(BLOCK_PACKETS * TS_PACKET_SIZE)
+        if len(data) == 0:
+            break
+        analyzer.feed(data)
+    return analyzer.finish()
+
+
+def analyze_file(filename: str) -> QualityReport:
+    """Returns the quality report of a recorded file"""
+    with open(filename, "rb") as f:
+        return analyze_stream(f)
+
+
+def main():
+    """Prints the quality report of a transport stream file, or of the
+    standard input for a live capture"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="file to analyze, - for stdin")
+    parser.add_argument("-j", "--json", action="store_true")
+    args = parser.parse_args()
+
+    if args.filename == "-":
+        report = analyze_stream(sys.stdin.buffer)
+    else:
+        report = analyze_file(args.filename)
+
+    if args.json:
+        print(json.dumps(report.as_dict()))
+    else:
+        print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+from datetime import datetime
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+from aiohttp import web
+
+import recorder.config as config
+from recorder.allocation import ConflictError
+from recorder.live import dump_recording
+
+logger = logging.getLogger(__name__)
+
+
+def parse_date(value) -> datetime:
+    if not isinstance(value, str):
+        raise ValueError(f"invalid date: {value!r}")
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        # the schedule is in local time
+        date = date.astimezone().replace(tzinfo=None)
+    return date
+
+
+def parse_recording(data: dict) -> dict:
+    """Returns the arguments of a recording from its JSON object, begin_date
+    is null or missing for an immediate recording. Raises ValueError."""
+    try:
+        channel = data["channel"]
+        program_name = data["program_name"]
+        end_date = parse_date(data["end_date"])
+    except KeyError as e:
+        raise ValueError(f"missing field: {e}")
+    if not isinstance(channel, str) or not isinstance(program_name, str) or \
+            not 5 <= len(program_name) <= 128:
+        raise ValueError("invalid channel or program name")
+    begin_date = data.get("begin_date")
+    adapter = data.get("adapter")
+    if adapter is not None and (
+        not isinstance(adapter, int) or isinstance(adapter, bool) or
+        not 0 <= adapter < config.general.dvb_adapter_number
+    ):
+        raise ValueError("invalid adapter")
+    return {
+        "adapter": adapter,
+        "channel": channel,
+        "program_name": program_name,
+        "begin_date": None if begin_date is None else parse_date(begin_date),
+        "end_date": end_date,
+        "shutdown": bool(data.get("shutdown", False))
+    }
+
+
+async def read_json(request: web.Request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": "invalid JSON"}),
+            content_type="application/json"
+        )
+
+
+def json_error(message: str, status: int) -> web.Response:
+    return web.json_response({"error": message}, status=status)
+
+
+def conditional_response(request: web.Request, data) -> web.Response:
+    """Returns the JSON of data with an ETag, or Not Modified if the client
+    has it already"""
+    body = json.dumps(data).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    if_none_match = request.headers.get("If-None-Match", "")
+    etags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    if etag in etags or "*" in etags:
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(
+        body=body, content_type="application/json", headers={"ETag": etag}
+    )
+
+
+async def list_recordings(request: web.Request) -> web.Response:
+    recordings = request.app.record.get_recordings()
+    return conditional_response(
+        request, [dump_recording(id_, r) for id_, r in recordings]
+    )
+
+
+async def create_recording(request: web.Request) -> web.Response:
+    try:
+        entry = parse_recording(await read_json(request))
+    except (ValueError, AttributeError, TypeError) as e:
+        return json_error(str(e), 400)
+
+    recorder = request.app.record
+    if entry["channel"] not in recorder.get_channels():
+        return json_error(f"unknown channel: {entry['channel']}", 400)
+    try:
+        immediate, begin_date, duration = recorder.check_dates(
+            entry["begin_date"], entry["end_date"]
+        )
+        id_ = recorder.id
+        await recorder.record(
+            entry["adapter"], entry["channel"], entry["program_name"],
+            immediate, begin_date, entry["end_date"], duration,
+            entry["shutdown"]
+        )
+    except ValueError as e:
+        return json_error(str(e), 400)
+    except ConflictError as e:
+        return json_error(recorder.describe_conflicts(e), 409)
+    return web.json_response(
+        dump_recording(id_, recorder.recordings[id_]), status=201
+    )
+
+
+async def create_recordings(request: web.Request) -> web.Response:
+    """Schedules a list of recordings at once, the result of each one is
+    returned in the same order"""
+    data = await read_json(request)
+    if not isinstance(data, list):
+        return json_error("a list is expected", 400)
+
+    entries = []
+    errors = {}
+    for i, item in enumerate(data):
+        try:
+            entries.append(parse_recording(item))
+        except (ValueError, AttributeError, TypeError) as e:
+            errors[i] = {"error": str(e)}
+
+    results = iter(request.app.record.add_recordings(entries))
+    return web.json_response([
+        errors[i] if i in errors else next(results) for i in range(len(data))
+    ])
+
+
+async def cancel_recording(request: web.Request) -> web.Response:
+    id_ = int(request.match_info["id"])
+    recorder = request.app.record
+    if id_ not in recorder.recordings:
+        return json_error("not found", 404)
+    await recorder.cancel_recording(id_)
+    return web.Response(status=204)
+
+
+async def list_awakenings(request: web.Request) -> web.Response:
+    awakenings = request.app.wakeup.get_awakenings()
+    return conditional_response(
+        request,
+        [{"id": id_, "date": date.isoformat()} for id_, date in awakenings]
+    )
+
+
+async def create_awakenings(request: web.Request) -> web.Response:
+    """Adds an awakening {"date": ...} or a list of them at once"""
+    data = await read_json(request)
+    single = not isinstance(data, list)
+    try:
+        dates = [parse_date(item["date"]) for item in ([data] if single else data)]
+    except (ValueError, KeyError, TypeError) as e:
+        return json_error(f"invalid awakening: {e}", 400)
+    if any(date <= datetime.now() for date in dates):
+        return json_error("the awakenings must be in the future", 400)
+
+    ids = request.app.wakeup.add_awakenings(dates)
+    awakenings = [
+        {"id": id_, "date": date.isoformat()} for id_, date in zip(ids, dates)
+    ]
+    return web.json_response(awakenings[0] if single else awakenings, status=201)
+
+
+async def cancel_awakening(request: web.Request) -> web.Response:
+    id_ = int(request.match_info["id"])
+    wakeup = request.app.wakeup
+    if id_ not in wakeup.awakenings:
+        return json_error("not found", 404)
+    wakeup.cancel_awakening(id_)
+    return web.Response(status=204)
+
+
+async def list_kept(request: web.Request) -> web.Response:
+    return web.json_response(sorted(request.app.record.store.get_kept()))
+
+
+async def keep_file(request: web.Request) -> web.Response:
+    """Keeps a recorded file from the retention, or not for DELETE"""
+    filename = request.match_info["filename"]
+    recorder = request.app.record
+    if not Path(recorder.recording_directory, filename).is_file():
+        return json_error("not found", 404)
+    recorder.store.set_kept(filename, request.method == "PUT")
+    return web.Response(status=204)
+
+
+def setup_routes(app: web.Application):
+    app.router.add_get("/api/recordings", list_recordings)
+    app.router.add_post("/api/recordings", create_recording)
+    app.router.add_post("/api/recordings/bulk", create_recordings)
+    app.router.add_delete("/api/recordings/{id:\\d+}", cancel_recording)
+    app.router.add_get("/api/awakenings", list_awakenings)
+    app.router.add_post("/api/awakenings", create_awakenings)
+    app.router.add_delete("/api/awakenings/{id:\\d+}", cancel_awakening)
+    app.router.add_get("/api/kept", list_kept)
+    app.router.add_put("/api/kept/{filename}", keep_file)
+    app.router.add_delete("/api/kept/{filename}", keep_file)
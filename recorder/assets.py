@@ -0,0 +1,204 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from pathlib import Path
+import re
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ASSETS_DIRECTORY = "data/static"
+MANIFEST_FILENAME = "manifest.json"
+# fingerprinted assets never change, they are cached for a year
+IMMUTABLE = "public, max-age=31536000, immutable"
+# the other files are checked at every use
+REVALIDATE = "no-cache"
+COMPRESSED_SUFFIXES = {
+    ".css", ".js", ".svg", ".json", ".ico", ".ttf", ".eot", ".map", ".txt",
+    ".yml"
+}
+# smaller files are not worth compressing (bytes)
+MIN_COMPRESS_SIZE = 512
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    """Returns the quality of each coding of an Accept-Encoding header"""
+    qualities = {}
+    for item in header.lower().split(","):
+        coding, *parameters = [p.strip() for p in item.split(";")]
+        if coding == "":
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def fingerprinted(path: Path, content: bytes) -> Path:
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return path.with_name(f"{path.stem}.{digest}{path.suffix}")
+
+
+class Assets:
+    """Static files served with their content hash in their name, so that
+    they can be cached forever by the browsers, with their gzip and brotli
+    variants computed in advance.
+
+    The fingerprinted files and their variants are built at startup in
+    ASSETS_DIRECTORY, only the files changed since the previous build are
+    processed again. The relative URLs of the style sheets are replaced by
+    the fingerprinted ones."""
+
+    def __init__(self, static_directory: Path, assets_directory: Path):
+        self.static_directory = static_directory.resolve()
+        self.assets_directory = assets_directory
+        # fingerprinted path by path of the static files
+        self.urls: dict[str, str] = {}
+        # encodings of the variants by fingerprinted path
+        self.variants: dict[str, list[str]] = {}
+
+    def url(self, path: str) -> str:
+        """Returns the URL of a static file, used by the templates"""
+        return "/static/" + self.urls.get(path, path)
+
+    def build(self):
+        manifest_filename = Path(self.assets_directory, MANIFEST_FILENAME)
+        try:
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+
+        files = sorted(
+            p for p in self.static_directory.rglob("*") if p.is_file()
+        )
+        # the style sheets refer to the other files
+        files.sort(key=lambda p: p.suffix == ".css")
+        new_manifest = {}
+        built = 0
+        for source in files:
+            path = source.relative_to(self.static_directory).as_posix()
+            st = source.stat()
+            entry = manifest.get(path)
+            if entry is None or entry["mtime_ns"] != st.st_mtime_ns or \
+                    entry["size"] != st.st_size or source.suffix == ".css" or \
+                    not Path(self.assets_directory, entry["path"]).exists():
+                entry = self.build_file(source, path, st)
+                built += 1
+            new_manifest[path] = entry
+            self.urls[path] = entry["path"]
+            self.variants[entry["path"]] = entry["encodings"]
+
+        # the fingerprinted files that are not used anymore are removed
+        for path, entry in manifest.items():
+            if new_manifest.get(path, {}).get("path") != entry["path"]:
+                for suffix in ("", ".gz", ".br"):
+                    Path(
+                        self.assets_directory, entry["path"] + suffix
+                    ).unlink(missing_ok=True)
+
+        with open(manifest_filename, "w") as f:
+            json.dump(new_manifest, f)
+        logger.info(f"{len(files)} static files, {built} built")
+
+    def build_file(self, source: Path, path: str, st: os.stat_result) -> dict:
+        content = source.read_bytes()
+        if source.suffix == ".css":
+            content = self.rewrite_css(content.decode(), path).encode()
+        target_path = fingerprinted(Path(path), content).as_posix()
+        target = Path(self.assets_directory, target_path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if not target.exists():
+            target.write_bytes(content)
+
+        encodings = []
+        if source.suffix in COMPRESSED_SUFFIXES and \
+                len(content) >= MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(content, 9, mtime=0)
+            if len(compressed) < len(content):
+                target.with_name(target.name + ".gz").write_bytes(compressed)
+                encodings.append("gzip")
+            if brotli is not None:
+                compressed = brotli.compress(content)
+                if len(compressed) < len(content):
+                    target.with_name(target.name + ".br").write_bytes(compressed)
+                    encodings.append("br")
+        return {
+            "path": target_path, "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size, "encodings": encodings
+        }
+
+    def rewrite_css(self, css: str, path: str) -> str:
+        """Replaces the relative URLs of a style sheet with the fingerprinted
+        ones"""
+        directory = Path(path).parent
+
+        def replace(match: re.Match[str]) -> str:
+            url = match.group(2)
+            if ":" in url or url.startswith(("/", "#")):
+                return match.group(0)
+            # the query or the fragment are kept, for the fonts of IE
+            name = re.split(r"[?#]", url, maxsplit=1)[0]
+            rest = url[len(name):]
+            target = os.path.normpath(Path(directory, name)).replace(os.sep, "/")
+            if target not in self.urls:
+                return match.group(0)
+            return f'url("/static/{self.urls[target]}{rest}")'
+
+        return CSS_URL.sub(replace, css)
+
+    async def handler(self, request: web.Request) -> web.StreamResponse:
+        path = request.match_info["path"]
+        encodings = self.variants.get(path)
+        if encodings is None:
+            # not fingerprinted, a file outside of the manifest or an old URL
+            filename = Path(self.static_directory, path).resolve()
+            if not filename.is_relative_to(self.static_directory) or \
+                    not filename.is_file():
+                raise web.HTTPNotFound()
+            return web.FileResponse(
+                filename, headers={"Cache-Control": REVALIDATE}
+            )
+
+        filename = Path(self.assets_directory, path)
+        content_type = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+        headers = {
+            "Cache-Control": IMMUTABLE,
+            "Content-Type": content_type,
+            "Vary": "Accept-Encoding"
+        }
+        accept_encoding = request.headers.get("Accept-Encoding", "")
+        qualities = parse_accept_encoding(accept_encoding)
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            # a coding not listed is accepted with "*"
+            if encoding in encodings and \
+                    qualities.get(encoding, qualities.get("*", 0)) > 0:
+                headers["Content-Encoding"] = encoding
+                return web.FileResponse(
+                    filename.with_name(filename.name + suffix),
+                    headers=headers
+                )
+        if "gzip" in encodings and "gzip" in accept_encoding.lower():
+            # FileResponse would send the gzip variant refused with q=0
+            loop = asyncio.get_running_loop()
+            body = await loop.run_in_executor(None, filename.read_bytes)
+            return web.Response(body=body, headers=headers)
+        return web.FileResponse(filename, headers=headers)
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import statistics
+import tempfile
+import time
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+import recorder.config as config
+from recorder.capture import Capture
+import recorder.main as main_module
+from recorder.record import Recorder
+from recorder.store import Store
+from recorder.synthetic import HD_BITRATE
+from recorder.synthetic import SyntheticAdapter
+from recorder.typem import GeneralConfig
+from recorder.wakeup import Awakenings
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = (
+    "France 2:674000000:INVERSION_AUTO:BANDWIDTH_8_MHZ:FEC_3_4:FEC_1_2:QAM_64:"
+    "TRANSMISSION_MODE_8K:GUARD_INTERVAL_1_8:HIERARCHY_NONE:120:130:257\n"
+)
+RESULTS_FILENAME = "data/benchmark.json"
+
+
+def rss() -> int:
+    """Returns the resident memory of the process (bytes)"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+class Benchmark:
+    """Runs the recorder without tuner: the recordings are captured from
+    synthetic streams written into FIFOs which stand for the dvr devices.
+    Everything is created in a temporary directory."""
+
+    def __init__(self, directory: Path, adapters: int):
+        self.directory = directory
+        self.adapters = adapters
+        channels_conf = Path(directory, "channels.conf")
+        channels_conf.write_text(CHANNELS)
+        recording_directory = Path(directory, "recordings")
+        recording_directory.mkdir()
+        Path(directory, "data").mkdir()
+        config.general = GeneralConfig(
+            dvb_adapter_number=adapters,
+            channels_conf=str(channels_conf),
+            max_duration=18000,
+            recording_directory=str(recording_directory),
+            language="fr",
+            simulate=False,
+            port=0,
+            native_capture=True
+        )
+        self.results: dict[str, float] = {}
+
+    def create(self) -> Recorder:
+        store = Store(Path(self.directory, "data", "recorder.db"))
+        wakeup = Awakenings(self.directory, store)
+        recorder = Recorder(self.directory, store, wakeup)
+        recorder.dvr_device = str(Path(self.directory, "adapter{}.ts"))
+        recorder.tune = False
+        return recorder
+
+    async def schedule(self, recorder: Recorder, count: int):
+        """Schedules count recordings, each one is saved in the store"""
+        channel = recorder.get_channels()[0]
+        begin_date = datetime.now() + timedelta(days=1)
+        start = time.perf_counter()
+        for i in range(count):
+            end_date = begin_date + timedelta(minutes=5)
+            recorder.add_recording(
+                None, channel, f"benchmark {i}", False, begin_date, end_date,
+                300, False
+            )
+            begin_date += timedelta(minutes=10 // self.adapters)
+        elapsed = time.perf_counter() - start
+        self.results["schedule_per_second"] = count / elapsed
+
+    async def render(self, recorder: Recorder, requests: int):
+        """Requests the index page with the recordings scheduled"""
+        app = await main_module.make_app(
+            Path(main_module.__file__).resolve().parent.parent, recorder,
+            recorder.wakeup
+        )
+        latencies = []
+        async with TestClient(TestServer(app)) as client:
+            for _ in range(requests):
+                start = time.perf_counter()
+                response = await client.get("/")
+                await response.read()
+                elapsed = time.perf_counter() - start
+                if response.status != 200:
+                    # an error page must not be timed as a render
+                    raise RuntimeError(
+                        f"rendering failed with status {response.status}"
+                    )
+                latencies.append(elapsed)
+        latencies.sort()
+        self.results["render_median_ms"] = statistics.median(latencies) * 1e3
+        self.results["render_p95_ms"] = \
+            latencies[int(0.95 * (len(latencies) - 1))] * 1e3
+
+    async def load(self):
+        """Loads the schedule saved by schedule() in a new recorder"""
+        recorder = self.create()
+        await recorder.wakeup.load()
+        start = time.perf_counter()
+        await recorder.load()
+        self.results["load_seconds"] = time.perf_counter() - start
+        recorder.timer.stop()
+        recorder.metrics.stop()
+        recorder.store.connection.close()
+
+    async def cancel(self, recorder: Recorder):
+        ids = list(recorder.recordings.keys())
+        start = time.perf_counter()
+        for id_ in ids:
+            await recorder.cancel_recording(id_)
+        elapsed = time.perf_counter() - start
+        self.results["cancel_per_second"] = len(ids) / elapsed
+
+    async def capture(self, duration: float):
+        """Captures a stream written as fast as possible"""
+        source = SyntheticAdapter(Path(self.directory, "capture.ts"), 0)
+        source.start()
+        capture = Capture(
+            str(source.filename), Path(self.directory, "capture-output.ts"),
+            duration
+        )
+        await capture.start()
+        await capture.wait()
+        source.stop()
+        Path(self.directory, "capture-output.ts").unlink()
+        self.results["capture_mbytes_per_second"] = \
+            capture.statistics.bitrate / 8e6
+
+    async def memory(self, recorder: Recorder, count: int, duration: float):
+        """Records count HD channels at once"""
+        sources = [
+            SyntheticAdapter(
+                Path(recorder.dvr_device.format(adapter)), HD_BITRATE
+            )
+            for adapter in range(count)
+        ]
+        for source in sources:
+            source.start()
+
+        before = rss()
+        channel = recorder.get_channels()[0]
+        now = datetime.now()
+        for adapter in range(count):
+            recorder.add_recording(
+                adapter, channel, f"memory {adapter}", True, now,
+                now + timedelta(seconds=duration), duration, False
+            )
+        await asyncio.sleep(duration / 2)
+        during = rss()
+        tasks = [r["task"] for r in recorder.recordings.values()]
+        await asyncio.gather(*tasks)
+        for source in sources:
+            source.stop()
+
+        written = sum(
+            f.stat().st_size
+            for f in Path(self.directory, "recordings").glob("memory*")
+        )
+        self.results["memory_per_recording_kbytes"] = \
+            (during - before) / count / 1024
+        self.results["recording_mbytes_per_second"] = \
+            written / duration / 1e6
+
+    async def run(self, count: int, requests: int, duration: float):
+        recorder = self.create()
+        await recorder.wakeup.load()
+        await recorder.load()
+        await self.schedule(recorder, count)
+        await self.render(recorder, requests)
+        await self.load()
+        await self.cancel(recorder)
+        await self.capture(duration)
+        await self.memory(recorder, self.adapters, duration)
+        await recorder.cancel_recordings()
+        await recorder.store.close()
+
+
+def compare(results: dict, baseline: dict):
+    for name, value in results["results"].items():
+        reference = baseline["results"].get(name)
+        if reference:
+            change = (value - reference) / reference * 100
+            print(f"{name}: {value:.3f} ({reference:.3f}, {change:+.1f} %)")
+        else:
+            print(f"{name}: {value:.3f}")
+
+
+def main():
+    """Measures the scheduling, the rendering of the index page, the
+    persistence and the capture without tuner. The results are saved for a
+    comparison with a later run."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--recordings", type=int, default=2000,
+        help="number of recordings scheduled"
+    )
+    parser.add_argument(
+        "-a", "--adapters", type=int, default=4,
+        help="number of recordings captured at once"
+    )
+    parser.add_argument("-r", "--requests", type=int, default=20)
+    parser.add_argument(
+        "-t", "--duration", type=float, default=10,
+        help="duration of the captures (s)"
+    )
+    parser.add_argument("-o", "--output", default=RESULTS_FILENAME)
+    parser.add_argument("-b", "--baseline", help="results of a previous run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="recorder-") as directory:
+        benchmark = Benchmark(Path(directory), args.adapters)
+        asyncio.run(
+            benchmark.run(args.recordings, args.requests, args.duration)
+        )
+
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": vars(args),
+        "results": benchmark.results
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    else:
+        compare(results, {"results": {}})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import asyncio
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.preroll import trim_head
+from recorder.supervision import file_size
+from recorder.supervision import Supervisor
+
+logger = logging.getLogger(__name__)
+
+# size of the copies of the ranges of the block
+COPY_SIZE = 1 << 24
+
+
+def copy_range(source: Path, destination: Path, begin: int, end: int):
+    """Copies a range of a file into a new file. The file system shares the
+    extents if it can."""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        offset = begin
+        try:
+            while offset < end:
+                copied = os.copy_file_range(
+                    src.fileno(), dst.fileno(), min(end - offset, COPY_SIZE),
+                    offset
+                )
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # not supported by the file system
+            src.seek(offset)
+            dst.seek(offset - begin)
+            while offset < end:
+                data = src.read(min(end - offset, COPY_SIZE))
+                if len(data) == 0:
+                    break
+                dst.write(data)
+                offset += len(data)
+
+
+class Segment:
+    """A recording of a block. It behaves like the process of a single
+    recording so that it can be cancelled the same way. Its range of the block
+    starts at the begin date, at once if the begin date is over."""
+
+    def __init__(
+        self, block: "Block", id_: int, filename: Path, begin_delay: float,
+        duration: float
+    ):
+        self.block = block
+        self.id = id_
+        self.filename = filename
+        self.pid = block.process.pid
+        self.returncode: Optional[int] = None
+        # offsets of the range of the recording in the block
+        self.begin: Optional[int] = None
+        self.end: Optional[int] = None
+        self.stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.handles = [loop.call_later(duration, self.stopped.set)]
+        if begin_delay <= 0:
+            self.begin = block.offset()
+        else:
+            self.handles.append(loop.call_later(begin_delay, self.set_begin))
+
+    def set_begin(self):
+        self.begin = self.block.offset()
+
+    def terminate(self):
+        self.returncode = -15
+        self.stopped.set()
+
+    async def wait(self):
+        waiters = [
+            asyncio.create_task(self.stopped.wait()),
+            asyncio.create_task(self.block.ended.wait())
+        ]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in waiters:
+                task.cancel()
+            for handle in self.handles:
+                handle.cancel()
+        self.end = self.block.offset()
+        if self.begin is None:
+            self.begin = self.end
+        if self.returncode is None:
+            # the block may end a bit before the end date of its last
+            # recording, its return code tells if it failed
+            self.returncode = 0 if self.stopped.is_set() else \
+                self.block.process.returncode
+        return self.returncode
+
+
+class Block:
+    """Continuous capture of a channel by an adapter for recordings which
+    follow each other, the adapter is tuned once for all of them. The range
+    of every recording is cut from the file of the block at packet boundaries
+    when it ends, the last one takes the file."""
+
+    def __init__(
+        self, adapter: int, channel: str, filename: Path, end_date: datetime,
+        process, supervisor: Supervisor
+    ):
+        self.adapter = adapter
+        self.channel = channel
+        self.filename = filename
+        self.end_date = end_date
+        self.process = process
+        self.supervisor = supervisor
+        self.members: dict[int, Segment] = {}
+        self.ended = asyncio.Event()
+        # the ranges are cut one at a time
+        self.lock = asyncio.Lock()
+        self.taken = False
+
+    def offset(self) -> int:
+        """Returns the size of the block in whole packets"""
+        size = file_size(self.filename)
+        return size - size % TS_PACKET_SIZE
+
+    def add(
+        self, id_: int, filename: Path, begin_delay: float, duration: float
+    ) -> Segment:
+        logger.debug(
+            f"block of {self.channel} on adapter {self.adapter}: "
+            f"{filename.name} added"
+        )
+        self.members[id_] = Segment(self, id_, filename, begin_delay, duration)
+        return self.members[id_]
+
+    def terminate(self):
+        if self.process.returncode is None:
+            self.process.terminate()
+
+    async def extract(self, id_: int):
+        """Writes the file of a recording which is over"""
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            segment = self.members.pop(id_)
+            begin, end = segment.begin, segment.end
+            try:
+                if begin is None or end is None or end <= begin:
+                    return
+                if self.ended.is_set() and len(self.members) == 0:
+                    # the head is removed as the pre-roll, about a block of
+                    # the file system of the previous recording is left
+                    removed = await loop.run_in_executor(
+                        None, trim_head, self.filename, begin
+                    )
+                    if removed != 0 or begin == 0:
+                        self.filename.rename(segment.filename)
+                        self.taken = True
+                        return
+                await loop.run_in_executor(
+                    None, copy_range, self.filename, segment.filename, begin,
+                    end
+                )
+            finally:
+                self.remove()
+
+    def remove(self):
+        """Removes the file of the block when no recording needs it"""
+        if self.ended.is_set() and len(self.members) == 0 and not self.taken:
+            logger.debug(f"delete file {self.filename.name}")
+            self.filename.unlink(missing_ok=True)
+
+    async def run(self) -> Optional[str]:
+        """Waits for the end of the capture under its supervisor. Returns the
+        reason of its failure if any."""
+        try:
+            return await self.supervisor.run(self.process)
+        finally:
+            self.ended.set()
+            async with self.lock:
+                self.remove()
@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+
+import recorder.config as config
+from recorder.record import Recorder
+from recorder.store import Store
+from recorder.store import STORE_FILENAME
+from recorder.wakeup import Awakenings
+
+logger = logging.getLogger()
+handler = logging.StreamHandler(stream=sys.stdout)
+formatter = logging.Formatter("%(asctime)s %(module)s %(levelname)s %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+record = None
+store = None
+
+
+def process_start() -> float:
+    """Returns the start of the current process, in seconds since boot"""
+    with open("/proc/self/stat") as f:
+        # the command name in parentheses may contain spaces
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+class Phases:
+    """Logs the duration of the startup phases and the time since boot"""
+
+    def __init__(self):
+        self.date = process_start()
+
+    def done(self, phase: str):
+        now = time.clock_gettime(time.CLOCK_BOOTTIME)
+        logger.info(
+            f"startup: {phase} in {(now - self.date) * 1000:.0f} ms, "
+            f"{now:.1f} s since boot"
+        )
+        self.date = now
+
+
+def set_log_levels():
+    logging.getLogger("aiohttp").setLevel(logging.WARNING)
+
+    # set log level of modules' loggers
+    for lg_name, lg_level in config.loggers.items():
+        if lg_name == "root":
+            logger.setLevel(lg_level)
+        else:
+            logging.getLogger(lg_name).setLevel(lg_level)
+
+
+async def restore(
+    path: Path, deferred: bool = False
+) -> tuple[Store, Awakenings, Recorder]:
+    """Loads the schedule from the store and arms the recordings. With
+    deferred, rtcwake is not called, Awakenings.setup_awakening must be
+    called afterwards."""
+    store = Store(Path(path, STORE_FILENAME))
+    wakeup = Awakenings(path, store)
+    wakeup.deferred = deferred
+    record = Recorder(path, store, wakeup)
+
+    # the awakenings of the recordings are added on the loaded ones
+    await wakeup.load()
+    await record.load()
+    store.start()
+    return store, wakeup, record
+
+
+async def run(config_filename: str):
+    """Starts the recorder with the recordings first: the recordings due
+    start while the web stack is imported, the background tasks and the web
+    server come after"""
+    global record
+    global store
+
+    phases = Phases()
+    phases.done("imports")
+    config.read(config_filename)
+    set_log_levels()
+
+    path = Path(__file__).resolve().parent.parent
+    store, wakeup, record = await restore(path, deferred=True)
+    phases.done(f"{len(record.recordings)} recordings armed")
+
+    loop = asyncio.get_running_loop()
+    main = await loop.run_in_executor(
+        None, importlib.import_module, "recorder.main"
+    )
+    phases.done("web imports")
+
+    wakeup.deferred = False
+    wakeup.setup_awakening()
+    record.start_services()
+    phases.done("awakening and background tasks")
+
+    await main.serve(path, record, wakeup)
+    phases.done("web server")
+    while True:
+        await asyncio.sleep(1)
+
+
+async def close():
+    if record is not None:
+        await record.cancel_recordings()
+    if store is not None:
+        # the schedule is already in the store
+        await store.close()
+
+
+def main():
+    """Fast startup, when the PC is awakened to record"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.toml")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    try:
+        logger.info("server started")
+        loop.run_until_complete(run(args.config))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(close())
+        loop.stop()
+        logger.info("server stopped")
+
+
+if __name__ == "__main__":
+    main()
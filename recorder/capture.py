@@ -0,0 +1,446 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import errno
+import fcntl
+import io
+import logging
+import os
+from pathlib import Path
+import select
+import threading
+import time
+from typing import Callable
+from typing import Optional
+
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.storage import preallocate
+from recorder.storage import release
+
+logger = logging.getLogger(__name__)
+
+DVR_DEVICE = "/dev/dvb/adapter{}/dvr0"
+
+# a chunk is made of whole packets and whole pages: 1024 packets of 188 bytes
+CHUNK_SIZE = 1024 * 188
+# a full chunk is written when the buffer holds that many chunks
+WRITE_CHUNKS = 4
+# the capture thread checks if it has to stop at this rate (ms)
+POLL_TIMEOUT = 200
+# the writer of a ring buffer syncs the file at this period (s)
+SYNC_PERIOD = 5.0
+# size of the pipe from the tuner when it writes the stream
+PIPE_SIZE = 1024 * 1024
+
+
+@dataclass
+class CaptureStatistics:
+    bytes_read: int = 0
+    reads: int = 0
+    writes: int = 0
+    overflows: int = 0
+    max_read: int = 0
+    # most bytes waiting in the ring buffer
+    high_water: int = 0
+    # times the ring buffer was full and bytes dropped then
+    stalls: int = 0
+    dropped: int = 0
+    syncs: int = 0
+    begin_time: float = 0.0
+    end_time: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        end_time = self.end_time or time.monotonic()
+        return max(end_time - self.begin_time, 0.0)
+
+    @property
+    def bitrate(self) -> float:
+        """Returns the average bitrate in bits per second"""
+        elapsed = self.elapsed
+        return self.bytes_read * 8 / elapsed if elapsed > 0 else 0.0
+
+
+class RingBuffer:
+    """Bounded buffer between the thread reading a source and the thread
+    writing the file. When the file is not written fast enough, the data read
+    are dropped instead of blocking the reader, so that the kernel buffer of
+    the source never overflows and the losses are counted. Only whole
+    packets are given to the writer, so that a drop leaves the file aligned
+    on the packets."""
+
+    def __init__(self, size: int, statistics: CaptureStatistics):
+        # the reader goes on while a batch is written
+        size = max(size - size % CHUNK_SIZE, 2 * WRITE_CHUNKS * CHUNK_SIZE)
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.statistics = statistics
+        # bytes put in and taken out of the buffer since the beginning
+        self.head = 0
+        self.tail = 0
+        # bytes of a partial packet read after the head
+        self.pending = 0
+        self.full = False
+        self.closed = False
+        # error of the writer, raised by the reader
+        self.error: Optional[OSError] = None
+        self.condition = threading.Condition()
+
+    def free(self) -> memoryview:
+        """Returns the contiguous free space after the head and the partial
+        packet. A packet never wraps, the head stays on a packet boundary and
+        the size of the buffer is a multiple of the packet size."""
+        size = len(self.buffer)
+        end = self.head + self.pending
+        start = end % size
+        return self.view[start:start + min(size - (end - self.tail),
+                                           size - start)]
+
+    def commit(self, n: int):
+        """Adds n bytes read into the free space, the bytes of a partial
+        packet are kept until it is complete"""
+        self.pending += n
+        n = self.pending - self.pending % TS_PACKET_SIZE
+        if n == 0:
+            return
+        self.pending -= n
+        with self.condition:
+            self.head += n
+            self.full = False
+            filled = self.head - self.tail
+            s = self.statistics
+            s.high_water = max(s.high_water, filled)
+            if filled >= WRITE_CHUNKS * CHUNK_SIZE:
+                self.condition.notify()
+
+    def drop(self, n: int):
+        """Counts n bytes read while the buffer was full, the partial packet
+        read before is dropped too"""
+        s = self.statistics
+        if not self.full:
+            self.full = True
+            s.stalls += 1
+        s.dropped += n + self.pending
+        self.pending = 0
+
+    def close(self):
+        with self.condition:
+            # the last packet is written even if it is not complete
+            self.head += self.pending
+            self.pending = 0
+            self.closed = True
+            self.condition.notify()
+
+    def drain(
+        self, output: io.FileIO,
+        write: Callable[[io.FileIO, memoryview], None]
+    ):
+        """Writes the buffer into output by large batches until it is
+        closed, the file is synced periodically"""
+        try:
+            self.write_batches(output, write)
+        except OSError as e:
+            self.error = e
+
+    def write_batches(
+        self, output: io.FileIO,
+        write: Callable[[io.FileIO, memoryview], None]
+    ):
+        size = len(self.buffer)
+        synced = time.monotonic()
+        while True:
+            with self.condition:
+                # what is buffered is written at least every SYNC_PERIOD
+                if self.head - self.tail < WRITE_CHUNKS * CHUNK_SIZE and \
+                        not self.closed:
+                    self.condition.wait(SYNC_PERIOD)
+                closed = self.closed
+                filled = self.head - self.tail
+            start = self.tail % size
+            n = min(filled, size - start)
+            if n > 0:
+                write(output, self.view[start:start + n])
+                with self.condition:
+                    self.tail += n
+            now = time.monotonic()
+            if now - synced >= SYNC_PERIOD or (closed and n == filled):
+                os.fdatasync(output.fileno())
+                self.statistics.syncs += 1
+                synced = now
+            if closed and n == filled:
+                break
+
+
+class Capture:
+    """Copies a transport stream from a source into a file in a dedicated
+    thread. The source is a dvr device tuned by an other process (see
+    tune_command), a FIFO or a recorded file for testing. If source is None,
+    the stream is read from the standard output of the tune command.
+
+    The data are read into a preallocated buffer through a memoryview and
+    written by chunks of whole packets. With ring_size, they go through a
+    ring buffer of that many bytes written by a second thread, so that a slow
+    disk does not block the reading. A capture behaves like the process of a
+    recording so that it can be cancelled the same way."""
+
+    def __init__(
+        self, source: Optional[str], filename: Path, duration: float,
+        tune_command: Optional[tuple] = None, size: int = 0,
+        ring_size: int = 0
+    ):
+        self.source = source
+        self.filename = filename
+        self.duration = duration
+        self.tune_command = tune_command
+        # expected size of the file, preallocated if not 0
+        self.size = size
+        self.ring_size = ring_size
+        # read end of the pipe from the tuner if source is None
+        self.pipe = None
+        self.tuner = None
+        self.thread = None
+        self.timer = None
+        self.pid = os.getpid()
+        self.returncode: Optional[int] = None
+        self.statistics = CaptureStatistics()
+        self.stopping = threading.Event()
+        self.finished = asyncio.Event()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.tune_command is not None:
+            # the tuner sets up the dvr device and keeps the lock, its
+            # status is read from stderr
+            stdout = asyncio.subprocess.DEVNULL
+            if self.source is None:
+                self.pipe, stdout = os.pipe()
+                try:
+                    fcntl.fcntl(self.pipe, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+                except OSError:
+                    pass
+            try:
+                self.tuner = await asyncio.create_subprocess_exec(
+                    *self.tune_command, stdout=stdout,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            finally:
+                if self.pipe is not None:
+                    os.close(stdout)
+            self.pid = self.tuner.pid
+        self.thread = threading.Thread(
+            target=self.run, args=(loop,), name=f"capture {self.filename}",
+            daemon=True
+        )
+        self.thread.start()
+        self.timer = loop.call_later(self.duration, self.terminate)
+
+    @property
+    def stderr(self) -> Optional[asyncio.StreamReader]:
+        return None if self.tuner is None else self.tuner.stderr
+
+    def received(self) -> int:
+        """Returns the size read from the source, the file grows by batches"""
+        return self.statistics.bytes_read
+
+    def terminate(self):
+        self.stopping.set()
+
+    async def wait(self):
+        await self.finished.wait()
+        self.timer.cancel()
+        if self.tuner is not None and self.tuner.returncode is None:
+            self.tuner.terminate()
+            await self.tuner.wait()
+        return self.returncode
+
+    def run(self, loop: asyncio.AbstractEventLoop):
+        try:
+            self.capture()
+            returncode = 0 if self.statistics.bytes_read > 0 else 1
+        except OSError as e:
+            logger.error(f"capture of {self.filename}: {e}")
+            returncode = 1
+        self.statistics.end_time = time.monotonic()
+
+        s = self.statistics
+        logger.debug(
+            f"capture of {self.filename}: {s.bytes_read} bytes, "
+            f"{s.reads} reads, {s.writes} writes, {s.overflows} overflows, "
+            f"{s.bitrate / 1e6:.2f} Mbit/s"
+        )
+        if self.ring_size != 0:
+            logger.debug(
+                f"capture of {self.filename}: ring buffer high water "
+                f"{s.high_water} bytes, {s.stalls} stalls, {s.dropped} bytes "
+                f"dropped, {s.syncs} syncs"
+            )
+        loop.call_soon_threadsafe(self.set_finished, returncode)
+
+    def set_finished(self, returncode: int):
+        self.returncode = returncode
+        self.finished.set()
+
+    def capture(self):
+        self.statistics.begin_time = time.monotonic()
+        if self.pipe is not None:
+            fd = self.pipe
+            os.set_blocking(fd, False)
+        else:
+            # a FIFO without writer is polled until one comes
+            fd = os.open(self.source, os.O_RDONLY | os.O_NONBLOCK)
+        poll = select.poll()
+        poll.register(fd, select.POLLIN | select.POLLPRI)
+        with io.FileIO(fd, "rb") as source:
+            fd = self.open_output()
+            if fd is None:
+                return
+            with io.FileIO(fd, "wb") as output:
+                if self.size != 0:
+                    preallocate(output.fileno(), self.size)
+                if self.ring_size == 0:
+                    self.copy(source, poll, output)
+                else:
+                    self.buffered_copy(source, poll, output)
+                if self.size != 0:
+                    release(output.fileno())
+
+    def open_output(self) -> Optional[int]:
+        """Opens the file, a FIFO only once it has a reader. Returns None if
+        the capture is stopped before."""
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NONBLOCK
+        while True:
+            try:
+                fd = os.open(self.filename, flags, 0o666)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # no reader on the FIFO yet
+                if self.stopping.wait(POLL_TIMEOUT / 1000):
+                    return None
+                continue
+            os.set_blocking(fd, True)
+            return fd
+
+    def read(self, source: io.FileIO, poll, view: memoryview) -> Optional[int]:
+        """Reads the source into view. Returns the size read, 0 at the end
+        of the source, None if there is nothing to read."""
+        if len(poll.poll(POLL_TIMEOUT)) == 0:
+            return None
+        s = self.statistics
+        try:
+            n = source.readinto(view)
+        except OSError as e:
+            if e.errno != errno.EOVERFLOW:
+                raise
+            # the kernel buffer of the dvr device overflowed
+            s.overflows += 1
+            return None
+        if n is not None and n != 0:
+            s.reads += 1
+            s.bytes_read += n
+            s.max_read = max(s.max_read, n)
+        return n
+
+    def copy(self, source: io.FileIO, poll, output: io.FileIO):
+        buffer = bytearray(WRITE_CHUNKS * CHUNK_SIZE)
+        view = memoryview(buffer)
+        filled = 0
+        while not self.stopping.is_set():
+            n = self.read(source, poll, view[filled:])
+            if n is None:
+                continue
+            if n == 0:
+                # end of the file or no more writer on the FIFO
+                break
+            filled += n
+
+            if filled == len(buffer):
+                self.write(output, view[:filled])
+                filled = 0
+
+        # the last chunk is written even if it is not complete
+        self.write(output, view[:filled])
+
+    def buffered_copy(self, source: io.FileIO, poll, output: io.FileIO):
+        """Reads the source into a ring buffer written by a second thread"""
+        s = self.statistics
+        ring = RingBuffer(self.ring_size, s)
+        writer = threading.Thread(
+            target=ring.drain, args=(output, self.write),
+            name=f"writer {self.filename}", daemon=True
+        )
+        writer.start()
+        scratch = memoryview(bytearray(CHUNK_SIZE))
+        # bytes to drop so that the file goes on at a packet boundary
+        skip = 0
+        try:
+            while not self.stopping.is_set():
+                if ring.error is not None:
+                    raise ring.error
+                view = ring.free()
+                dropping = len(view) == 0 or skip != 0
+                if dropping:
+                    view = scratch[:skip or CHUNK_SIZE]
+                n = self.read(source, poll, view)
+                if n is None:
+                    continue
+                if n == 0:
+                    break
+                if dropping:
+                    ring.drop(n)
+                    skip = -s.bytes_read % TS_PACKET_SIZE
+                else:
+                    ring.commit(n)
+        finally:
+            ring.close()
+            writer.join()
+        if ring.error is not None:
+            raise ring.error
+
+    def write(self, output: io.FileIO, data: memoryview):
+        while len(data) > 0:
+            n = output.write(data)
+            data = data[n:]
+            self.statistics.writes += 1
+
+
+async def run(
+    source: str, filename: str, duration: float, ring_size: int = 0
+):
+    capture = Capture(source, Path(filename), duration, ring_size=ring_size)
+    await capture.start()
+    await capture.wait()
+
+    s = capture.statistics
+    print(
+        f"{s.bytes_read} bytes in {s.elapsed:.3f} s, {s.reads} reads, "
+        f"{s.writes} writes, {s.overflows} overflows, "
+        f"{s.bitrate / 1e6:.2f} Mbit/s"
+    )
+    if ring_size != 0:
+        print(
+            f"ring buffer: {s.high_water} bytes high water, {s.stalls} stalls, "
+            f"{s.dropped} bytes dropped, {s.syncs} syncs"
+        )
+
+
+def main():
+    """Copies a transport stream from a dvr device, a FIFO or a file, to test
+    the capture without the recorder"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source")
+    parser.add_argument("output")
+    parser.add_argument("-t", "--duration", type=float, default=60)
+    parser.add_argument(
+        "-r", "--ring-buffer", type=int, default=0,
+        help="size of the ring buffer (MiB), none if 0"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(
+        args.source, args.output, args.duration, args.ring_buffer * 1024 * 1024
+    ))
+
+
+if __name__ == "__main__":
+    main()
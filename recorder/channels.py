@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+import os
+from typing import Optional
+
+
+@dataclass
+class Channel:
+    name: str
+    frequency: int
+    inversion: str
+    bandwidth: str
+    code_rate_hp: str
+    code_rate_lp: str
+    modulation: str
+    transmission_mode: str
+    guard_interval: str
+    hierarchy: str
+    video_pid: int
+    audio_pid: int
+    service_id: int
+
+
+def parse_channel(line: str) -> Channel:
+    """Parses a line of a channels file in zap format"""
+    # the name is what is before the first colon, the parameters are the
+    # last twelve fields (some names are followed by an empty field)
+    name = line.split(":", 1)[0]
+    fields = line.strip().rsplit(":", 12)[1:]
+    return Channel(
+        name,
+        int(fields[0]),
+        fields[1],
+        fields[2],
+        fields[3],
+        fields[4],
+        fields[5],
+        fields[6],
+        fields[7],
+        fields[8],
+        int(fields[9]),
+        int(fields[10]),
+        int(fields[11])
+    )
+
+
+def read_channels(filename: str) -> list[Channel]:
+    """Reads a channels file in zap format"""
+    with open(filename) as f:
+        return [parse_channel(line) for line in f if line.strip()]
+
+
+class ChannelTable:
+    """Channels of a channels file indexed by name and by multiplex. The file
+    is parsed again only when its modification time changes."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.mtime = None
+        self.channels: list[Channel] = []
+        self.channel_names: list[str] = []
+        self.by_name: dict[str, Channel] = {}
+        self.by_frequency: dict[int, list[Channel]] = {}
+        self.by_service_id: dict[int, Channel] = {}
+
+    def refresh(self):
+        mtime = os.stat(self.filename).st_mtime_ns
+        if mtime == self.mtime:
+            return
+
+        channels = read_channels(self.filename)
+        by_name: dict[str, Channel] = {}
+        by_frequency: dict[int, list[Channel]] = {}
+        by_service_id: dict[int, Channel] = {}
+        for channel in channels:
+            by_name.setdefault(channel.name, channel)
+            by_frequency.setdefault(channel.frequency, []).append(channel)
+            by_service_id.setdefault(channel.service_id, channel)
+
+        self.channels = channels
+        self.channel_names = [channel.name for channel in channels]
+        self.by_name = by_name
+        self.by_frequency = by_frequency
+        self.by_service_id = by_service_id
+        self.mtime = mtime
+
+    def names(self) -> list[str]:
+        self.refresh()
+        return self.channel_names
+
+    def get(self, name: str) -> Channel:
+        """Returns the channel of a name, raises KeyError if not found"""
+        self.refresh()
+        return self.by_name[name]
+
+    def frequencies(self) -> list[int]:
+        self.refresh()
+        return list(self.by_frequency.keys())
+
+    def by_service(self, service_id: int) -> Optional[Channel]:
+        self.refresh()
+        return self.by_service_id.get(service_id)
+
+    def multiplex(self, frequency: int) -> list[Channel]:
+        """Returns the channels broadcasted on a frequency"""
+        self.refresh()
+        return self.by_frequency.get(frequency, [])
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+import signal
+from typing import Optional
+
+from recorder.supervision import CHECK_PERIOD
+
+logger = logging.getLogger(__name__)
+
+CAPTURES_FILENAME = "data/captures.json"
+
+
+def start_time(pid: int) -> Optional[int]:
+    """Returns the start of a process in clock ticks since boot, None if it
+    does not exist. It tells a process from a later one with the same pid."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name in parentheses may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+    except FileNotFoundError:
+        return None
+    if fields[0] == "Z":
+        # over, not reaped yet
+        return None
+    return int(fields[19])
+
+
+class StatusFile:
+    """Reads the status lines written by a detached tuner into a file, like
+    its standard error. The reading ends when the file is closed."""
+
+    def __init__(self, filename: Path):
+        self.file = open(filename, "rb")
+        self.closed = False
+
+    async def read(self, n: int) -> bytes:
+        while not self.closed:
+            data = self.file.read(n)
+            if len(data) != 0:
+                return data
+            await asyncio.sleep(CHECK_PERIOD)
+        return b""
+
+    def close(self):
+        self.closed = True
+        self.file.close()
+
+
+class DetachedCapture:
+    """A dvbv5-zap writing a file in its own session, so that it goes on if
+    the recorder stops. Its status lines are written to a file. It behaves
+    like the process of a recording, a capture started by a previous run of
+    the recorder is adopted with its pid."""
+
+    def __init__(
+        self, pid: int, status: Path,
+        process: Optional[asyncio.subprocess.Process] = None
+    ):
+        self.pid = pid
+        self.status = status
+        self.started = start_time(pid)
+        # the child process, None if the capture is adopted
+        self.process = process
+        self.stderr = StatusFile(status)
+        self.returncode = None
+
+    @classmethod
+    async def start(cls, command: tuple, status: Path) -> "DetachedCapture":
+        with open(status, "wb") as f:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL, stderr=f,
+                start_new_session=True
+            )
+        return cls(process.pid, status, process)
+
+    @classmethod
+    def adopt(cls, state: dict) -> Optional["DetachedCapture"]:
+        """Returns the capture of a state if it is still running"""
+        if start_time(state["pid"]) != state["started"]:
+            logger.debug(f"capture of process {state['pid']} is over")
+            return None
+        return cls(state["pid"], Path(state["status"]))
+
+    def terminate(self):
+        self.returncode = -signal.SIGTERM
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    async def wait(self):
+        if self.process is not None:
+            returncode = await self.process.wait()
+        else:
+            # the return code of a process which is not a child is unknown
+            while start_time(self.pid) == self.started:
+                await asyncio.sleep(CHECK_PERIOD)
+            returncode = 0
+        if self.returncode is None:
+            self.returncode = returncode
+        self.stderr.close()
+        return self.returncode
+
+    def state(self, files: list[Path]) -> dict:
+        return {
+            "pid": self.pid,
+            "started": self.started,
+            "status": str(self.status),
+            "files": [f.name for f in files]
+        }
+
+
+class CaptureStates:
+    """States of the detached captures by recording id, saved in a file so
+    that the recorder adopts them when it starts again"""
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self.states: dict[int, dict] = {}
+
+    def load(self) -> dict[int, dict]:
+        try:
+            with open(self.filename) as f:
+                self.states = {int(k): v for k, v in json.load(f).items()}
+        except (FileNotFoundError, ValueError):
+            self.states = {}
+        return self.states
+
+    def save(self):
+        temporary = self.filename.with_suffix(".tmp")
+        with open(temporary, "w") as f:
+            json.dump(self.states, f)
+        temporary.replace(self.filename)
+
+    def add(self, id_: int, state: dict):
+        previous = self.states.get(id_)
+        if previous is not None:
+            if previous["status"] != state["status"]:
+                # the capture has been moved to another adapter
+                Path(previous["status"]).unlink(missing_ok=True)
+            if "preroll" in previous:
+                state["preroll"] = previous["preroll"]
+        self.states[id_] = state
+        self.save()
+
+    def set_preroll(self, id_: int, size: int):
+        """Saves the size of the pre-roll of the first file of a capture, to
+        remove it when an adopted capture ends"""
+        if id_ in self.states:
+            self.states[id_]["preroll"] = size
+            self.save()
+
+    def remove(self, id_: int):
+        state = self.states.pop(id_, None)
+        if state is not None:
+            Path(state["status"]).unlink(missing_ok=True)
+            self.save()
@@ -0,0 +1,260 @@
+import argparse
+from dataclasses import dataclass
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import logging
+from typing import Optional
+
+from recorder.multiplex import crc32_mpeg
+from recorder.multiplex import EIT_PID
+from recorder.multiplex import packet_payload
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.multiplex import TS_SYNC_BYTE
+from recorder.store import Store
+
+logger = logging.getLogger(__name__)
+
+# present/following and schedule tables of the actual transport stream
+EIT_TABLES = range(0x4e, 0x60)
+SHORT_EVENT_DESCRIPTOR = 0x4d
+MJD_EPOCH = date(1858, 11, 17)
+# the events are written to the store by batches
+FLUSH_EVENTS = 200
+# the versions of the sections already parsed are forgotten beyond that
+MAX_SECTIONS = 100_000
+# character tables selected by the first byte of a text (ETSI EN 300 468)
+CHARACTER_TABLES = {
+    0x01: "iso8859_5", 0x02: "iso8859_6", 0x03: "iso8859_7",
+    0x04: "iso8859_8", 0x05: "iso8859_9", 0x06: "iso8859_10",
+    0x07: "iso8859_11", 0x09: "iso8859_13", 0x0a: "iso8859_14",
+    0x0b: "iso8859_15", 0x11: "utf_16_be", 0x15: "utf_8"
+}
+
+
+@dataclass
+class Event:
+    """Programme of the guide, the dates are local"""
+    service_id: int
+    event_id: int
+    begin_date: datetime
+    end_date: datetime
+    title: str
+    description: str
+
+
+def bcd(value: int) -> int:
+    return (value >> 4) * 10 + (value & 0x0f)
+
+
+def decode_text(data: bytes) -> str:
+    if len(data) == 0:
+        return ""
+    encoding = "latin_1"
+    if data[0] < 0x20:
+        if data[0] == 0x10 and len(data) >= 3:
+            encoding = f"iso8859_{data[2]}"
+            data = data[3:]
+        else:
+            encoding = CHARACTER_TABLES.get(data[0], encoding)
+            data = data[1:]
+    try:
+        text = data.decode(encoding, errors="replace")
+    except LookupError:
+        text = data.decode("latin_1")
+    # emphasis and line break control codes
+    return "".join(
+        c for c in text if c >= " " and not "\x80" <= c <= "\x9f"
+    ).strip()
+
+
+def decode_date(data: bytes) -> Optional[datetime]:
+    """Returns the local date of a MJD and UTC BCD time"""
+    if data == b"\xff" * 5:
+        return None
+    mjd = (data[0] << 8) | data[1]
+    utc = datetime.combine(
+        MJD_EPOCH + timedelta(days=mjd),
+        datetime.min.time(), timezone.utc
+    ) + timedelta(hours=bcd(data[2]), minutes=bcd(data[3]), seconds=bcd(data[4]))
+    return utc.astimezone().replace(tzinfo=None)
+
+
+def parse_eit(section: bytes) -> list[Event]:
+    """Returns the events of an EIT section"""
+    events = []
+    service_id = (section[3] << 8) | section[4]
+    i = 14
+    end = len(section) - 4
+    while i + 12 <= end:
+        event_id = (section[i] << 8) | section[i + 1]
+        begin_date = decode_date(section[i + 2:i + 7])
+        duration = timedelta(
+            hours=bcd(section[i + 7]), minutes=bcd(section[i + 8]),
+            seconds=bcd(section[i + 9])
+        )
+        descriptors_length = ((section[i + 10] & 0x0f) << 8) | section[i + 11]
+        i += 12
+        descriptors_end = min(i + descriptors_length, end)
+
+        title = description = ""
+        while i + 2 <= descriptors_end:
+            tag, length = section[i], section[i + 1]
+            descriptor = section[i + 2:i + 2 + length]
+            i += 2 + length
+            if tag == SHORT_EVENT_DESCRIPTOR and len(descriptor) >= 4:
+                name_length = descriptor[3]
+                title = decode_text(descriptor[4:4 + name_length])
+                text = descriptor[4 + name_length:]
+                if len(text) != 0:
+                    description = decode_text(text[1:1 + text[0]])
+        i = descriptors_end
+
+        if begin_date is not None and title:
+            events.append(Event(
+                service_id, event_id, begin_date, begin_date + duration,
+                title, description
+            ))
+    return events
+
+
+class SectionAssembler:
+    """Rebuilds the PSI sections of a PID from its packets, a section may
+    span many packets and a packet may hold many sections"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.continuity_counter = None
+        self.started = False
+
+    def feed(self, packet) -> list[bytes]:
+        if packet[1] & 0x80:
+            # transport error
+            return []
+        continuity_counter = packet[3] & 0x0f
+        if self.continuity_counter is not None and \
+                continuity_counter != (self.continuity_counter + 1) & 0x0f:
+            # a packet is lost, the current section is dropped
+            self.buffer.clear()
+            self.started = False
+        self.continuity_counter = continuity_counter
+
+        payload = packet_payload(packet)
+        if len(payload) == 0:
+            return []
+        if packet[1] & 0x40:
+            pointer = payload[0]
+            if self.started:
+                self.buffer += payload[1:1 + pointer]
+            sections = self.sections()
+            self.buffer = bytearray(payload[1 + pointer:])
+            self.started = True
+        elif self.started:
+            self.buffer += payload
+            sections = []
+        else:
+            return []
+        return sections + self.sections()
+
+    def sections(self) -> list[bytes]:
+        sections = []
+        while len(self.buffer) >= 3 and self.buffer[0] != 0xff:
+            length = 3 + (((self.buffer[1] & 0x0f) << 8) | self.buffer[2])
+            if len(self.buffer) < length:
+                break
+            sections.append(bytes(self.buffer[:length]))
+            del self.buffer[:length]
+        if len(self.buffer) != 0 and self.buffer[0] == 0xff:
+            # stuffing up to the end of the packet
+            self.buffer.clear()
+            self.started = False
+        return sections
+
+
+class Epg:
+    """Programme guide read from the EIT of the transport streams.
+
+    The packets of the EIT PID are fed as they come and the sections are
+    parsed once: a section already parsed in the same version is skipped
+    before its CRC is checked. The events are written to the store by
+    batches, or kept in events if there is no store."""
+
+    def __init__(self, store: Optional[Store] = None):
+        self.store = store
+        self.assembler = SectionAssembler()
+        # (table id, service id, section number) -> version
+        self.versions: dict[tuple[int, int, int], int] = {}
+        self.events: list[Event] = []
+
+    def feed(self, data: bytes) -> int:
+        """Feeds packets of a transport stream, whole packets are expected.
+        Returns the number of packets of the EIT."""
+        # numpy is not imported at startup
+        import numpy as np
+
+        packets = np.frombuffer(
+            data, dtype=np.uint8, count=len(data) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        ).reshape(-1, TS_PACKET_SIZE)
+        pids = ((packets[:, 1].astype(np.uint16) & 0x1f) << 8) | packets[:, 2]
+        eit = packets[(pids == EIT_PID) & (packets[:, 0] == TS_SYNC_BYTE)]
+        for packet in eit:
+            self.feed_packet(packet.tobytes())
+        return len(eit)
+
+    def feed_packet(self, packet: bytes):
+        for section in self.assembler.feed(packet):
+            self.feed_section(section)
+
+    def feed_section(self, section: bytes):
+        if len(section) < 18 or section[0] not in EIT_TABLES:
+            return
+        key = (section[0], (section[3] << 8) | section[4], section[6])
+        version = (section[5] >> 1) & 0x1f
+        if self.versions.get(key) == version or crc32_mpeg(section) != 0:
+            return
+        if len(self.versions) >= MAX_SECTIONS:
+            self.versions.clear()
+        self.versions[key] = version
+
+        self.events += parse_eit(section)
+        if self.store is not None and len(self.events) >= FLUSH_EVENTS:
+            self.flush()
+
+    def flush(self):
+        if self.store is not None and len(self.events) != 0:
+            self.store.add_events(self.events)
+            self.events = []
+
+
+def parse_file(filename: str) -> list[Event]:
+    """Returns the events of a recorded transport stream"""
+    epg = Epg()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(1024 * TS_PACKET_SIZE)
+            if len(data) == 0:
+                break
+            epg.feed(data)
+    # the present/following events are repeated in the schedule
+    events = {(e.service_id, e.event_id): e for e in epg.events}
+    return sorted(events.values(), key=lambda e: (e.service_id, e.begin_date))
+
+
+def main():
+    """Prints the programme guide of a recorded transport stream"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("-s", "--service", type=int, help="service id")
+    args = parser.parse_args()
+
+    for event in parse_file(args.filename):
+        if args.service is None or event.service_id == args.service:
+            print(
+                f"{event.service_id} {event.begin_date:%d/%m/%Y %H:%M} "
+                f"{event.end_date:%H:%M} {event.title}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ from aiohttp_session_flash import flash
 
 @web.middleware
 async def error_middleware(request, handler):
+    if request.path.startswith("/api/"):
+        # the API returns its errors in JSON
+        return await handler(request)
     try:
         response = await handler(request)
         if response.status in [400, 403, 404, 405]:
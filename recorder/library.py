@@ -0,0 +1,295 @@
+import asyncio
+import ctypes
+import ctypes.util
+from dataclasses import dataclass
+from datetime import datetime
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import struct
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.multiplex import TS_SYNC_BYTE
+from recorder.storage import RECORDING_SUFFIX
+from recorder.storage import SIDECAR_SUFFIXES
+from recorder.store import Store
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# the files are written to the store by batches
+BATCH_SIZE = 200
+# the PCR are read at the beginning and at the end of the files
+PCR_READ_SIZE = 4096 * TS_PACKET_SIZE
+PCR_FREQUENCY = 90000
+PCR_MODULO = 1 << 33
+# the changes notified are indexed after this delay (s)
+DEBOUNCE_DELAY = 2.0
+# the directory is scanned again at this period without inotify (s)
+RESCAN_PERIOD = 600
+PAGE_SIZE = 50
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+@dataclass
+class LibraryFile:
+    filename: str
+    mtime_ns: int
+    size: int
+    date: datetime
+    program_name: str
+    channel: Optional[str] = None
+    duration: Optional[float] = None
+    bitrate: Optional[float] = None
+    thumbnail: Optional[str] = None
+
+
+def read_pcrs(data: bytes) -> "np.ndarray":
+    """Returns the PCR of the first PCR PID of a part of a transport stream,
+    which may begin in the middle of a packet"""
+    # numpy is not imported at startup
+    import numpy as np
+
+    offset = data.find(bytes([TS_SYNC_BYTE]))
+    while offset != -1 and offset + TS_PACKET_SIZE < len(data) and \
+            data[offset + TS_PACKET_SIZE] != TS_SYNC_BYTE:
+        offset = data.find(bytes([TS_SYNC_BYTE]), offset + 1)
+    if offset == -1:
+        return np.zeros(0, dtype=np.int64)
+    count = (len(data) - offset) // TS_PACKET_SIZE
+    packets = np.frombuffer(
+        data, dtype=np.uint8, count=count * TS_PACKET_SIZE, offset=offset
+    ).reshape(-1, TS_PACKET_SIZE)
+    packets = packets[
+        (packets[:, 0] == TS_SYNC_BYTE) & ((packets[:, 3] & 0x20) != 0) &
+        (packets[:, 4] >= 7) & ((packets[:, 5] & 0x10) != 0)
+    ]
+    if len(packets) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pids = ((packets[:, 1].astype(np.int64) & 0x1f) << 8) | packets[:, 2]
+    packets = packets[pids == pids[0]].astype(np.int64)
+    pcrs: "np.ndarray" = (
+        (packets[:, 6] << 25) | (packets[:, 7] << 17) | (packets[:, 8] << 9) |
+        (packets[:, 9] << 1) | (packets[:, 10] >> 7)
+    )
+    return pcrs
+
+
+def pcr_duration(filename: Path, size: int) -> Optional[float]:
+    """Returns the duration of a transport stream from the PCR of its
+    beginning and of its end, without reading it all"""
+    with open(filename, "rb") as f:
+        head = read_pcrs(f.read(PCR_READ_SIZE))
+        f.seek(max(size - PCR_READ_SIZE, 0))
+        tail = read_pcrs(f.read(PCR_READ_SIZE))
+    if len(head) == 0 or len(tail) == 0:
+        return None
+    duration = ((int(tail[-1]) - int(head[0])) % PCR_MODULO) / PCR_FREQUENCY
+    return duration if duration > 0 else None
+
+
+def index_file(path: Path, st: os.stat_result) -> LibraryFile:
+    """Returns the data of a recorded file, the duration measured by the
+    post-processing is used if there is one"""
+    duration = None
+    try:
+        with open(path.with_suffix(".info.json")) as f:
+            duration = float(json.load(f)["duration"]) or None
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    if duration is None:
+        try:
+            duration = pcr_duration(path, st.st_size)
+        except OSError:
+            pass
+    thumbnail = path.with_suffix(".jpg")
+    return LibraryFile(
+        path.name, st.st_mtime_ns, st.st_size,
+        datetime.fromtimestamp(st.st_mtime), path.stem.replace("-", " "),
+        None, duration,
+        st.st_size * 8 / duration if duration else None,
+        thumbnail.name if thumbnail.exists() else None
+    )
+
+
+class Inotify:
+    """Notifications of the changes of the files of a directory"""
+
+    def __init__(self, directory: Path, mask: int):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error))
+
+    def read(self) -> list[str]:
+        """Returns the names of the files changed"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Library:
+    """Index of the recorded files, kept in the store.
+
+    At startup, only the files whose modification time or size changed since
+    the previous scan are read again. The changes are then followed with
+    inotify, or by scanning again periodically if it is not available. The
+    duration is read from the PCR of the beginning and of the end of the
+    files."""
+
+    def __init__(self, directory: str, store: Store):
+        self.directory = Path(directory)
+        self.store = store
+        # names of the files changed, indexed after DEBOUNCE_DELAY
+        self.changed: set[str] = set()
+        self.wakeup = asyncio.Event()
+        self.inotify = None
+        self.task = None
+
+    def find_changes(
+        self, states: dict[str, tuple[int, int]], names: Optional[set[str]]
+    ) -> tuple[list[tuple[str, os.stat_result]], list[str]]:
+        """Returns the files to index and the names of the files removed,
+        among names or in the whole directory if names is None. The files
+        notified are indexed again even if they did not change, their
+        post-processing files may have."""
+        if names is None:
+            entries = [
+                (e.name, e.stat()) for e in os.scandir(self.directory)
+                if e.name.endswith(RECORDING_SUFFIX) and e.is_file()
+            ]
+            removed = set(states.keys())
+        else:
+            entries = []
+            removed = set()
+            for name in names:
+                try:
+                    entries.append((name, Path(self.directory, name).stat()))
+                except FileNotFoundError:
+                    removed.add(name)
+        changed = []
+        for name, st in entries:
+            removed.discard(name)
+            if names is not None or \
+                    states.get(name) != (st.st_mtime_ns, st.st_size):
+                changed.append((name, st))
+        return changed, sorted(removed & set(states.keys()))
+
+    def index_files(
+        self, entries: list[tuple[str, os.stat_result]]
+    ) -> list[LibraryFile]:
+        return [index_file(Path(self.directory, name), st) for name, st in entries]
+
+    async def update(self, names: Optional[set[str]] = None):
+        """Indexes the files changed, by batches so that a long scan is not
+        lost if it is interrupted"""
+        loop = asyncio.get_running_loop()
+        states = self.store.get_file_states()
+        changed, removed = await loop.run_in_executor(
+            None, self.find_changes, states, names
+        )
+        self.store.remove_files(removed)
+        for i in range(0, len(changed), BATCH_SIZE):
+            files = await loop.run_in_executor(
+                None, self.index_files, changed[i:i + BATCH_SIZE]
+            )
+            self.store.add_files(files)
+        if len(changed) != 0 or len(removed) != 0:
+            logger.info(
+                f"library: {len(changed)} files indexed, {len(removed)} removed"
+            )
+
+    def notified(self):
+        for name in self.inotify.read():
+            for suffix in SIDECAR_SUFFIXES:
+                if name.endswith(suffix):
+                    # a file made by the post-processing
+                    name = name[:-len(suffix)] + RECORDING_SUFFIX
+                    break
+            if name.endswith(RECORDING_SUFFIX):
+                self.changed.add(name)
+        if len(self.changed) != 0:
+            self.wakeup.set()
+
+    async def run(self):
+        await self.update()
+        loop = asyncio.get_running_loop()
+        try:
+            self.inotify = Inotify(
+                self.directory,
+                IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+            )
+        except OSError as e:
+            logger.warning(f"library: no inotify, {e}")
+            while True:
+                await asyncio.sleep(RESCAN_PERIOD)
+                await self.update()
+
+        loop.add_reader(self.inotify.fd, self.notified)
+        try:
+            while True:
+                await self.wakeup.wait()
+                await asyncio.sleep(DEBOUNCE_DELAY)
+                self.wakeup.clear()
+                names = self.changed
+                self.changed = set()
+                await self.update(names)
+        finally:
+            loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+
+    def add_recording(self, filename: str, channel: str, program_name: str):
+        """Sets the channel and the program name of a file just recorded"""
+        self.store.set_file_channel(filename, channel, program_name)
+        self.changed.add(filename)
+        self.wakeup.set()
+
+    def search(self, words: str, page: int) -> tuple[list[dict], int]:
+        """Returns a page of the files and the number of pages"""
+        files, count = self.store.search_files(
+            words, (page - 1) * PAGE_SIZE, PAGE_SIZE
+        )
+        return files, max(math.ceil(count / PAGE_SIZE), 1)
+
+    def start(self):
+        if self.directory.is_dir():
+            self.task = asyncio.create_task(self.run())
+        else:
+            logger.warning(f"library: {self.directory} is not a directory")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
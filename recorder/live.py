@@ -0,0 +1,146 @@
+import asyncio
+from dataclasses import asdict
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# the progress of the recordings running is sent at this period (s)
+PROGRESS_PERIOD = 2.0
+# a comment is sent to the idle connections at this period (s)
+KEEPALIVE_PERIOD = 15.0
+# messages waiting for a slow browser, the oldest is dropped beyond
+CLIENT_QUEUE_SIZE = 4
+
+
+def dump_recording(id_: int, recording: dict) -> dict:
+    """Returns the JSON object of a recording, for the API and the
+    browsers"""
+    return {
+        "id": id_,
+        "channel": recording["channel"],
+        "program_name": recording["program_name"],
+        "begin_date": recording["begin_date"].isoformat(),
+        "end_date": recording["end_date"].isoformat(),
+        "adapter": recording["adapter"],
+        "shutdown": recording["shutdown"],
+        "duration": recording["duration"],
+        "filename": recording["filename"],
+        "series": recording["series"],
+        "recording": recording["process"] is not None,
+        "tuner": None if recording["supervisor"] is None
+        else asdict(recording["supervisor"].status)
+    }
+
+
+class LiveStatus:
+    """State of the recorder pushed to the browsers with server-sent events.
+
+    A single task builds the state when the recorder notifies a change, and
+    periodically while recordings are running. The message is encoded once
+    and queued for every connected browser, so that they share the same
+    stream and never poll the server. The task only runs while a browser is
+    connected."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.clients: set[asyncio.Queue] = set()
+        self.changed = asyncio.Event()
+        # last message sent, sent first to the browsers connecting
+        self.message = None
+        # (size, monotonic date) of the files at the previous state by id
+        self.sizes: dict[int, tuple[int, float]] = {}
+        self.task = None
+
+    def notify(self):
+        """Called by the recorder when a recording or an adapter changes"""
+        self.changed.set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        if self.message is not None:
+            queue.put_nowait(self.message)
+        self.clients.add(queue)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.clients.discard(queue)
+        if len(self.clients) == 0:
+            self.stop()
+
+    def progress(self, id_: int, recording: dict, now: float) -> dict:
+        """Returns the elapsed time, the size and the bitrate since the
+        previous state of a recording running"""
+        size = self.recorder.written(recording)
+        elapsed = now - recording["started"]
+        previous_size, previous_date = self.sizes.get(
+            id_, (0, recording["started"])
+        )
+        self.sizes[id_] = (size, now)
+        bitrate = 0
+        if now > previous_date:
+            bitrate = (size - previous_size) * 8 / (now - previous_date)
+        return {"elapsed": round(elapsed), "bytes": size, "bitrate": round(bitrate)}
+
+    def state(self) -> dict:
+        recorder = self.recorder
+        now = time.monotonic()
+        recordings = []
+        for id_, recording in recorder.get_recordings():
+            data = dump_recording(id_, recording)
+            if recording["process"] is not None:
+                data["state"] = "recording"
+                data.update(self.progress(id_, recording, now))
+            elif recording["task"] is not None:
+                data["state"] = "starting"
+            else:
+                data["state"] = "scheduled"
+            recordings.append(data)
+        for id_ in self.sizes.keys() - recorder.recordings.keys():
+            del self.sizes[id_]
+
+        adapters = []
+        for adapter, busy in enumerate(recorder.busy):
+            adapters.append({
+                "adapter": adapter,
+                "busy": busy,
+                "guide": adapter in recorder.scans,
+                "recordings": [
+                    r["id"] for r in recordings
+                    if r["adapter"] == adapter and r["state"] == "recording"
+                ]
+            })
+        return {"recordings": recordings, "adapters": adapters}
+
+    def broadcast(self, message: bytes):
+        for queue in self.clients:
+            if queue.full():
+                # the states are complete, only the last ones matter
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            state = self.state()
+            message = f"data: {json.dumps(state)}\n\n".encode()
+            if message != self.message:
+                self.message = message
+                self.broadcast(message)
+            running = any(r["state"] == "recording" for r in state["recordings"])
+            try:
+                await asyncio.wait_for(
+                    self.changed.wait(), PROGRESS_PERIOD if running else None
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.message = None
+        self.sizes.clear()
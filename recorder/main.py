@@ -1,10 +1,8 @@
 import argparse
 import asyncio
-from datetime import datetime
 from functools import partial
 import logging
 from pathlib import Path
-import sys
 
 from aiohttp import web
 from aiohttp_babel.locale import load_gettext_translations
@@ -22,6 +20,7 @@ from wtforms import BooleanField
 from wtforms import DateTimeField
 from wtforms import Form
 from wtforms import SelectField
+from wtforms import SelectMultipleField
 from wtforms import StringField
 from wtforms import SubmitField
 from wtforms.validators import Length
@@ -29,13 +28,21 @@ from wtforms.validators import DataRequired
 from wtforms.validators import Optional
 
 import recorder.config as config
+from recorder.allocation import ConflictError
+from recorder.api import setup_routes as setup_api_routes
+from recorder.assets import Assets
+from recorder.assets import ASSETS_DIRECTORY
+from recorder.boot import restore
+from recorder.boot import set_log_levels
 from recorder.error import error_middleware
-from recorder.record import Recorder
+from recorder.live import KEEPALIVE_PERIOD
+from recorder.metrics import CONTENT_TYPE
+from recorder.series import Series
+from recorder.streaming import stream_recording
 from recorder.utils import _l
 from recorder.utils import remove_special_data
 from recorder.utils import set_language
 from recorder.utils import halt
-from recorder.wakeup import Awakenings
 
 DEFAULT_LANGUAGE = "fr"
 
@@ -43,14 +50,11 @@ routes = web.RouteTableDef()
 
 record = None
 wakeup = None
-path = None
+store = None
+path = Path(__file__).resolve().parent.parent
 
+# the handler is set up by recorder.boot
 logger = logging.getLogger()
-handler = logging.StreamHandler(stream=sys.stdout)
-formatter = logging.Formatter("%(asctime)s %(module)s %(levelname)s %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
 
 
 def locale_detector(request, locale):
@@ -67,35 +71,20 @@ def setup_i18n(path: Path, locale):
 
 
 async def init():
-    global path
     global record
     global wakeup
+    global store
 
-    path = Path(__file__).resolve().parent.parent
-
-    logging.getLogger("aiohttp").setLevel(logging.WARNING)
-
-    # set log level of modules' loggers
-    for lg_name, lg_level in config.loggers.items():
-        if lg_name == "root":
-            logger.setLevel(lg_level)
-        else:
-            module = sys.modules[lg_name]
-            module_logger = getattr(module, "logger")
-            module_logger.setLevel(lg_level)
-
-    record = Recorder(path)
-    wakeup = Awakenings(path)
-
-    await record.load()
-    await wakeup.load()
+    set_log_levels()
+    store, wakeup, record = await restore(path)
+    record.start_services()
 
 
 async def close():
     await record.cancel_recordings()
 
-    await record.save()
-    await wakeup.save()
+    # the schedule is already in the store
+    await store.close()
 
 
 @aiohttp_jinja2.template("index.html")
@@ -105,6 +94,13 @@ async def cancel_recording(request):
     return web.HTTPFound(request.app.router["index"].url_for())
 
 
+@aiohttp_jinja2.template("index.html")
+async def cancel_series(request):
+    id_ = int(request.match_info["id"])
+    await request.app.record.cancel_series(id_)
+    return web.HTTPFound(request.app.router["index"].url_for())
+
+
 @aiohttp_jinja2.template("index.html")
 async def cancel_awakening(request):
     id_ = int(request.match_info["id"])
@@ -112,6 +108,89 @@ async def cancel_awakening(request):
     return web.HTTPFound(request.app.router["index"].url_for())
 
 
+@aiohttp_jinja2.template("index.html")
+async def record_event(request):
+    service_id = int(request.match_info["service_id"])
+    event_id = int(request.match_info["event_id"])
+    recorder = request.app.record
+    try:
+        id_ = recorder.record_event(service_id, event_id)
+    except ValueError as e:
+        flash(request, ("danger", str(e)))
+    except ConflictError as e:
+        flash(request, ("danger", recorder.describe_conflicts(e)))
+    else:
+        recording = recorder.recordings[id_]
+        message = _(
+            "L'enregistrement de \"{}\" est programmé "
+            "pour le {} à {} pendant {} minutes de \"{}\" "
+            "sur l'enregistreur {}"
+        ).format(
+            recording["program_name"],
+            recording["begin_date"].strftime("%d/%m/%Y"),
+            recording["begin_date"].strftime("%H:%M"),
+            round(recording["duration"] / 60), recording["channel"],
+            recording["adapter"]
+        )
+        flash(request, ("info", message))
+    return web.HTTPFound(request.app.router["index"].url_for())
+
+
+@aiohttp_jinja2.template("library.html")
+async def library(request):
+    q = request.query.get("q", "")
+    try:
+        page = max(int(request.query.get("page", 1)), 1)
+    except ValueError:
+        raise web.HTTPBadRequest()
+    files, pages = request.app.record.library.search(q, page)
+    return {"files": files, "q": q, "page": page, "pages": pages}
+
+
+async def thumbnail(request):
+    directory = Path(request.app.record.recording_directory).resolve()
+    filename = Path(directory, request.match_info["filename"]).resolve()
+    if filename.parent != directory or filename.suffix != ".jpg" or \
+            not filename.is_file():
+        raise web.HTTPNotFound()
+    return web.FileResponse(filename)
+
+
+async def events(request):
+    """Stream of the states of the recorder"""
+    live = request.app.record.live
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            # no buffering by a reverse proxy
+            "X-Accel-Buffering": "no"
+        }
+    )
+    await response.prepare(request)
+    queue = live.subscribe()
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), KEEPALIVE_PERIOD)
+            except asyncio.TimeoutError:
+                message = b": keepalive\n\n"
+            await response.write(message)
+    except ConnectionResetError:
+        pass
+    finally:
+        live.unsubscribe(queue)
+    return response
+
+
+async def metrics(request):
+    recorder = request.app.record
+    return web.Response(
+        body=recorder.metrics.render(recorder).encode(),
+        headers={"Content-Type": CONTENT_TYPE}
+    )
+
+
 @routes.view("/", name="index")
 class IndexView(web.View):
 
@@ -135,6 +214,26 @@ class IndexView(web.View):
             format="%d/%m/%Y %H:%M",
             validators=[DataRequired()]
         )
+        recurrence = SelectField(
+            _l("Répétition"),
+            choices=[
+                ("none", _l("Aucune")),
+                ("daily", _l("Tous les jours")),
+                ("weekdays", _l("Du lundi au vendredi")),
+                ("weekly", _l("Toutes les semaines")),
+                ("custom", _l("Jours choisis"))
+            ],
+            default="none"
+        )
+        weekdays = SelectMultipleField(
+            _l("Jours"),
+            choices=[
+                (0, _l("Lundi")), (1, _l("Mardi")), (2, _l("Mercredi")),
+                (3, _l("Jeudi")), (4, _l("Vendredi")), (5, _l("Samedi")),
+                (6, _l("Dimanche"))
+            ],
+            coerce=int
+        )
         shutdown = BooleanField(_l("Extinction"))
         submit = SubmitField(_l("Valider"))
 
@@ -155,14 +254,15 @@ class IndexView(web.View):
         super().__init__(request)
         self.recorder = request.app.record
         self.wakeup = request.app.wakeup
-        self.adapters_choices = [
+        self.adapters_choices = [(-1, _("Automatique"))] + [
             (i, str(i)) for i in range(self.recorder.dvb_adapter_number)
         ]
         self.channels_choices = list(enumerate(self.recorder.get_channels()))
 
     @aiohttp_jinja2.template("index.html")
     async def post(self):
-        form = self.RecordingForm(await self.request.post())
+        post = await self.request.post()
+        form = self.RecordingForm(post)
         form.adapter.choices = self.adapters_choices
         form.channel.choices = self.channels_choices
         if form.data["submit"]:
@@ -170,49 +270,76 @@ class IndexView(web.View):
                 data = remove_special_data(form.data)
 
                 error = False
-                begin_date = data["begin_date"]
-                if begin_date is None:
-                    immediate = True
-                    begin_date = datetime.now()
-                else:
-                    immediate = False
-                    if begin_date <= datetime.now():
-                        error = True
-                        message = _("La date de début doit être dans le futur.")
                 end_date = data["end_date"]
-                if begin_date >= end_date:
+                try:
+                    immediate, begin_date, duration = \
+                        self.recorder.check_dates(data["begin_date"], end_date)
+                except ValueError as e:
+                    error = True
+                    message = str(e)
+                    immediate = data["begin_date"] is None
+                recurrence = data["recurrence"]
+                if recurrence != "none" and immediate:
                     error = True
-                    message = _("La date de début doit être antérieure à la date de fin.")
-                duration = (end_date - begin_date).total_seconds()
-                if duration > int(self.recorder.max_duration):
+                    message = _("La date de début d'une série est obligatoire.")
+                if recurrence == "custom" and len(data["weekdays"]) == 0:
                     error = True
-                    message = _("La durée de l'enregistrement est trop longue.")
+                    message = _("Les jours de la série sont obligatoires.")
                 if error:
                     flash(self.request, ("danger", message))
-                else:
-                    adapter = data["adapter"]
-                    shutdown = data["shutdown"]
-                    channel = self.channels_choices[data["channel"]][1]
-                    program_name = data["program_name"]
-                    await self.recorder.record(
-                        adapter, channel, program_name, immediate,
-                        begin_date, end_date, duration, shutdown
+                elif recurrence != "none":
+                    series = Series(
+                        self.channels_choices[data["channel"]][1],
+                        data["program_name"],
+                        begin_date,
+                        duration,
+                        recurrence,
+                        data["weekdays"],
+                        data["adapter"] if data["adapter"] >= 0 else None,
+                        data["shutdown"]
                     )
+                    self.recorder.add_series(series)
                     message = _(
-                        "L'enregistrement de \"{}\" est programmé "
-                        "pour le {} à {} pendant {} minutes de \"{}\" "
-                        "sur l'enregistreur {}"
+                        "La série \"{}\" est programmée à partir du {} à {} "
+                        "pendant {} minutes de \"{}\""
                     ).format(
-                        program_name, begin_date.strftime("%d/%m/%Y"),
+                        series.program_name, begin_date.strftime("%d/%m/%Y"),
                         begin_date.strftime("%H:%M"), round(duration / 60),
-                        channel, adapter
+                        series.channel
                     )
                     flash(self.request, ("info", message))
                     return web.HTTPFound(self.request.app.router["index"].url_for())
+                else:
+                    adapter = data["adapter"] if data["adapter"] >= 0 else None
+                    shutdown = data["shutdown"]
+                    channel = self.channels_choices[data["channel"]][1]
+                    program_name = data["program_name"]
+                    try:
+                        adapter = await self.recorder.record(
+                            adapter, channel, program_name, immediate,
+                            begin_date, end_date, duration, shutdown
+                        )
+                    except ConflictError as e:
+                        message = self.recorder.describe_conflicts(e)
+                        flash(self.request, ("danger", message))
+                    except ValueError as e:
+                        flash(self.request, ("danger", str(e)))
+                    else:
+                        message = _(
+                            "L'enregistrement de \"{}\" est programmé "
+                            "pour le {} à {} pendant {} minutes de \"{}\" "
+                            "sur l'enregistreur {}"
+                        ).format(
+                            program_name, begin_date.strftime("%d/%m/%Y"),
+                            begin_date.strftime("%H:%M"), round(duration / 60),
+                            channel, adapter
+                        )
+                        flash(self.request, ("info", message))
+                        return web.HTTPFound(self.request.app.router["index"].url_for())
             else:
                 flash(self.request, ("danger", _("Le formulaire contient des erreurs.")))
 
-        form2 = self.AwakeningForm(await self.request.post())
+        form2 = self.AwakeningForm(post)
         if form2.data["submit2"]:
             if form2.validate():
                 data = remove_special_data(form2.data)
@@ -222,7 +349,7 @@ class IndexView(web.View):
             else:
                 flash(self.request, ("danger", _("Le formulaire contient des erreurs.")))
 
-        form3 = self.ToolsForm(await self.request.post())
+        form3 = self.ToolsForm(post)
         if form3.data["submit3"]:
             if form3.validate():
                 data = remove_special_data(form3.data)
@@ -233,6 +360,7 @@ class IndexView(web.View):
 
         return {
             "form": form, "recordings": self.recorder.get_recordings(),
+            "series": self.recorder.get_series(),
             "form2": form2, "awakenings": self.wakeup.get_awakenings(),
             "form3": form3
         }
@@ -246,14 +374,19 @@ class IndexView(web.View):
         form2 = self.AwakeningForm()
         form3 = self.ToolsForm()
 
+        # search in the programme guide
+        q = self.request.query.get("q")
+        events = self.recorder.search_epg(q) if q else []
+
         return {
             "form": form, "recordings": self.recorder.get_recordings(),
+            "series": self.recorder.get_series(),
             "form2": form2, "awakenings": self.wakeup.get_awakenings(),
-            "form3": form3
+            "form3": form3, "q": q, "events": events
         }
 
 
-async def make_app():
+async def make_app(path: Path, record, wakeup):
     # run a server
     lang = config.general.language
     set_language(lang)
@@ -275,19 +408,41 @@ async def make_app():
             aiohttp_session_flash.context_processor,
         )
     )
+    # the static files are fingerprinted and compressed before serving
+    assets = Assets(Path(path, "static"), Path(path, ASSETS_DIRECTORY))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, assets.build)
+
     jinja2_env = aiohttp_jinja2.get_env(app)
     jinja2_env.globals['_'] = _
+    jinja2_env.globals['static'] = assets.url
 
     app.router.add_get(
         "/recording/cancel/{id:\d+}/", cancel_recording, name="cancel_recording"
     )
+    app.router.add_get(
+        "/series/cancel/{id:\d+}/", cancel_series, name="cancel_series"
+    )
     app.router.add_get(
         "/wakeup/cancel/{id:\d+}/", cancel_awakening, name="cancel_awakening"
     )
+    app.router.add_get(
+        "/epg/record/{service_id:\d+}/{event_id:\d+}/", record_event,
+        name="record_event"
+    )
+    app.router.add_get(
+        "/recordings/{filename}", stream_recording, name="stream_recording"
+    )
+    app.router.add_get("/library/", library, name="library")
+    app.router.add_get(
+        "/thumbnails/{filename}", thumbnail, name="thumbnail"
+    )
+    app.router.add_get("/events", events, name="events")
+    app.router.add_get("/metrics", metrics, name="metrics")
+    setup_api_routes(app)
 
     app.router.add_routes(routes)
-    static_dir = Path(path, "static")
-    app.router.add_static("/static", static_dir)
+    app.router.add_get("/static/{path:.+}", assets.handler, name="static")
 
     # cors = aiohttp_cors.setup(app, defaults={
     #     "*": aiohttp_cors.ResourceOptions(
@@ -304,17 +459,20 @@ async def make_app():
     return app
 
 
-async def run(config_filename: str):
-    config.read(config_filename)
-
-    await init()
-
-    app = await make_app()
+async def serve(path: Path, record, wakeup):
+    app = await make_app(path, record, wakeup)
 
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", config.general.port)
     await site.start()
+
+
+async def run(config_filename: str):
+    config.read(config_filename)
+
+    await init()
+    await serve(path, record, wakeup)
     while True:
         await asyncio.sleep(1)
 
@@ -0,0 +1,195 @@
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Optional
+
+from recorder.capture import Capture
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# the event loop lag is measured at this period (s)
+LAG_PERIOD = 1.0
+# the lag reported is the maximum of the last measures
+LAG_HISTORY = 10
+
+
+class Metrics:
+    """Counters of the recorder exposed in the Prometheus text format.
+
+    The counters are updated by the recorder when something happens and the
+    rates are measured by the supervisors of the captures: a scrape only
+    reads them and the size of the files being recorded, so that scrapers do
+    not disturb each other."""
+
+    def __init__(self, adapter_number: int):
+        self.busy_time = [0.0] * adapter_number
+        # monotonic date at which each adapter became busy
+        self.busy_since: list[Optional[float]] = [None] * adapter_number
+        self.started = 0
+        self.failed = 0
+        self.dropped = 0
+        self.start_delay_sum = 0.0
+        # start delays of the running recordings by id
+        self.start_delays: dict[int, float] = {}
+        self.lags = deque([0.0], maxlen=LAG_HISTORY)
+        self.task = None
+
+    def set_busy(self, adapter: int, busy: bool):
+        now = time.monotonic()
+        since = self.busy_since[adapter]
+        if since is not None:
+            self.busy_time[adapter] += now - since
+        self.busy_since[adapter] = now if busy else None
+
+    def recording_started(self, id_: int, delay: float):
+        """delay is from the begin date to the start of the capture (s),
+        negative with a pre-roll"""
+        self.started += 1
+        self.start_delay_sum += delay
+        self.start_delays[id_] = delay
+
+    def recording_ended(self, id_: int, failed: bool):
+        if failed:
+            self.failed += 1
+        self.start_delays.pop(id_, None)
+
+    def recording_dropped(self):
+        self.dropped += 1
+
+    async def measure_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_PERIOD
+            await asyncio.sleep(LAG_PERIOD)
+            self.lags.append(max(loop.time() - expected, 0.0))
+
+    def start(self):
+        self.task = asyncio.create_task(self.measure_lag())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def render(self, recorder) -> str:
+        now = time.monotonic()
+        lines = []
+
+        def metric(name: str, kind: str, help_: str, samples):
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if labels:
+                    labels = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{labels}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+
+        busy_time = [
+            t + (now - since if since is not None else 0)
+            for t, since in zip(self.busy_time, self.busy_since)
+        ]
+        metric(
+            "recorder_adapter_busy", "gauge", "1 if the adapter is in use",
+            [({"adapter": a}, int(b)) for a, b in enumerate(recorder.busy)]
+        )
+        metric(
+            "recorder_adapter_busy_seconds_total", "counter",
+            "Time the adapter has been in use",
+            [({"adapter": a}, f"{t:.3f}") for a, t in enumerate(busy_time)]
+        )
+
+        running = {
+            id_: r for id_, r in recorder.recordings.items()
+            if r["process"] is not None
+        }
+        metric(
+            "recorder_recordings_active", "gauge", "Recordings in progress",
+            [(None, len(running))]
+        )
+        metric(
+            "recorder_recordings_scheduled", "gauge",
+            "Recordings not started yet",
+            [(None, len(recorder.recordings) - len(running))]
+        )
+        metric(
+            "recorder_recordings_started_total", "counter",
+            "Recordings started", [(None, self.started)]
+        )
+        metric(
+            "recorder_recordings_failed_total", "counter",
+            "Recordings whose capture failed", [(None, self.failed)]
+        )
+        metric(
+            "recorder_recordings_dropped_total", "counter",
+            "Recordings missed or whose adapter was busy",
+            [(None, self.dropped)]
+        )
+
+        written = []
+        rates = []
+        buffers = []
+        for id_, recording in running.items():
+            size = recorder.written(recording)
+            supervisor = recording["supervisor"]
+            if supervisor is not None:
+                rate = supervisor.rate
+            else:
+                # a member of a multiplex has no supervisor, the average
+                # since its start is reported
+                elapsed = now - recording["started"]
+                rate = size / elapsed if elapsed > 0 else 0.0
+            labels = {"id": id_, "adapter": recording["adapter"]}
+            written.append((labels, size))
+            rates.append((labels, f"{rate:.0f}"))
+            process = recording["process"]
+            if isinstance(process, Capture) and process.ring_size != 0:
+                buffers.append((labels, process.statistics))
+        metric(
+            "recorder_recording_bytes", "gauge",
+            "Size of the file being recorded", written
+        )
+        metric(
+            "recorder_recording_bytes_per_second", "gauge",
+            "Rate of the capture over its last check",
+            rates
+        )
+        metric(
+            "recorder_recording_buffer_high_water_bytes", "gauge",
+            "Most bytes waiting in the ring buffer of the capture",
+            [(labels, s.high_water) for labels, s in buffers]
+        )
+        metric(
+            "recorder_recording_buffer_stalls_total", "counter",
+            "Times the ring buffer of the capture was full",
+            [(labels, s.stalls) for labels, s in buffers]
+        )
+        metric(
+            "recorder_recording_buffer_dropped_bytes_total", "counter",
+            "Bytes dropped because the ring buffer of the capture was full",
+            [(labels, s.dropped) for labels, s in buffers]
+        )
+
+        metric(
+            "recorder_recording_start_delay_seconds", "gauge",
+            "Start of the capture relative to the begin date",
+            [
+                ({"id": id_}, f"{d:.3f}")
+                for id_, d in self.start_delays.items()
+            ]
+        )
+        metric(
+            "recorder_start_delay_seconds", "summary",
+            "Start of the captures relative to their begin date", []
+        )
+        lines.append(
+            f"recorder_start_delay_seconds_sum {self.start_delay_sum:.3f}"
+        )
+        lines.append(f"recorder_start_delay_seconds_count {self.started}")
+        metric(
+            "recorder_event_loop_lag_seconds", "gauge",
+            "Maximum lag of the event loop over the last measures",
+            [(None, f"{max(self.lags):.6f}")]
+        )
+        return "\n".join(lines) + "\n"
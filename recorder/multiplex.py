@@ -0,0 +1,276 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable
+from typing import Optional
+
+from aiohttp_babel.middlewares import _
+
+import recorder.config as config
+from recorder.channels import Channel
+from recorder.storage import preallocate
+from recorder.storage import release
+
+logger = logging.getLogger(__name__)
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+EIT_PID = 0x0012
+
+# number of packets read from the transport stream at once
+READ_PACKETS = 348
+# a program buffers its packets before writing them to its file
+WRITE_SIZE = 256 * TS_PACKET_SIZE
+
+
+def make_crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for bit in range(8):
+            crc = (crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xffffffff)
+    return table
+
+
+CRC_TABLE = make_crc_table()
+
+
+def crc32_mpeg(data: bytes) -> int:
+    """Returns the CRC of PSI sections, it is 0 for a whole section with its
+    CRC"""
+    crc = 0xffffffff
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def packet_payload(packet: bytes) -> bytes:
+    """Returns the payload of a transport stream packet"""
+    adaptation_field_control = (packet[3] >> 4) & 0x03
+    if adaptation_field_control == 0x01:
+        return packet[4:]
+    if adaptation_field_control == 0x03:
+        return packet[5 + packet[4]:]
+    return b""
+
+
+def packet_section(packet) -> bytes:
+    """Returns the PSI section starting in a packet, the section is supposed
+    to fit in the packet, which is true for PAT and PMT of a single program"""
+    if not packet[1] & 0x40:
+        # no payload unit start indicator
+        return b""
+    payload = packet_payload(packet)
+    if len(payload) == 0:
+        return b""
+    section = payload[1 + payload[0]:]
+    if len(section) < 3:
+        return b""
+    section_length = ((section[1] & 0x0f) << 8) | section[2]
+    return section[:3 + section_length]
+
+
+def parse_pat(section: bytes) -> dict[int, int]:
+    """Returns the PMT PIDs of a PAT section indexed by service id"""
+    programs: dict[int, int] = {}
+    if len(section) < 12 or section[0] != 0x00:
+        return programs
+    # skip the header and the CRC
+    for i in range(8, len(section) - 4, 4):
+        program_number = (section[i] << 8) | section[i + 1]
+        pid = ((section[i + 2] & 0x1f) << 8) | section[i + 3]
+        if program_number != 0:
+            programs[program_number] = pid
+    return programs
+
+
+def parse_pmt(section: bytes) -> set[int]:
+    """Returns the PIDs of the elementary streams of a PMT section"""
+    pids: set[int] = set()
+    if len(section) < 16 or section[0] != 0x02:
+        return pids
+    pcr_pid = ((section[8] & 0x1f) << 8) | section[9]
+    pids.add(pcr_pid)
+    program_info_length = ((section[10] & 0x0f) << 8) | section[11]
+    i = 12 + program_info_length
+    while i + 5 <= len(section) - 4:
+        pids.add(((section[i + 1] & 0x1f) << 8) | section[i + 2])
+        es_info_length = ((section[i + 3] & 0x0f) << 8) | section[i + 4]
+        i += 5 + es_info_length
+    return pids
+
+
+class Program:
+    """Packets of a channel extracted from a multiplex into a file"""
+
+    def __init__(self, channel: Channel, filename: Path, size: int = 0):
+        self.channel = channel
+        self.filename = filename
+        self.pids = {PAT_PID, channel.video_pid, channel.audio_pid}
+        self.pmt_pid = None
+        self.buffer = bytearray()
+        self.file = open(filename, "wb")
+        # the expected size of the file is preallocated if not 0
+        self.size = size
+        if size != 0:
+            preallocate(self.file.fileno(), size)
+
+    def feed(self, packet):
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        if pid == PAT_PID and self.pmt_pid is None:
+            pmt_pid = parse_pat(packet_section(packet)).get(
+                self.channel.service_id
+            )
+            if pmt_pid is not None:
+                self.pmt_pid = pmt_pid
+                self.pids.add(pmt_pid)
+        elif pid == self.pmt_pid:
+            self.pids.update(parse_pmt(packet_section(packet)))
+
+        self.buffer += packet
+        if len(self.buffer) >= WRITE_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.size != 0:
+            self.file.flush()
+            release(self.file.fileno())
+        self.file.close()
+
+
+class Member:
+    """A recording of a multiplex. It behaves like the process of a single
+    recording so that it can be cancelled the same way."""
+
+    def __init__(self, multiplex: "Multiplex", id_: int, pid: int):
+        self.multiplex = multiplex
+        self.id = id_
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self.finished = asyncio.Event()
+
+    def terminate(self):
+        self.multiplex.remove(self.id)
+
+    async def wait(self):
+        await self.finished.wait()
+        return self.returncode
+
+
+class Multiplex:
+    """An adapter tuned once to a frequency. The whole transport stream is
+    read and every recorded channel is written to its own file by PID."""
+
+    def __init__(
+        self, adapter: int, channels_conf: str, channel: Channel,
+        eit: Optional[Callable[[bytes], None]] = None
+    ):
+        self.adapter = adapter
+        self.channels_conf = channels_conf
+        self.frequency = channel.frequency
+        self.channel = channel
+        self.programs: dict[int, Program] = {}
+        self.members: dict[int, Member] = {}
+        # called with the packets of the EIT, for the programme guide
+        self.eit = eit
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.task: Optional[asyncio.Task] = None
+        # set once start() is over, even if it failed
+        self.started = asyncio.Event()
+        # no recording can join once the last one has left
+        self.closing = False
+        # set by the recorder once the adapter is free
+        self.closed = asyncio.Event()
+
+    async def start(self):
+        try:
+            await self.start_process()
+        finally:
+            self.started.set()
+
+    async def start_process(self):
+        command = (
+            config.general.zap_command,
+            "-a", f"{self.adapter}",
+            "-I", "zap",
+            "-c", f"{self.channels_conf}",
+            "-P",
+            "-o", "-",
+            f"{self.channel.name}"
+        )
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE
+        )
+        logger.debug(
+            f"multiplex {self.frequency} on adapter {self.adapter}, "
+            f"process id: {process.pid}"
+        )
+        self.process = process
+        self.task = asyncio.create_task(self.demux(process))
+
+    def add(
+        self, id_: int, channel: Channel, filename: Path, size: int = 0
+    ) -> Optional[Member]:
+        """Returns None if the multiplex is not started"""
+        if self.process is None:
+            return None
+        logger.info(
+            _("Ajout de \"{}\" au multiplex {} (id={})").format(
+                channel.name, self.frequency, id_
+            )
+        )
+        self.programs[id_] = Program(channel, filename, size)
+        member = Member(self, id_, self.process.pid)
+        self.members[id_] = member
+        return member
+
+    def remove(self, id_: int, returncode: int = 0):
+        if id_ not in self.programs:
+            return
+        self.programs.pop(id_).close()
+        member = self.members.pop(id_)
+        member.returncode = returncode
+        member.finished.set()
+
+        if len(self.programs) == 0:
+            self.closing = True
+            if self.process is not None and self.process.returncode is None:
+                self.process.terminate()
+
+    async def demux(self, process: asyncio.subprocess.Process):
+        stdout = process.stdout
+        remainder = b""
+        while stdout is not None:
+            data = await stdout.read(READ_PACKETS * TS_PACKET_SIZE)
+            if len(data) == 0:
+                break
+            data = remainder + data
+            end = len(data) - len(data) % TS_PACKET_SIZE
+            remainder = data[end:]
+
+            for i in range(0, end, TS_PACKET_SIZE):
+                packet = data[i:i + TS_PACKET_SIZE]
+                if packet[0] != TS_SYNC_BYTE:
+                    continue
+                pid = ((packet[1] & 0x1f) << 8) | packet[2]
+                if pid == EIT_PID and self.eit is not None:
+                    self.eit(packet)
+                for program in self.programs.values():
+                    if pid in program.pids:
+                        program.feed(packet)
+
+        await process.wait()
+        logger.debug(
+            f"multiplex {self.frequency} on adapter {self.adapter}, "
+            f"process return code: {process.returncode}"
+        )
+        # the recordings still running are lost
+        for id_ in list(self.programs.keys()):
+            self.remove(id_, process.returncode or 1)
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+from pathlib import Path
+import re
+import sys
+from typing import Optional
+
+from aiohttp_babel.middlewares import _
+
+from recorder.store import Store
+
+logger = logging.getLogger(__name__)
+
+STEPS = ("analyze", "metadata", "thumbnail", "remux", "commercials")
+# the commands run with the lowest CPU priority and the idle I/O class
+LOW_PRIORITY = ("nice", "-n", "19", "ionice", "-c", "3")
+REMUX_FORMATS = {"mkv": "matroska", "mp4": "mp4"}
+THUMBNAIL_WIDTH = 320
+# an advertising break is black and silent at the same time (s)
+BREAK_MIN_DURATION = 0.2
+BLACK_INTERVAL = re.compile(r"black_start:([\d.]+) black_end:([\d.]+)")
+SILENCE_START = re.compile(r"silence_start: ([\d.]+)")
+SILENCE_END = re.compile(r"silence_end: ([\d.]+)")
+
+
+class StepError(Exception):
+    """Raised when the command of a step fails"""
+
+
+def find_breaks(output: str) -> list[tuple[float, float]]:
+    """Returns the intervals both black and silent from the output of the
+    blackdetect and silencedetect filters of ffmpeg"""
+    blacks = [
+        (float(m.group(1)), float(m.group(2)))
+        for m in BLACK_INTERVAL.finditer(output)
+    ]
+    silences = list(zip(
+        (float(m.group(1)) for m in SILENCE_START.finditer(output)),
+        (float(m.group(1)) for m in SILENCE_END.finditer(output))
+    ))
+    breaks = []
+    for black_start, black_end in blacks:
+        for silence_start, silence_end in silences:
+            start = max(black_start, silence_start)
+            end = min(black_end, silence_end)
+            if end - start >= BREAK_MIN_DURATION:
+                breaks.append((start, end))
+    return breaks
+
+
+class PostProcessor:
+    """Queue of the processing of the finished recordings.
+
+    A job runs the steps of a recording one after the other. The commands of
+    the steps are run with the lowest CPU and I/O priorities by a bounded
+    number of workers, so that they never starve the captures. The steps
+    left are saved in the store after each step, the jobs are resumed at
+    startup."""
+
+    def __init__(
+        self, store: Store, steps: list[str], workers: int,
+        remux_format: str
+    ):
+        self.store = store
+        for step in steps:
+            if step not in STEPS:
+                logger.warning(f"unknown post-processing step: {step}")
+        # the steps are run in the order of STEPS
+        self.steps = [step for step in STEPS if step in steps]
+        self.workers = workers
+        if remux_format not in REMUX_FORMATS:
+            raise ValueError(f"unknown remux format: {remux_format}")
+        self.remux_format = remux_format
+        self.queue: asyncio.Queue[tuple[int, Path, list[str]]] = \
+            asyncio.Queue()
+        self.tasks: list[asyncio.Task] = []
+        # ids of the jobs queued or running
+        self.pending: set[int] = set()
+
+    def add(self, filename: Path):
+        """Adds the job of a finished recording"""
+        if len(self.steps) == 0:
+            return
+        id_ = self.store.add_job(str(filename), self.steps)
+        self.pending.add(id_)
+        self.queue.put_nowait((id_, filename, self.steps))
+
+    async def join(self):
+        """Waits until every job is done"""
+        await self.queue.join()
+
+    async def work(self):
+        while True:
+            id_, filename, steps = await self.queue.get()
+            try:
+                await self.run_job(id_, filename, steps)
+            except Exception:
+                # the worker goes on with the next jobs
+                logger.exception(f"post-processing of {filename.name}")
+            finally:
+                self.pending.discard(id_)
+                self.queue.task_done()
+
+    async def run_job(self, id_: int, filename: Path, steps: list[str]):
+        while len(steps) != 0:
+            if not filename.exists():
+                logger.warning(f"{filename.name} does not exist anymore")
+                break
+            step = steps[0]
+            logger.debug(f"{step} of {filename.name}")
+            try:
+                message = await getattr(self, step)(filename)
+            except (StepError, OSError, ValueError) as e:
+                logger.error(
+                    _("Échec de l'étape {} de {} : {}").format(
+                        step, filename.name, e
+                    )
+                )
+            else:
+                logger.info(f"{filename.name}, {step}: {message}")
+            steps = steps[1:]
+            self.store.update_job(id_, steps)
+        self.store.remove_job(id_)
+
+    async def run(self, *command: str) -> tuple[bytes, bytes]:
+        """Runs a command with the lowest priorities. Returns its standard
+        output and error. Raises StepError if it fails."""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *LOW_PRIORITY, *command, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            raise StepError(e)
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            lines = stderr.decode(errors="replace").strip().splitlines()
+            raise StepError(lines[-1] if lines else process.returncode)
+        return stdout, stderr
+
+    async def analyze(self, filename: Path) -> str:
+        """Checks the integrity of the file, the quality report is saved next
+        to it"""
+        stdout, _stderr = await self.run(
+            sys.executable, "-m", "recorder.analyzer", "-j", str(filename)
+        )
+        report = json.loads(stdout)
+        filename.with_suffix(".quality.json").write_bytes(stdout)
+        return (
+            f"{report['packets']} packets, {report['sync_errors']} sync "
+            f"errors, {report['transport_errors']} transport errors, "
+            f"{report['cc_errors']} continuity errors"
+        )
+
+    async def metadata(self, filename: Path) -> str:
+        """Saves the duration and the streams of the file next to it"""
+        stdout, _stderr = await self.run(
+            "ffprobe", "-v", "error", "-print_format", "json",
+            "-show_format", "-show_streams", str(filename)
+        )
+        probe = json.loads(stdout)
+        duration = float(probe["format"].get("duration", 0))
+        streams = [
+            {
+                key: stream[key]
+                for key in (
+                    "index", "codec_type", "codec_name", "width", "height",
+                    "channels", "tags"
+                )
+                if key in stream
+            }
+            for stream in probe.get("streams", [])
+        ]
+        info = {
+            "duration": duration,
+            "size": int(probe["format"].get("size", 0)),
+            "bit_rate": int(probe["format"].get("bit_rate", 0)),
+            "streams": streams
+        }
+        with open(filename.with_suffix(".info.json"), "w") as f:
+            json.dump(info, f)
+        return f"{duration:.0f} s, {len(streams)} streams"
+
+    def duration(self, filename: Path) -> Optional[float]:
+        try:
+            with open(filename.with_suffix(".info.json")) as f:
+                return float(json.load(f)["duration"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    async def thumbnail(self, filename: Path) -> str:
+        """Saves a picture of the beginning of the program"""
+        # the pre-roll and the end of the previous program are skipped
+        duration = self.duration(filename)
+        offset = 0 if duration is None else duration / 10
+        thumbnail = filename.with_suffix(".jpg")
+        await self.run(
+            "ffmpeg", "-y", "-v", "error", "-ss", f"{offset:.0f}",
+            "-i", str(filename), "-vf", f"thumbnail,scale={THUMBNAIL_WIDTH}:-1",
+            "-frames:v", "1", str(thumbnail)
+        )
+        return thumbnail.name
+
+    async def remux(self, filename: Path) -> str:
+        """Copies the video and audio streams into another container"""
+        target = filename.with_suffix(f".{self.remux_format}")
+        partial = filename.with_suffix(f".part.{self.remux_format}")
+        try:
+            await self.run(
+                "ffmpeg", "-y", "-v", "error", "-i", str(filename),
+                "-map", "0:v?", "-map", "0:a?", "-c", "copy",
+                "-f", REMUX_FORMATS[self.remux_format], str(partial)
+            )
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        partial.rename(target)
+        return target.name
+
+    async def commercials(self, filename: Path) -> str:
+        """Saves the probable advertising breaks of the file next to it"""
+        _stdout, stderr = await self.run(
+            "ffmpeg", "-nostats", "-i", str(filename),
+            "-vf", "blackdetect=d=0.1", "-af", "silencedetect=d=0.1",
+            "-f", "null", "-"
+        )
+        breaks = find_breaks(stderr.decode(errors="replace"))
+        with open(filename.with_suffix(".breaks.json"), "w") as f:
+            json.dump(breaks, f)
+        return f"{len(breaks)} breaks"
+
+    def start(self):
+        """Resumes the jobs of the store and starts the workers"""
+        for id_, filename, steps in self.store.get_jobs():
+            if id_ not in self.pending:
+                self.pending.add(id_)
+                self.queue.put_nowait((id_, Path(filename), steps))
+        self.tasks = [
+            asyncio.create_task(self.work()) for i in range(self.workers)
+        ]
+
+    async def stop(self):
+        """Stops the workers, the jobs not done are kept in the store"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,95 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import math
+import os
+from pathlib import Path
+import time
+
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.store import Store
+
+logger = logging.getLogger(__name__)
+
+# latencies kept by adapter and frequency
+HISTORY_SIZE = 20
+# the adaptive pre-roll is the slowest recent latency plus this margin (s)
+MARGIN = 2.0
+# the recording file is checked for data at this period (s)
+POLL_PERIOD = 0.1
+
+FALLOC_FL_COLLAPSE_RANGE = 0x08
+
+
+class Preroll:
+    """Pre-roll of the recordings: the adapter is tuned before the begin date
+    so that the data flows when the program begins.
+
+    The tune-to-lock latency, from the start of the capture to the first data
+    in the file, is measured for every recording and kept by adapter and
+    frequency. With adaptive pre-roll, the pre-roll of an adapter and a
+    frequency is derived from its recent latencies, up to the configured
+    pre-roll."""
+
+    def __init__(self, store: Store, preroll: int, adaptive: bool):
+        self.store = store
+        self.preroll = preroll
+        self.adaptive = adaptive
+
+    def get(self, adapter: int, frequency: int) -> float:
+        """Returns the pre-roll of an adapter tuned to a frequency (s)"""
+        if not self.adaptive:
+            return self.preroll
+        latencies = self.store.get_latencies(adapter, frequency, HISTORY_SIZE)
+        if len(latencies) == 0:
+            return self.preroll
+        return min(max(latencies) + MARGIN, self.preroll)
+
+    async def measure(
+        self, adapter: int, frequency: int, filename: Path, timeout: float
+    ):
+        """Measures the latency of a capture which has just been started"""
+        start = time.monotonic()
+        while time.monotonic() - start < timeout:
+            try:
+                if filename.stat().st_size > 0:
+                    break
+            except FileNotFoundError:
+                pass
+            await asyncio.sleep(POLL_PERIOD)
+        else:
+            return
+
+        latency = time.monotonic() - start
+        logger.debug(
+            f"latency of adapter {adapter} on {frequency}: {latency:.1f} s"
+        )
+        self.store.add_latency(adapter, frequency, latency)
+
+
+def trim_head(filename: Path, size: int) -> int:
+    """Removes about size bytes at the beginning of a file without copying
+    it. The size removed is a multiple of the block size of the file system
+    and of the packet size. Returns the size removed, 0 if the file system
+    does not support it."""
+    block_size = os.stat(filename).st_blksize
+    size -= size % math.lcm(block_size, TS_PACKET_SIZE)
+    if size <= 0:
+        return 0
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        result = libc.fallocate(
+            fd, FALLOC_FL_COLLAPSE_RANGE, ctypes.c_longlong(0),
+            ctypes.c_longlong(size)
+        )
+    finally:
+        os.close(fd)
+    if result != 0:
+        logger.debug(
+            f"cannot trim {filename.name}: {os.strerror(ctypes.get_errno())}"
+        )
+        return 0
+    return size
@@ -1,92 +1,743 @@
 import asyncio
 from datetime import datetime
+from datetime import timedelta
+from functools import partial
 import logging
 from pathlib import Path
 import pickle
+import time
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+from typing import Union
 
 from aiohttp_babel.middlewares import _
 
 import recorder.config as config
+from recorder.allocation import AdapterAllocator
+from recorder.allocation import ConflictError
+from recorder.allocation import MERGE_GAP
+from recorder.block import Block
+from recorder.block import Segment
+from recorder.capture import Capture
+from recorder.capture import DVR_DEVICE
+from recorder.channels import Channel
+from recorder.channels import ChannelTable
+from recorder.detach import CAPTURES_FILENAME
+from recorder.detach import CaptureStates
+from recorder.detach import DetachedCapture
+from recorder.epg import Epg
+from recorder.library import Library
+from recorder.live import LiveStatus
+from recorder.metrics import Metrics
+from recorder.multiplex import Member
+from recorder.multiplex import Multiplex
+from recorder.multiplex import READ_PACKETS
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.postprocess import PostProcessor
+from recorder.preroll import Preroll
+from recorder.preroll import trim_head
+from recorder.series import EXPANSION_WINDOW
+from recorder.series import Series
+from recorder.storage import Storage
+from recorder.store import Store
+from recorder.supervision import file_size
+from recorder.supervision import Supervisor
+from recorder.timer import Timer
 from recorder.utils import set_locale
+from recorder.wakeup import Awakenings
 
 logger = logging.getLogger(__name__)
 
 RECORDINGS_BIN_FILENAME = "data/recordings.bin"
+STATUS_FILENAME = "data/capture-{}-{}.log"
+
+# a capture started by the recorder
+CaptureProcess = Union[asyncio.subprocess.Process, Capture, DetachedCapture]
+# the recordings of a multiplex and of a block behave like a capture
+RecordingProcess = Union[CaptureProcess, Member, Segment]
 
 
 class Recorder:
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, store: Store, wakeup: Awakenings):
         self.max_duration = config.general.max_duration
         self.dvb_adapter_number = config.general.dvb_adapter_number
         self.channels_conf = config.general.channels_conf
+        self.channels = ChannelTable(self.channels_conf)
         self.recording_directory = config.general.recording_directory
         self.simulate = config.general.simulate
+        self.multiplex = config.general.multiplex
+        self.native_capture = config.general.native_capture
+        # size of the ring buffer of the captures (bytes), none if 0
+        self.ring_buffer = config.general.ring_buffer * 1024 * 1024
+        self.analyze = config.general.analyze
+        self.zap_command = config.general.zap_command
+        self.lock_timeout = config.general.lock_timeout
+        self.stall_timeout = config.general.stall_timeout
+        # dvr device of the native capture and tuning of the adapter, the
+        # benchmark replaces the device with a synthetic stream
+        self.dvr_device = DVR_DEVICE
+        self.tune = True
         self.busy = [False] * self.dvb_adapter_number
+        self.metrics = Metrics(self.dvb_adapter_number)
+        self.live = LiveStatus(self)
+        self.multiplexes: dict[int, Multiplex] = {}
+        # the multiplex mode already shares the adapters
+        self.merge_recordings = config.general.merge_recordings and \
+            not self.multiplex and not self.simulate
+        self.blocks: dict[int, Block] = {}
+        self.allocator = AdapterAllocator(
+            self.dvb_adapter_number, self.max_duration, self.multiplex,
+            self.merge_recordings
+        )
         self.recordings: dict[int, dict] = {}
+        self.series: dict[int, Series] = {}
         self.recordings_filename = Path(path, RECORDINGS_BIN_FILENAME)
+        self.path = path
+        # only the captures of dvbv5-zap into a file outlive the recorder
+        self.reattach = config.general.reattach and not self.simulate and \
+            not self.multiplex and not self.native_capture and \
+            self.ring_buffer == 0
+        self.captures = CaptureStates(Path(path, CAPTURES_FILENAME))
+        self.store = store
+        self.timer = Timer()
+        self.preroll = Preroll(
+            store, config.general.preroll, config.general.adaptive_preroll
+        )
+        self.keep_preroll = config.general.keep_preroll
+        self.storage = Storage(
+            self.recording_directory, store, config.general.min_free_space,
+            config.general.storage_admission, config.general.retention
+        )
+        self.preallocate = config.general.preallocate
+        self.library = Library(self.recording_directory, store)
+        # the integrity check is the first step of the post-processing
+        steps = list(config.general.post_processing)
+        if self.analyze:
+            steps.append("analyze")
+        self.postprocessor = PostProcessor(
+            store, steps, config.general.post_processing_workers,
+            config.general.remux_format
+        )
+        self.wakeup = wakeup
+        self.auto_power_off = config.general.auto_power_off
+        self.epg = config.general.epg
+        self.epg_period = config.general.epg_period
+        self.epg_duration = config.general.epg_duration
+        self.epg_margin = config.general.epg_margin
+        # programme guides being read, by adapter
+        self.guides: dict[int, Epg] = {}
+        # scans of the programme guide by the idle adapters, by adapter
+        self.scans: dict[int, asyncio.Task] = {}
+        self.scan_task = None
+        # set at shutdown, the recordings cancelled are kept in the store
+        self.closing = False
 
         self.id = 1
+        self.series_id = 1
 
     def get_recordings(self):
         """Returns recordings sorted by begin date"""
         return sorted(self.recordings.items(), key=lambda r: r[1]["begin_date"])
 
+    def get_series(self):
+        """Returns series sorted by program name"""
+        return sorted(self.series.items(), key=lambda s: s[1].program_name)
+
+    def forget(self, id_: int):
+        """Removes a recording which is over, cancelled or dropped"""
+        self.allocator.remove(id_)
+        del self.recordings[id_]
+        self.live.notify()
+        if not self.closing:
+            self.store.remove_recording(id_)
+            self.wakeup.remove_recording(id_)
+
+    def is_recording(self, filename: str) -> bool:
+        """Returns True if the file is being recorded"""
+        return any(
+            r["filename"] == filename and r["process"] is not None
+            for r in self.recordings.values()
+        )
+
     def get_channels(self):
-        with open(self.channels_conf) as fichier:
-            lines = fichier.readlines()
-        channels = [line.split(':', 1)[0] for line in lines]
-        return channels
+        return self.channels.names()
 
-    async def record_program(
-        self, delay: int, adapter: int, channel: str, filename: str,
-        duration: int, shutdown, id_: int
-    ):
-        try:
-            await asyncio.sleep(delay)
-        except asyncio.CancelledError:
-            del self.recordings[id_]
+    def running_recordings(self) -> tuple[list[dict], set[str]]:
+        """Returns the recordings started and the files that the retention
+        must not remove"""
+        running = [r for r in self.recordings.values() if r["task"] is not None]
+        protected = {r["filename"] for r in self.recordings.values()}
+        protected.update(Path(job[1]).name for job in self.store.get_jobs())
+        return running, protected
+
+    def set_busy(self, adapter: int, busy: bool):
+        self.busy[adapter] = busy
+        self.metrics.set_busy(adapter, busy)
+        self.live.notify()
+
+    async def join_multiplex(
+        self, adapter: int, channel: str, filename: Path, id_: int, size: int
+    ) -> Optional[Member]:
+        """Adds a recording to the multiplex the adapter is tuned to. The
+        adapter is tuned if it is free, or once the multiplex which is
+        stopping has freed it. Returns None if the adapter is tuned to another
+        frequency."""
+        chan = self.channels.get(channel)
+        multiplex = self.multiplexes.get(adapter)
+        while multiplex is not None and (
+            multiplex.closing or not multiplex.started.is_set()
+        ):
+            if multiplex.closing:
+                await multiplex.closed.wait()
+            else:
+                # being started for another recording
+                await multiplex.started.wait()
+            multiplex = self.multiplexes.get(adapter)
+        if multiplex is None:
+            if self.busy[adapter]:
+                return None
+            self.set_busy(adapter, True)
+            eit = None
+            if self.epg:
+                # the programme guide is read from the recorded multiplex
+                self.guides[adapter] = Epg(self.store)
+                eit = self.guides[adapter].feed_packet
+            multiplex = Multiplex(adapter, self.channels_conf, chan, eit)
+            # the recordings starting meanwhile wait for it
+            self.multiplexes[adapter] = multiplex
+            try:
+                await multiplex.start()
+            except BaseException:
+                multiplex.closing = True
+                await self.leave_multiplex(multiplex)
+                raise
+        elif multiplex.frequency != chan.frequency:
+            return None
+        return multiplex.add(id_, chan, filename, size)
+
+    async def leave_multiplex(self, multiplex: Multiplex):
+        """Frees the adapter when its multiplex has no more recordings"""
+        adapter = multiplex.adapter
+        if not multiplex.closing or \
+                self.multiplexes.get(adapter) is not multiplex:
+            # still recording, or freed by another recording
             return
+        del self.multiplexes[adapter]
+        if multiplex.task is not None:
+            await multiplex.task
+        guide = self.guides.pop(adapter, None)
+        if guide is not None:
+            guide.flush()
+        self.set_busy(adapter, False)
+        multiplex.closed.set()
 
-        logger.info(_("Enregistrement de {} (id={})").format(filename, id_))
+    def chain_end(
+        self, adapter: int, channel: str, end_date: datetime
+    ) -> datetime:
+        """Returns the end of the recordings not started of a channel on an
+        adapter which follow each other from end_date, with less than
+        MERGE_GAP seconds between them"""
+        gap = timedelta(seconds=MERGE_GAP + self.preroll.preroll)
+        for id_, recording in self.get_recordings():
+            if recording["task"] is None and recording["adapter"] == adapter \
+                    and recording["channel"] == channel and \
+                    recording["begin_date"] - gap <= end_date:
+                end_date = max(end_date, recording["end_date"])
+        return end_date
+
+    async def start_block(
+        self, adapter: int, channel: str, filename: Path, end_date: datetime,
+        size: int
+    ) -> Block:
+        """Starts the capture of a channel until end_date for the recordings
+        which follow each other"""
+        filename = filename.with_name(filename.name + ".block")
+        duration = (end_date - datetime.now()).total_seconds()
+        logger.info(
+            _("Enregistrement en continu de \"{}\" sur l'enregistreur {} "
+              "jusqu'à {}").format(
+                channel, adapter, end_date.strftime("%d/%m/%Y %H:%M")
+            )
+        )
+        process = await self.start_capture(
+            adapter, channel, filename, duration, size
+        )
+        supervisor = Supervisor(
+            process.stderr, self.received(process, filename),
+            self.lock_timeout, self.stall_timeout
+        )
+        block = Block(adapter, channel, filename, end_date, process, supervisor)
+        self.blocks[adapter] = block
+        asyncio.create_task(self.run_block(block))
+        return block
+
+    async def run_block(self, block: Block):
+        """Frees the adapter at the end of the capture of a block, the
+        recordings of a failed block are not moved to another adapter"""
+        reason = await block.run()
+        if reason is not None:
+            logger.error(
+                _("Échec de la capture sur l'enregistreur {} : {}").format(
+                    block.adapter, reason
+                )
+            )
+        del self.blocks[block.adapter]
+        self.set_busy(block.adapter, False)
+
+    def release_block(self, adapter: int):
+        """Stops the capture of a block when no recording is left to make
+        with it"""
+        block = self.blocks.get(adapter)
+        if block is not None and len(block.members) == 0 and \
+                self.chain_end(adapter, block.channel, datetime.now()) <= \
+                datetime.now():
+            logger.debug(f"block of {block.channel} on adapter {adapter} stopped")
+            block.terminate()
+
+    def reassign(self, id_: int, adapter: int):
+        """Moves a recording to another adapter"""
+        self.allocator.move(id_, adapter)
+        self.recordings[id_]["adapter"] = adapter
+        self.store.move_recording(id_, adapter)
+        self.live.notify()
+
+    def describe_conflicts(self, error: ConflictError) -> str:
+        """Returns the conflict report of a recording that cannot be
+        scheduled"""
+        conflicts = []
+        for adapter, id_ in error.conflicts:
+            recording = self.recordings[id_]
+            conflicts.append(
+                _("\"{}\" sur l'enregistreur {} de {} à {} (id={})").format(
+                    recording["program_name"], adapter,
+                    recording["begin_date"].strftime("%d/%m/%Y %H:%M"),
+                    recording["end_date"].strftime("%d/%m/%Y %H:%M"), id_
+                )
+            )
+        message: str = _("Aucun enregistreur libre, conflit avec : {}").format(
+            ", ".join(conflicts)
+        )
+        return message
 
-        if self.busy[adapter]:
-            logger.warning(_("Enregistreur occupé (id={})").format(id_))
+    def start_recording(self, id_: int):
+        """Starts a recording, called by the timer at its begin date"""
+        recording = self.recordings[id_]
+        now = datetime.now()
+        if recording["end_date"] <= now:
+            logger.error(_("Enregistrement manqué (id={})").format(id_))
+            self.metrics.recording_dropped()
+            self.forget(id_)
             return
 
-        self.busy[adapter] = True
+        frequency = self.channels.get(recording["channel"]).frequency
+        preroll = self.preroll.get(recording["adapter"], frequency)
+        start_date = recording["begin_date"] - timedelta(seconds=preroll)
+        if start_date > now + timedelta(seconds=1):
+            # the latencies measured allow a shorter pre-roll
+            self.timer.add(id_, start_date, partial(self.start_recording, id_))
+            return
 
-        logger.debug(_("Début de l'enregistrement (id={})").format(id_))
-        if self.simulate:
-            command = ("/usr/bin/sleep", str(int(duration)))
+        # the timer may fire late, after a suspend for instance
+        duration = (recording["end_date"] - now).total_seconds()
+        recording["task"] = asyncio.create_task(
+            self.record_program(
+                recording["channel"],
+                recording["filename"],
+                duration,
+                recording["shutdown"],
+                id_
+            )
+        )
+        self.live.notify()
+
+    async def watch_preroll(
+        self, id_: int, adapter: int, channel: str, filename: Path,
+        tuned: bool
+    ) -> int:
+        """Measures the latency of the adapter if it has just been tuned.
+        Returns the size of the file at the begin date."""
+        recording = self.recordings[id_]
+        if tuned:
+            await self.preroll.measure(
+                adapter, self.channels.get(channel).frequency, filename,
+                recording["duration"]
+            )
+
+        delay = (recording["begin_date"] - datetime.now()).total_seconds()
+        if delay <= 0:
+            return 0
+        await asyncio.sleep(delay)
+        try:
+            return filename.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    async def record_program(
+        self, channel: str, filename: str, duration: float, shutdown, id_: int,
+        adopted: Optional[DetachedCapture] = None,
+        files: Optional[list[Path]] = None
+    ):
+        """Makes a recording. With adopted, the capture of files started by
+        the previous run of the recorder is taken over."""
+        logger.info(_("Enregistrement de {} (id={})").format(filename, id_))
+
+        # the adapter may have changed since the recording was scheduled
+        adapter = self.recordings[id_]["adapter"]
+        program_name = self.recordings[id_]["program_name"]
+        # the recordings have priority over the programme guide
+        await self.stop_scan(adapter)
+
+        record_filename = Path(self.recording_directory, filename)
+        size = 0
+        if not self.simulate:
+            # the oldest recordings are removed if the disk is nearly full
+            await self.storage.make_room_async(*self.running_recordings())
+            if self.preallocate:
+                size = self.storage.estimate(channel, duration)
+        multiplex = self.multiplex and not self.simulate
+        # the block of the adapter when the recording is merged with others
+        block = None
+        process: RecordingProcess
+        if files is None:
+            files = [record_filename]
+        if adopted is not None:
+            process = adopted
+            self.set_busy(adapter, True)
+            tuned = False
+            logger.info(
+                _("Reprise de la capture de {} (id={})").format(
+                    files[-1].name, id_
+                )
+            )
+        elif multiplex:
+            # several channels of the same frequency share the adapter
+            member = await self.join_multiplex(
+                adapter, channel, record_filename, id_, size
+            )
+            if member is None:
+                logger.error(_("Enregistreur occupé (id={})").format(id_))
+                self.metrics.recording_dropped()
+                self.forget(id_)
+                return
+            process = member
+            timer = asyncio.get_running_loop().call_later(
+                duration, member.terminate
+            )
+            tuned = len(member.multiplex.members) == 1
+            logger.debug(_("Début de l'enregistrement (id={})").format(id_))
+        else:
+            recording = self.recordings[id_]
+            block = self.blocks.get(adapter)
+            if block is not None and (block.channel != channel or
+                                      block.end_date < recording["end_date"]):
+                block = None
+            if block is None and self.busy[adapter]:
+                # the adapter may be kept by a block which ends too early
+                adapter = self.idle_adapter(recording["end_date"])
+                if adapter is None:
+                    logger.error(_("Enregistreur occupé (id={})").format(id_))
+                    self.metrics.recording_dropped()
+                    self.forget(id_)
+                    return
+                self.reassign(id_, adapter)
+
+            # a block is already tuned to the channel
+            tuned = block is None
+            if block is None:
+                self.set_busy(adapter, True)
+                end_date = recording["end_date"]
+                if self.merge_recordings:
+                    end_date = self.chain_end(adapter, channel, end_date)
+                if end_date > recording["end_date"]:
+                    block = await self.start_block(
+                        adapter, channel, record_filename, end_date, size
+                    )
+
+            logger.debug(_("Début de l'enregistrement (id={})").format(id_))
+            if block is None:
+                process = await self.start_capture(
+                    adapter, channel, record_filename, duration, size,
+                    self.status_filename(id_, files)
+                )
+            else:
+                process = block.add(
+                    id_, record_filename,
+                    0 if self.keep_preroll else
+                    (recording["begin_date"] - datetime.now()).total_seconds(),
+                    duration
+                )
+                recording["supervisor"] = block.supervisor
+
+        logger.debug(f"process id: {process.pid}")
+        if isinstance(process, DetachedCapture):
+            self.captures.add(id_, process.state(files))
+        self.recordings[id_]["process"] = process
+        self.recordings[id_]["started"] = time.monotonic()
+        self.live.notify()
+        self.metrics.recording_started(
+            id_,
+            (datetime.now() - self.recordings[id_]["begin_date"]).total_seconds()
+        )
+        if not self.simulate:
+            # the pre-roll of a block is left out of the range of the
+            # recording
+            watch = asyncio.create_task(self.watch_preroll(
+                id_, adapter, channel,
+                record_filename if block is None else block.filename, tuned
+            ))
+            if isinstance(process, DetachedCapture):
+                watch.add_done_callback(partial(self.save_preroll, id_))
+        started = time.monotonic()
+        if self.simulate or isinstance(process, (Member, Segment)):
+            await process.wait()
         else:
-            record_filename = Path(self.recording_directory, filename)
+            adapter, process = await self.supervise(
+                id_, adapter, channel, files, process
+            )
+        elapsed = time.monotonic() - started
+
+        preroll_size = 0
+        if not self.simulate:
+            if watch.done() and watch.exception() is None and block is None:
+                preroll_size = watch.result()
+            else:
+                watch.cancel()
+        if adopted is not None and preroll_size == 0:
+            # measured by the previous run of the recorder
+            preroll_size = self.captures.states.get(id_, {}).get("preroll", 0)
+
+        logger.debug(f"process return code: {process.returncode}")
+        if isinstance(process, Capture) and process.statistics.dropped != 0:
+            logger.error(
+                _("{} octets perdus, le disque est trop lent "
+                  "(id={})").format(process.statistics.dropped, id_)
+            )
+        logger.debug(_("Fin de l'enregistrement (id={})").format(id_))
+
+        if isinstance(process, Member):
+            timer.cancel()
+            await self.leave_multiplex(process.multiplex)
+        elif block is not None:
+            await block.extract(id_)
+        else:
+            self.set_busy(adapter, False)
+        self.captures.remove(id_)
+        self.forget(id_)
+        if block is not None:
+            self.release_block(adapter)
+        failed = not self.simulate and \
+            (process.returncode != 0 or len(files) != 1)
+        self.metrics.recording_ended(id_, failed)
+
+        if not self.simulate:
+            # the partial files are kept, only the empty ones are removed
+            for f in list(files):
+                if file_size(f) == 0:
+                    logger.debug(f"delete file {f.name}")
+                    f.unlink(missing_ok=True)
+                    files.remove(f)
+            if len(files) == 0:
+                return
+            if failed:
+                logger.error(
+                    _("Enregistrement incomplet dans {} (id={})").format(
+                        ", ".join(f.name for f in files), id_
+                    )
+                )
+            elif record_filename in files:
+                self.storage.measure(channel, record_filename, elapsed)
+            for f in files:
+                self.library.add_recording(f.name, channel, program_name)
+
+        if preroll_size != 0 and not self.keep_preroll and \
+                record_filename in files:
+            loop = asyncio.get_running_loop()
+            size = await loop.run_in_executor(
+                None, trim_head, record_filename, preroll_size
+            )
+            logger.debug(f"{size} bytes of pre-roll removed from {filename}")
+
+        if not self.simulate:
+            for f in files:
+                self.postprocessor.add(f)
+
+        if shutdown or self.auto_power_off:
+            await self.power_off(id_)
+
+    def save_preroll(self, id_: int, watch: asyncio.Task):
+        """Saves the size of the pre-roll of a detached capture"""
+        if not watch.cancelled() and watch.exception() is None and \
+                watch.result() != 0:
+            self.captures.set_preroll(id_, watch.result())
+
+    def status_filename(self, id_: int, files: list[Path]) -> Optional[Path]:
+        """Returns the file of the status lines of the next capture of a
+        recording if it is detached, None otherwise"""
+        if not self.reattach:
+            return None
+        return Path(self.path, STATUS_FILENAME.format(id_, len(files)))
+
+    async def start_capture(
+        self, adapter: int, channel: str, filename: Path, duration: float,
+        size: int, status: Optional[Path] = None
+    ) -> CaptureProcess:
+        """Starts the capture of a channel into a file with an adapter. If
+        status is given, the capture is detached and writes its status lines
+        to it. Returns its process."""
+        if self.simulate:
+            command: tuple[str, ...] = ("/usr/bin/sleep", str(int(duration)))
+            return await asyncio.create_subprocess_exec(*command)
+        if self.native_capture:
+            # dvbv5-zap only tunes, the dvr device is read by the recorder
             command = (
-                "/usr/bin/dvbv5-zap",
+                self.zap_command,
                 "-a", f"{adapter}",
                 "-I", "zap",
-                "-o", f"{record_filename}",
+                "-p",
                 "-c", f"{self.channels_conf}",
-                "-t", f"{duration}",
                 f"{channel}"
             )
+            process = Capture(
+                self.dvr_device.format(adapter), filename, duration,
+                command if self.tune else None, size, self.ring_buffer
+            )
+            await process.start()
+            return process
+        if self.ring_buffer != 0:
+            # dvbv5-zap writes the stream to a pipe read by the recorder
+            command = (
+                self.zap_command,
+                "-a", f"{adapter}",
+                "-I", "zap",
+                "-o", "-",
+                "-c", f"{self.channels_conf}",
+                f"{channel}"
+            )
+            process = Capture(
+                None, filename, duration, command, size, self.ring_buffer
+            )
+            await process.start()
+            return process
+        command = (
+            self.zap_command,
+            "-a", f"{adapter}",
+            "-I", "zap",
+            "-o", f"{filename}",
+            "-c", f"{self.channels_conf}",
+            "-t", f"{int(duration)}",
+            f"{channel}"
+        )
+        if status is not None:
+            return await DetachedCapture.start(command, status)
+        # the status lines of dvbv5-zap are read by the supervisor
+        return await asyncio.create_subprocess_exec(
+            *command, stderr=asyncio.subprocess.PIPE
+        )
 
-        process = await asyncio.create_subprocess_exec(*command)
-        logger.debug(f"process id: {process.pid}")
-        self.recordings[id_]["process"] = process
-        await process.wait()
+    def written(self, recording: dict) -> int:
+        """Returns the size recorded so far of a recording running"""
+        process = recording["process"]
+        if isinstance(process, Segment):
+            # the recording is a range of the file of its block
+            if process.begin is None:
+                return 0
+            return process.block.offset() - process.begin
+        return file_size(
+            Path(self.recording_directory, recording["filename"])
+        )
 
-        logger.debug(f"process return code: {process.returncode}")
-        logger.debug(_("Fin de l'enregistrement (id={})").format(id_))
+    def received(self, process, filename: Path) -> Callable[[], int]:
+        """Returns the function giving the size captured by a process"""
+        if isinstance(process, Capture):
+            return process.received
+        return partial(file_size, filename)
 
-        self.busy[adapter] = False
-        del self.recordings[id_]
+    async def supervise(
+        self, id_: int, adapter: int, channel: str, files: list[Path],
+        process: CaptureProcess
+    ) -> tuple[int, CaptureProcess]:
+        """Waits for the end of a capture. If the adapter has no lock or if
+        the data stall, the recording goes on in a new file with another free
+        adapter, the files are appended to files. The capture is kept while
+        no adapter is free. Returns the last adapter and process."""
+        recording = self.recordings[id_]
+        while True:
+            supervisor = Supervisor(
+                process.stderr, self.received(process, files[-1]),
+                self.lock_timeout, self.stall_timeout,
+                partial(self.can_recover, id_, adapter)
+            )
+            recording["supervisor"] = supervisor
+            reason = await supervisor.run(process)
+            if reason is None:
+                return adapter, process
+            logger.error(
+                _("Échec de la capture sur l'enregistreur {} : {} "
+                  "(id={})").format(adapter, reason, id_)
+            )
+            remaining = (recording["end_date"] - datetime.now()).total_seconds()
+            if remaining <= 0:
+                return adapter, process
+            spare = self.idle_adapter(recording["end_date"])
+            if spare is None:
+                # taken while the capture was stopped
+                logger.error(
+                    _("Aucun enregistreur de secours, reprise sur "
+                      "l'enregistreur {} (id={})").format(adapter, id_)
+                )
+            else:
+                self.set_busy(adapter, False)
+                adapter = spare
+                self.set_busy(adapter, True)
+                self.allocator.move(id_, adapter)
+                recording["adapter"] = adapter
+                self.store.move_recording(id_, adapter)
+            # the file of the failed capture is kept
+            filename = files[0].with_stem(f"{files[0].stem}-{len(files) + 1}")
+            status = self.status_filename(id_, files)
+            files.append(filename)
+            recording["filename"] = filename.name
+            logger.info(
+                _("Reprise de l'enregistrement sur l'enregistreur {} dans {} "
+                  "(id={})").format(adapter, filename.name, id_)
+            )
+            process = await self.start_capture(
+                adapter, channel, filename, remaining, 0, status
+            )
+            if isinstance(process, DetachedCapture):
+                self.captures.add(id_, process.state(files))
+            recording["process"] = process
 
-        if process.returncode != 0 and not self.simulate:
-            logger.debug(f"delete file {record_filename.name}")
-            record_filename.unlink()
-            return
+    def can_recover(self, id_: int, adapter: int, reason: str) -> bool:
+        """Returns True if a failed capture can go on with another adapter,
+        else the capture is kept"""
+        if self.idle_adapter(self.recordings[id_]["end_date"]) is not None:
+            return True
+        logger.warning(
+            _("Échec de la capture sur l'enregistreur {} : {}, aucun "
+              "enregistreur de secours, la capture continue (id={})").format(
+                adapter, reason, id_
+            )
+        )
+        return False
 
-        if shutdown:
+    async def power_off(self, id_: int):
+        """Powers the PC off after a recording unless an other one is running
+        or begins soon: close recordings are made in the same power on
+        period. The post-processing of the recordings is finished before."""
+        if len(self.postprocessor.pending) != 0:
+            logger.info(
+                _("Attente de la fin des traitements (id={})").format(id_)
+            )
+        await self.postprocessor.join()
+        if any(r["task"] is not None for r in self.recordings.values()) or \
+                not self.wakeup.can_power_off():
+            logger.info(
+                _("Pas de mise hors tension, un enregistrement est proche "
+                  "(id={})").format(id_)
+            )
+        else:
             logger.debug(_("Mise hors tension (id={})").format(id_))
             await asyncio.create_subprocess_shell(
                 "sudo shutdown -h now",
@@ -95,10 +746,218 @@ class Recorder:
                 stderr=asyncio.subprocess.DEVNULL
             )
 
+    def idle_adapter(
+        self, end_date: datetime, excluded: Iterable[int] = ()
+    ) -> Optional[int]:
+        """Returns an adapter free from now to end_date, not in excluded"""
+        now = datetime.now()
+        for adapter in range(self.dvb_adapter_number):
+            if adapter not in excluded and not self.busy[adapter] and \
+                    self.allocator.is_free(adapter, now, end_date):
+                return adapter
+        return None
+
+    async def scan_epg(self):
+        """Reads the programme guide of every multiplex with the idle
+        adapters, periodically. The events over are removed."""
+        while True:
+            self.store.remove_events(datetime.now())
+            for frequency in self.channels.frequencies():
+                adapter = self.idle_adapter(
+                    datetime.now() + timedelta(seconds=self.epg_duration)
+                )
+                if adapter is None:
+                    logger.info(_("Aucun enregistreur libre pour le guide"))
+                    break
+                channel = self.channels.multiplex(frequency)[0]
+                self.scans[adapter] = asyncio.create_task(
+                    self.scan_multiplex(adapter, channel)
+                )
+                # the scan may be cancelled by a recording
+                await asyncio.wait([self.scans[adapter]])
+                del self.scans[adapter]
+            await asyncio.sleep(self.epg_period)
+
+    async def scan_multiplex(self, adapter: int, channel: Channel):
+        """Reads the programme guide of a multiplex for epg_duration
+        seconds"""
+        logger.debug(
+            f"programme guide of {channel.frequency} on adapter {adapter}"
+        )
+        self.set_busy(adapter, True)
+        guide = Epg(self.store)
+        command = (
+            self.zap_command,
+            "-a", f"{adapter}",
+            "-I", "zap",
+            "-c", f"{self.channels_conf}",
+            "-P",
+            "-o", "-",
+            f"{channel.name}"
+        )
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout = process.stdout
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.epg_duration
+            remainder = b""
+            while stdout is not None and loop.time() < deadline:
+                try:
+                    data = await asyncio.wait_for(
+                        stdout.read(READ_PACKETS * TS_PACKET_SIZE),
+                        deadline - loop.time()
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if len(data) == 0:
+                    break
+                data = remainder + data
+                end = len(data) - len(data) % TS_PACKET_SIZE
+                remainder = data[end:]
+                guide.feed(data[:end])
+        finally:
+            if process.returncode is None:
+                process.terminate()
+            await process.wait()
+            guide.flush()
+            self.set_busy(adapter, False)
+
+    async def stop_scan(self, adapter: int):
+        """Stops the scan of the programme guide using an adapter"""
+        task = self.scans.get(adapter)
+        if task is not None and not task.done():
+            logger.debug(f"programme guide scan on adapter {adapter} stopped")
+            task.cancel()
+            await asyncio.wait([task])
+
+    def search_epg(self, words: str) -> list[dict]:
+        """Returns the events of the programme guide whose title has the
+        words, with the name of their channel"""
+        events = []
+        for event in self.store.search_events(words, datetime.now()):
+            channel = self.channels.by_service(event["service_id"])
+            if channel is not None:
+                event["channel"] = channel.name
+                events.append(event)
+        return events
+
+    def record_event(self, service_id: int, event_id: int) -> int:
+        """Schedules the recording of an event of the programme guide with
+        epg_margin seconds before and after. Returns the id of the
+        recording. Raises ValueError or ConflictError."""
+        event = self.store.get_event(service_id, event_id)
+        channel = self.channels.by_service(service_id)
+        if event is None or channel is None:
+            raise ValueError(_("Programme inconnu"))
+
+        margin = timedelta(seconds=self.epg_margin)
+        begin_date = event["begin_date"] - margin
+        end_date = event["end_date"] + margin
+        immediate, begin_date, duration = self.check_dates(
+            None if begin_date <= datetime.now() else begin_date, end_date
+        )
+        program_name = "{} {}".format(
+            event["title"], event["begin_date"].strftime("%Y-%m-%d %H-%M")
+        )
+        id_ = self.id
+        self.add_recording(
+            None, channel.name, program_name, immediate, begin_date,
+            end_date, duration, False
+        )
+        return id_
+
+    def check_dates(
+        self, begin_date: Optional[datetime], end_date: datetime
+    ) -> tuple[bool, datetime, float]:
+        """Checks the dates of a recording, it starts now if begin_date is
+        None. Returns immediate, the begin date and the duration. Raises
+        ValueError with the message for the user."""
+        if begin_date is None:
+            immediate = True
+            begin_date = datetime.now()
+        else:
+            immediate = False
+            if begin_date <= datetime.now():
+                raise ValueError(_("La date de début doit être dans le futur."))
+        if begin_date >= end_date:
+            raise ValueError(
+                _("La date de début doit être antérieure à la date de fin.")
+            )
+        duration = (end_date - begin_date).total_seconds()
+        if duration > int(self.max_duration):
+            raise ValueError(_("La durée de l'enregistrement est trop longue."))
+        return immediate, begin_date, duration
+
+    def add_recordings(self, entries: list[dict]) -> list[dict]:
+        """Schedules many recordings with a single write in the store and a
+        single call to rtcwake. The entries have the arguments of
+        add_recording, begin_date is None for an immediate recording. Returns
+        the id and the adapter of each recording, or the error if it cannot
+        be scheduled."""
+        results: list[dict] = []
+        usage = None
+        if not self.simulate and self.storage.admission != "off":
+            # the space is measured once for all the entries
+            usage = self.storage.usage(self.running_recordings()[1])
+        with self.store.batch(), self.wakeup.batch():
+            for entry in entries:
+                try:
+                    if entry["channel"] not in self.channels.names():
+                        raise ValueError(_("Chaîne inconnue"))
+                    immediate, begin_date, duration = self.check_dates(
+                        entry["begin_date"], entry["end_date"]
+                    )
+                    id_ = self.id
+                    adapter = self.add_recording(
+                        entry["adapter"], entry["channel"],
+                        entry["program_name"], immediate, begin_date,
+                        entry["end_date"], duration, entry["shutdown"],
+                        usage=usage
+                    )
+                except ValueError as e:
+                    results.append({"error": str(e)})
+                except ConflictError as e:
+                    results.append({"error": self.describe_conflicts(e)})
+                else:
+                    results.append({"id": id_, "adapter": adapter})
+        return results
+
     async def record(
-        self, adapter: int, channel: str, program_name: str, immediate: bool,
-        begin_date: datetime, end_date: datetime, duration: int, shutdown: bool
-    ):
+        self, adapter: Optional[int], channel: str, program_name: str,
+        immediate: bool, begin_date: datetime, end_date: datetime,
+        duration: float, shutdown: bool
+    ) -> int:
+        """Schedules a recording on the given adapter or on a free one if
+        adapter is None. Returns the adapter. Raises ConflictError if no
+        adapter is free."""
+        return self.add_recording(
+            adapter, channel, program_name, immediate, begin_date, end_date,
+            duration, shutdown
+        )
+
+    def add_recording(
+        self, adapter: Optional[int], channel: str, program_name: str,
+        immediate: bool, begin_date: datetime, end_date: datetime,
+        duration: float, shutdown: bool, series: Optional[int] = None,
+        usage: Optional[tuple[int, int]] = None
+    ) -> int:
+        """usage is the space given by Storage.usage(), measured if None"""
+        if adapter is not None and (
+            isinstance(adapter, bool) or
+            not 0 <= adapter < self.dvb_adapter_number
+        ):
+            raise ValueError(_("Enregistreur inconnu"))
+        if not self.simulate and self.storage.admission != "off":
+            if usage is None:
+                usage = self.storage.usage(self.running_recordings()[1])
+            self.storage.admit(
+                channel, begin_date, end_date, self.recordings.values(), usage
+            )
+        adapter = self.allocate(self.id, channel, begin_date, end_date, adapter)
+
         logger.info(
             _(
                 "Programmation de l'enregistrement de \"{}\" "
@@ -106,24 +965,138 @@ class Recorder:
             ).format(program_name, round(duration / 60), channel, adapter, self.id)
         )
 
-        program_filename = program_name.replace(' ', '-') + ".ts"
-        if immediate:
-            delay = 0
+        self.schedule(
+            self.id, adapter, channel, program_name, immediate, begin_date,
+            end_date, duration, shutdown, series
+        )
+        self.store.add_recording(self.id, self.recordings[self.id])
+
+        self.id += 1
+
+        return adapter
+
+    def add_series(self, series: Series) -> int:
+        """Schedules a series of recordings, its occurrences are scheduled as
+        recordings when they are in the expansion window. Returns the id of
+        the series."""
+        id_ = self.series_id
+        self.series_id += 1
+
+        logger.info(
+            _("Programmation de la série \"{}\" (id={})").format(
+                series.program_name, id_
+            )
+        )
+        self.series[id_] = series
+        self.store.add_series(id_, series)
+        self.expand_series(id_)
+
+        return id_
+
+    def expand_series(self, id_: int):
+        """Schedules the occurrences of a series in the expansion window and
+        the next expansion"""
+        series = self.series[id_]
+        now = datetime.now()
+        after = now if series.last is None else max(series.last, now)
+
+        for begin_date in series.occurrences(after, now + EXPANSION_WINDOW):
+            end_date = begin_date + timedelta(seconds=series.duration)
+            try:
+                self.add_recording(
+                    series.adapter, series.channel,
+                    series.program_name_of(begin_date), False, begin_date,
+                    end_date, series.duration, series.shutdown, id_
+                )
+            except ConflictError as e:
+                logger.error(self.describe_conflicts(e))
+            except ValueError as e:
+                logger.error(str(e))
+            series.last = begin_date
+            self.store.update_series(id_, begin_date)
+
+        next_date = series.next_occurrence(now + EXPANSION_WINDOW)
+        if next_date is None:
+            logger.info(
+                _("Fin de la série \"{}\" (id={})").format(
+                    series.program_name, id_
+                )
+            )
+            del self.series[id_]
+            self.store.remove_series(id_)
+            self.wakeup.remove_series(id_)
         else:
-            delay = int((begin_date - datetime.now()).total_seconds())
-        task = asyncio.create_task(
-            self.record_program(
-                delay,
-                adapter,
-                channel,
-                program_filename,
-                duration,
-                shutdown,
-                self.id
+            self.timer.add(
+                ("series", id_), next_date - EXPANSION_WINDOW,
+                partial(self.expand_series, id_)
+            )
+            # the PC may be off when the timer expires
+            self.wakeup.add_series(id_, next_date)
+
+    async def cancel_series(self, id_: int):
+        """Cancels a series and its occurrences not started yet"""
+        if id_ not in self.series:
+            return
+
+        logger.info(
+            _("Annulation de la série \"{}\" (id={})").format(
+                self.series[id_].program_name, id_
+            )
+        )
+        self.timer.remove(("series", id_))
+        self.wakeup.remove_series(id_)
+        del self.series[id_]
+        self.store.remove_series(id_)
+
+        for i, recording in list(self.recordings.items()):
+            if recording["series"] == id_ and recording["task"] is None:
+                await self.stop(i)
+
+    def allocate(
+        self, id_: int, channel: str, begin_date: datetime,
+        end_date: datetime, adapter: Optional[int]
+    ) -> int:
+        frequency = self.channels.get(channel).frequency
+        # the adapter is tuned before the begin date
+        adapter, moves = self.allocator.allocate(
+            id_, begin_date - timedelta(seconds=self.preroll.preroll),
+            end_date, frequency, adapter, channel
+        )
+        for i, a in moves.items():
+            logger.info(
+                _("Déplacement de \"{}\" sur l'enregistreur {} (id={})").format(
+                    self.recordings[i]["program_name"], a, i
+                )
             )
+            self.recordings[i]["adapter"] = a
+            self.store.move_recording(i, a)
+            self.live.notify()
+        return adapter
+
+    def schedule(
+        self, id_: int, adapter: int, channel: str, program_name: str,
+        immediate: bool, begin_date: datetime, end_date: datetime,
+        duration: float, shutdown: bool, series: Optional[int] = None
+    ):
+        self.add_entry(
+            id_, adapter, channel, program_name, begin_date, end_date,
+            duration, shutdown, series
         )
 
-        self.recordings[self.id] = {
+        if immediate:
+            self.start_recording(id_)
+        else:
+            start_date = begin_date - timedelta(seconds=self.preroll.preroll)
+            self.timer.add(id_, start_date, partial(self.start_recording, id_))
+            self.wakeup.add_recording(id_, start_date)
+
+    def add_entry(
+        self, id_: int, adapter: int, channel: str, program_name: str,
+        begin_date: datetime, end_date: datetime, duration: float,
+        shutdown: bool, series: Optional[int] = None
+    ):
+        program_filename = program_name.replace(' ', '-') + ".ts"
+        self.recordings[id_] = {
             "channel": channel,
             "program_name": program_name,
             "begin_date": begin_date,
@@ -131,72 +1104,169 @@ class Recorder:
             "adapter": adapter,
             "shutdown": shutdown,
             "duration": duration,
+            "filename": program_filename,
+            "series": series,
             "process": None,
-            "task": task
+            # monotonic date of the start of the capture
+            "started": None,
+            "supervisor": None,
+            "task": None
         }
+        self.live.notify()
 
-        self.id += 1
+    async def stop(self, id_: int):
+        recording = self.recordings[id_]
+        if recording["task"] is None:
+            # not started yet
+            self.timer.remove(id_)
+            self.forget(id_)
+            self.release_block(recording["adapter"])
+            return
+
+        process = recording["process"]
+        if process is not None:
+            process.terminate()
+        else:
+            recording["task"].cancel()
+        try:
+            await recording["task"]
+        except asyncio.CancelledError:
+            # the task was cancelled before the process was started
+            if id_ in self.recordings:
+                self.forget(id_)
 
     async def cancel_recording(self, id_):
         if id_ in self.recordings:
             logger.info(_("Annulation de {} (id={})").format(
                 self.recordings[id_]["program_name"], id_)
             )
-
-            process = self.recordings[id_]["process"]
-            if process is not None:
-                process.terminate()
-            else:
-                self.recordings[id_]["task"].cancel()
-            await self.recordings[id_]["task"]
+            await self.stop(id_)
 
     async def cancel_recordings(self):
+        self.closing = True
+        self.timer.stop()
+        self.metrics.stop()
+        self.live.stop()
+        self.storage.stop()
+        await self.library.stop()
+        await self.postprocessor.stop()
+        if self.scan_task is not None:
+            self.scan_task.cancel()
+            for adapter in list(self.scans.keys()):
+                await self.stop_scan(adapter)
         for id_ in list(self.recordings.keys()):
-            record = self.recordings[id_]
-            process = record["process"]
-            if process is not None:
-                process.terminate()
+            recording = self.recordings[id_]
+            if isinstance(recording["process"], DetachedCapture):
+                # the capture goes on, it is adopted at the next start
+                recording["task"].cancel()
+                await asyncio.wait([recording["task"]])
             else:
-                record["task"].cancel()
-            await record["task"]
+                await self.stop(id_)
 
-    @set_locale
-    async def save(self):
-        """Saves the recordings to a file"""
-        # only recordings not started
-        now = datetime.now()
-        recordings = dict(
-            filter(lambda e: e[1]["begin_date"] > now, self.recordings.items())
+    def start_services(self):
+        """Starts the background tasks, after the recordings are loaded so
+        that they do not delay the first capture at startup"""
+        self.storage.start(self.running_recordings)
+        self.library.start()
+        self.postprocessor.start()
+        if self.epg and not self.simulate:
+            self.scan_task = asyncio.create_task(self.scan_epg())
+
+    def adopt(self, id_: int, recording: dict, state: dict) -> bool:
+        """Takes over a capture started by the previous run of the recorder.
+        Returns False if it is over."""
+        process = DetachedCapture.adopt(state)
+        if process is None:
+            return False
+
+        r = recording
+        if r["begin_date"] <= datetime.now() and "preroll" not in state and \
+                self.preroll.preroll != 0 and not self.keep_preroll:
+            logger.warning(
+                _("Le pré-roll de {} ne sera pas supprimé (id={})").format(
+                    state["files"][0], id_
+                )
+            )
+        frequency = self.channels.get(r["channel"]).frequency
+        self.allocator.add(
+            id_, r["adapter"],
+            r["begin_date"] - timedelta(seconds=self.preroll.preroll),
+            r["end_date"], frequency, r["channel"]
+        )
+        self.add_entry(
+            id_, r["adapter"], r["channel"], r["program_name"],
+            r["begin_date"], r["end_date"], r["duration"], r["shutdown"],
+            r["series"]
+        )
+        files = [Path(self.recording_directory, f) for f in state["files"]]
+        self.recordings[id_]["filename"] = files[-1].name
+        duration = (r["end_date"] - datetime.now()).total_seconds()
+        self.recordings[id_]["task"] = asyncio.create_task(
+            self.record_program(
+                r["channel"], files[0].name, duration, r["shutdown"], id_,
+                process, files
+            )
         )
+        return True
+
+    def import_recordings(self):
+        """Imports the recordings saved by the previous versions"""
+        try:
+            with open(self.recordings_filename, "rb") as f:
+                recordings = pickle.load(f)
+        except (FileNotFoundError, EOFError):
+            return
 
-        with open(self.recordings_filename, "wb") as f:
-            pickle.dump(recordings, f)
+        for id_, recording in recordings.items():
+            self.store.add_recording(id_, recording)
+        self.recordings_filename.unlink()
 
     @set_locale
     async def load(self):
-        """Loads the recordings from a file"""
+        """Loads the recordings from the store in one pass"""
+        self.import_recordings()
+        self.timer.start()
+        self.metrics.start()
 
-        try:
-            with open(self.recordings_filename, "rb") as f:
-                rec1 = pickle.load(f)
-        except FileNotFoundError:
-            rec1 = {}
-
-        if len(rec1) != 0:
-            # only recordings not expired
-            now = datetime.now()
-            rec2 = dict(
-                filter(lambda e: e[1]["begin_date"] > now, rec1.items())
-            )
-
-            for r in rec2.values():
-                await self.record(
-                    r["adapter"],
-                    r["channel"],
-                    r["program_name"],
-                    False,
-                    r["begin_date"],
-                    r["end_date"],
-                    r["duration"],
-                    r["shutdown"]
+        recordings = self.store.get_recordings()
+        if len(recordings) != 0:
+            self.id = max(recordings.keys()) + 1
+
+        # the captures detached by the previous run
+        states = self.captures.load()
+        now = datetime.now()
+        for id_, r in sorted(recordings.items(), key=lambda r: r[1]["begin_date"]):
+            if id_ in states and self.adopt(id_, r, states[id_]):
+                continue
+            # only recordings not started
+            if r["begin_date"] <= now:
+                self.store.remove_recording(id_)
+                continue
+
+            try:
+                adapter = self.allocate(
+                    id_, r["channel"], r["begin_date"], r["end_date"],
+                    r["adapter"]
                 )
+            except ConflictError as e:
+                logger.error(self.describe_conflicts(e))
+                self.store.remove_recording(id_)
+                continue
+            if adapter != r["adapter"]:
+                self.store.move_recording(id_, adapter)
+
+            self.schedule(
+                id_, adapter, r["channel"], r["program_name"], False,
+                r["begin_date"], r["end_date"], r["duration"], r["shutdown"],
+                r["series"]
+            )
+
+        for id_ in list(states.keys()):
+            if id_ not in self.recordings:
+                self.captures.remove(id_)
+
+        self.series = self.store.get_series()
+        if len(self.series) != 0:
+            self.series_id = max(self.series.keys()) + 1
+        for id_ in list(self.series.keys()):
+            self.expand_series(id_)
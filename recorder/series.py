@@ -0,0 +1,66 @@
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Iterator
+from typing import Optional
+
+# occurrences are scheduled as recordings this long before they begin
+EXPANSION_WINDOW = timedelta(hours=24)
+
+RULES = ("daily", "weekdays", "weekly", "custom")
+
+
+@dataclass
+class Series:
+    """Template of a recording repeated according to a rule: every day, from
+    monday to friday, every week on the day of the first occurrence, or on
+    chosen days of the week (0 is monday)"""
+    channel: str
+    program_name: str
+    begin_date: datetime
+    duration: int
+    rule: str
+    weekdays: list[int] = field(default_factory=list)
+    adapter: Optional[int] = None
+    shutdown: bool = False
+    until: Optional[date] = None
+    # begin date of the last occurrence scheduled
+    last: Optional[datetime] = None
+
+    def matches(self, day: date) -> bool:
+        if self.rule == "daily":
+            return True
+        if self.rule == "weekdays":
+            return day.weekday() < 5
+        if self.rule == "weekly":
+            return day.weekday() == self.begin_date.weekday()
+        return day.weekday() in self.weekdays
+
+    def occurrences(self, after: datetime, before: datetime) -> Iterator[datetime]:
+        """Yields the begin dates of the occurrences after a date (excluded)
+        and before an other one (included)"""
+        day = max(after.date(), self.begin_date.date())
+        time = self.begin_date.time()
+        while True:
+            begin_date = datetime.combine(day, time)
+            if begin_date > before or (
+                self.until is not None and day > self.until
+            ):
+                return
+            if begin_date > after and begin_date >= self.begin_date and \
+                    self.matches(day):
+                yield begin_date
+            day += timedelta(days=1)
+
+    def next_occurrence(self, after: datetime) -> Optional[datetime]:
+        """Returns the first occurrence after a date, None if the series is
+        over"""
+        # every rule has an occurrence in a week if it has a day
+        return next(self.occurrences(after, after + timedelta(days=8)), None)
+
+    def program_name_of(self, begin_date: datetime) -> str:
+        """Returns the program name of an occurrence, the file names of the
+        occurrences are different"""
+        return f"{self.program_name} {begin_date.strftime('%Y-%m-%d %H-%M')}"
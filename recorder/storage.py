@@ -0,0 +1,224 @@
+import asyncio
+import ctypes
+import ctypes.util
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+
+from aiohttp_babel.middlewares import _
+
+from recorder.store import Store
+
+logger = logging.getLogger(__name__)
+
+# bytes per second of a channel never recorded, a HD channel
+DEFAULT_BYTERATE = 10_000_000 // 8
+# bitrates kept by channel
+BITRATE_HISTORY = 10
+# the free space is checked at this period while recording (s)
+CHECK_PERIOD = 60
+RECORDING_SUFFIX = ".ts"
+# files made from a recording by the post-processing
+SIDECAR_SUFFIXES = (
+    ".quality.json", ".info.json", ".jpg", ".mkv", ".mp4", ".breaks.json"
+)
+ADMISSIONS = ("off", "warn", "refuse")
+FALLOC_FL_KEEP_SIZE = 0x01
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """Reserves the blocks of a file being written without changing its size,
+    so that it is less fragmented. Returns False if the file system does not
+    support it."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    result: int = libc.fallocate(
+        fd, FALLOC_FL_KEEP_SIZE, ctypes.c_longlong(0), ctypes.c_longlong(size)
+    )
+    if result != 0:
+        logger.debug(f"cannot preallocate: {os.strerror(ctypes.get_errno())}")
+    return result == 0
+
+
+def release(fd: int):
+    """Frees the blocks preallocated beyond the end of a file"""
+    os.ftruncate(fd, os.fstat(fd).st_size)
+
+
+class Storage:
+    """Space of the recording directory.
+
+    The bitrate of each channel is learnt from its past recordings, so that
+    the space needed by the schedule can be forecast: a recording is refused
+    or a warning is logged when it would not fit. With retention, the oldest
+    recordings are removed before the space runs out, except the kept
+    ones."""
+
+    def __init__(
+        self, directory: str, store: Store, min_free_space: int,
+        admission: str, retention: bool
+    ):
+        self.directory = Path(directory)
+        self.store = store
+        # the space always left free (bytes)
+        self.reserve = min_free_space * MB
+        if admission not in ADMISSIONS:
+            raise ValueError(f"unknown storage admission: {admission}")
+        self.admission = admission
+        self.retention = retention
+        # bytes per second by channel
+        self.byterates: dict[str, float] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def byterate(self, channel: str) -> float:
+        """Returns the bytes per second of a channel, the highest of its
+        recent recordings"""
+        byterate = self.byterates.get(channel)
+        if byterate is None:
+            bitrates = self.store.get_bitrates(channel, BITRATE_HISTORY)
+            byterate = max(bitrates) if bitrates else DEFAULT_BYTERATE
+            self.byterates[channel] = byterate
+        return byterate
+
+    def estimate(self, channel: str, duration: float) -> int:
+        """Returns the size of a recording (bytes)"""
+        return int(self.byterate(channel) * max(duration, 0))
+
+    def measure(self, channel: str, filename: Path, duration: float):
+        """Learns the bitrate of a channel from a finished recording"""
+        try:
+            size = filename.stat().st_size
+        except FileNotFoundError:
+            return
+        if size != 0 and duration > 0:
+            self.store.add_bitrate(channel, size / duration, BITRATE_HISTORY)
+            self.byterates.pop(channel, None)
+
+    def free_space(self) -> int:
+        st = os.statvfs(self.directory)
+        return st.f_bavail * st.f_frsize
+
+    def forecast(self, recordings: Iterable[dict], end_date: datetime) -> int:
+        """Returns the space still needed by the recordings beginning before
+        a date"""
+        now = datetime.now()
+        needed = 0
+        for r in recordings:
+            if r["begin_date"] < end_date:
+                duration = (r["end_date"] - max(r["begin_date"], now))
+                needed += self.estimate(r["channel"], duration.total_seconds())
+        return needed
+
+    def candidates(self, protected: set[str], kept: set[str]) -> list[Path]:
+        """Returns the recordings that can be removed, the oldest first. kept
+        is read from the store by the caller, in the thread of the loop."""
+        files = [
+            f for f in self.directory.glob(f"*{RECORDING_SUFFIX}")
+            if f.name not in kept and f.name not in protected
+        ]
+        return sorted(files, key=lambda f: f.stat().st_mtime)
+
+    def usage(self, protected: set[str]) -> tuple[int, int]:
+        """Returns the space free above the reserve and the size of the
+        recordings that the retention can remove (bytes)"""
+        free = self.free_space() - self.reserve
+        removable = 0
+        if self.retention:
+            removable = sum(
+                f.stat().st_size
+                for f in self.candidates(protected, self.store.get_kept())
+            )
+        return free, removable
+
+    def admit(
+        self, channel: str, begin_date: datetime, end_date: datetime,
+        recordings: Iterable[dict], usage: tuple[int, int]
+    ):
+        """Checks that a new recording fits in the recording directory with
+        the recordings already scheduled, usage is given by usage(). Raises
+        ValueError with the message for the user if it is refused."""
+        if self.admission == "off":
+            return
+        needed = self.forecast(recordings, end_date) + self.estimate(
+            channel, (end_date - begin_date).total_seconds()
+        )
+        free, removable = usage
+        if needed <= free:
+            return
+        available = free
+        if self.retention:
+            available += removable
+            if needed <= available:
+                logger.warning(
+                    _("Des enregistrements anciens seront supprimés pour "
+                      "libérer {:.1f} Go").format((needed - free) / GB)
+                )
+                return
+        message = _(
+            "Espace disque insuffisant : {:.1f} Go nécessaires, "
+            "{:.1f} Go disponibles"
+        ).format(needed / GB, max(available, 0) / GB)
+        if self.admission == "refuse":
+            raise ValueError(message)
+        logger.warning(message)
+
+    def make_room(self, needed: int, protected: set[str], kept: set[str]):
+        """Removes the oldest recordings until needed bytes are free above
+        the reserve. It runs in an executor and does not use the store."""
+        if not self.retention:
+            return
+        candidates = None
+        while self.free_space() - self.reserve < needed:
+            if candidates is None:
+                candidates = self.candidates(protected, kept)
+            if len(candidates) == 0:
+                logger.error(_("Plus d'enregistrement à supprimer"))
+                return
+            self.remove(candidates.pop(0))
+
+    def remove(self, filename: Path):
+        logger.info(
+            _("Suppression de l'enregistrement {}").format(filename.name)
+        )
+        filename.unlink(missing_ok=True)
+        for suffix in SIDECAR_SUFFIXES:
+            filename.with_suffix(suffix).unlink(missing_ok=True)
+
+    async def watch(self, running: Callable[[], tuple[list[dict], set[str]]]):
+        """Makes room for the recordings running, running returns them and
+        the files that must not be removed"""
+        while True:
+            await asyncio.sleep(CHECK_PERIOD)
+            recordings, protected = running()
+            if len(recordings) == 0:
+                continue
+            await self.make_room_async(recordings, protected)
+
+    async def make_room_async(
+        self, recordings: list[dict], protected: set[str]
+    ):
+        """Makes room for the end of recordings in an executor, the removal
+        of large files may be slow"""
+        needed = self.forecast(recordings, datetime.max)
+        # the connection to the store belongs to the thread of the loop
+        kept = self.store.get_kept()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                None, self.make_room, needed, protected, kept
+            )
+        except OSError as e:
+            logger.error(f"storage: {e}")
+
+    def start(self, running: Callable[[], tuple[list[dict], set[str]]]):
+        if self.retention:
+            self.task = asyncio.create_task(self.watch(running))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,545 @@
+import asyncio
+from contextlib import contextmanager
+from datetime import date
+from datetime import datetime
+import logging
+from pathlib import Path
+import sqlite3
+from typing import Optional
+
+from recorder.series import Series
+
+logger = logging.getLogger(__name__)
+
+STORE_FILENAME = "data/recorder.db"
+
+# period of the compaction of the write-ahead log (s)
+COMPACT_PERIOD = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    adapter INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    program_name TEXT NOT NULL,
+    begin_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    duration REAL NOT NULL,
+    shutdown INTEGER NOT NULL,
+    series INTEGER
+);
+CREATE TABLE IF NOT EXISTS awakenings (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    channel TEXT NOT NULL,
+    program_name TEXT NOT NULL,
+    begin_date TEXT NOT NULL,
+    duration REAL NOT NULL,
+    rule TEXT NOT NULL,
+    weekdays TEXT NOT NULL,
+    adapter INTEGER,
+    shutdown INTEGER NOT NULL,
+    until TEXT,
+    last TEXT
+);
+CREATE TABLE IF NOT EXISTS latencies (
+    adapter INTEGER NOT NULL,
+    frequency INTEGER NOT NULL,
+    latency REAL NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS latencies_multiplex
+    ON latencies (adapter, frequency, date);
+CREATE TABLE IF NOT EXISTS boots (
+    lead REAL NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS bitrates (
+    channel TEXT NOT NULL,
+    bitrate REAL NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kept (
+    filename TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS library (
+    filename TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    program_name TEXT NOT NULL,
+    channel TEXT,
+    duration REAL,
+    bitrate REAL,
+    thumbnail TEXT
+);
+CREATE INDEX IF NOT EXISTS library_date ON library (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS library_name USING fts5 (
+    program_name, content='library',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS library_insert AFTER INSERT ON library BEGIN
+    INSERT INTO library_name (rowid, program_name)
+        VALUES (new.rowid, new.program_name);
+END;
+CREATE TRIGGER IF NOT EXISTS library_delete AFTER DELETE ON library BEGIN
+    INSERT INTO library_name (library_name, rowid, program_name)
+        VALUES ('delete', old.rowid, old.program_name);
+END;
+CREATE TRIGGER IF NOT EXISTS library_update AFTER UPDATE ON library BEGIN
+    INSERT INTO library_name (library_name, rowid, program_name)
+        VALUES ('delete', old.rowid, old.program_name);
+    INSERT INTO library_name (rowid, program_name)
+        VALUES (new.rowid, new.program_name);
+END;
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    steps TEXT NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    service_id INTEGER NOT NULL,
+    event_id INTEGER NOT NULL,
+    begin_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    PRIMARY KEY (service_id, event_id)
+);
+CREATE INDEX IF NOT EXISTS events_begin_date ON events (begin_date);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_title USING fts5 (
+    title, content='events', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS events_insert AFTER INSERT ON events BEGIN
+    INSERT INTO events_title (rowid, title) VALUES (new.rowid, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS events_delete AFTER DELETE ON events BEGIN
+    INSERT INTO events_title (events_title, rowid, title)
+        VALUES ('delete', old.rowid, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS events_update AFTER UPDATE ON events BEGIN
+    INSERT INTO events_title (events_title, rowid, title)
+        VALUES ('delete', old.rowid, old.title);
+    INSERT INTO events_title (rowid, title) VALUES (new.rowid, new.title);
+END;
+"""
+
+
+class Store:
+    """SQLite database of the schedule.
+
+    Every change is written when it happens, in its own transaction, so the
+    schedule survives a crash of the recorder. The database is in WAL mode:
+    a change only appends to the log, which is merged into the database in
+    the background. The log is only synced when it is merged, a power cut
+    may lose the last changes but leaves the database consistent."""
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.upgrade()
+        self.task = None
+
+    def upgrade(self):
+        """Adds the columns missing in a database of a previous version"""
+        columns = [
+            row["name"] for row in self.execute("PRAGMA table_info(recordings)")
+        ]
+        if "series" not in columns:
+            self.execute("ALTER TABLE recordings ADD COLUMN series INTEGER")
+
+    def execute(self, sql: str, parameters=()):
+        return self.connection.execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters):
+        with self.batch():
+            self.connection.executemany(sql, parameters)
+
+    @contextmanager
+    def batch(self):
+        """Makes the changes in a single transaction"""
+        if self.connection.in_transaction:
+            # nested in an other batch
+            yield
+            return
+        with self.connection:
+            self.connection.execute("BEGIN")
+            yield
+
+    def add_recording(self, id_: int, recording: dict):
+        self.execute(
+            "INSERT OR REPLACE INTO recordings VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                id_, recording["adapter"], recording["channel"],
+                recording["program_name"], recording["begin_date"].isoformat(),
+                recording["end_date"].isoformat(), recording["duration"],
+                recording["shutdown"], recording.get("series")
+            )
+        )
+
+    def move_recording(self, id_: int, adapter: int):
+        self.execute(
+            "UPDATE recordings SET adapter = ? WHERE id = ?", (adapter, id_)
+        )
+
+    def remove_recording(self, id_: int):
+        self.execute("DELETE FROM recordings WHERE id = ?", (id_,))
+
+    def get_recordings(self) -> dict[int, dict]:
+        recordings = {}
+        for row in self.execute("SELECT * FROM recordings"):
+            recording = dict(row)
+            del recording["id"]
+            recording["begin_date"] = datetime.fromisoformat(row["begin_date"])
+            recording["end_date"] = datetime.fromisoformat(row["end_date"])
+            recording["shutdown"] = bool(row["shutdown"])
+            recordings[row["id"]] = recording
+        return recordings
+
+    def add_awakening(self, id_: int, awakening_date: datetime):
+        self.execute(
+            "INSERT OR REPLACE INTO awakenings VALUES (?, ?)",
+            (id_, awakening_date.isoformat())
+        )
+
+    def remove_awakenings(self, ids: list[int]):
+        self.executemany(
+            "DELETE FROM awakenings WHERE id = ?", [(id_,) for id_ in ids]
+        )
+
+    def get_awakenings(self) -> dict[int, datetime]:
+        return {
+            row["id"]: datetime.fromisoformat(row["date"])
+            for row in self.execute("SELECT * FROM awakenings")
+        }
+
+    def add_series(self, id_: int, series: Series):
+        self.execute(
+            "INSERT OR REPLACE INTO series VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                id_, series.channel, series.program_name,
+                series.begin_date.isoformat(), series.duration, series.rule,
+                ",".join(str(d) for d in series.weekdays), series.adapter,
+                series.shutdown,
+                series.until.isoformat() if series.until else None,
+                series.last.isoformat() if series.last else None
+            )
+        )
+
+    def update_series(self, id_: int, last: datetime):
+        self.execute(
+            "UPDATE series SET last = ? WHERE id = ?", (last.isoformat(), id_)
+        )
+
+    def remove_series(self, id_: int):
+        self.execute("DELETE FROM series WHERE id = ?", (id_,))
+
+    def get_series(self) -> dict[int, Series]:
+        series = {}
+        for row in self.execute("SELECT * FROM series"):
+            series[row["id"]] = Series(
+                row["channel"],
+                row["program_name"],
+                datetime.fromisoformat(row["begin_date"]),
+                row["duration"],
+                row["rule"],
+                [int(d) for d in row["weekdays"].split(",") if d],
+                row["adapter"],
+                bool(row["shutdown"]),
+                date.fromisoformat(row["until"]) if row["until"] else None,
+                datetime.fromisoformat(row["last"]) if row["last"] else None
+            )
+        return series
+
+    def add_latency(
+        self, adapter: int, frequency: int, latency: float, count: int = 20
+    ):
+        """Adds a tune-to-lock latency and keeps the count last ones"""
+        with self.batch():
+            self.connection.execute(
+                "INSERT INTO latencies VALUES (?, ?, ?, ?)",
+                (adapter, frequency, latency, datetime.now().isoformat())
+            )
+            self.connection.execute(
+                "DELETE FROM latencies WHERE adapter = ? AND frequency = ? "
+                "AND rowid NOT IN (SELECT rowid FROM latencies "
+                "WHERE adapter = ? AND frequency = ? ORDER BY date DESC LIMIT ?)",
+                (adapter, frequency, adapter, frequency, count)
+            )
+
+    def get_latencies(
+        self, adapter: int, frequency: int, count: int
+    ) -> list[float]:
+        return [
+            row["latency"] for row in self.execute(
+                "SELECT latency FROM latencies "
+                "WHERE adapter = ? AND frequency = ? ORDER BY date DESC LIMIT ?",
+                (adapter, frequency, count)
+            )
+        ]
+
+    def add_boot(self, lead: float, count: int = 10):
+        """Adds a boot lead time and keeps the count last ones"""
+        with self.batch():
+            self.connection.execute(
+                "INSERT INTO boots VALUES (?, ?)",
+                (lead, datetime.now().isoformat())
+            )
+            self.connection.execute(
+                "DELETE FROM boots WHERE rowid NOT IN "
+                "(SELECT rowid FROM boots ORDER BY date DESC LIMIT ?)",
+                (count,)
+            )
+
+    def get_boots(self, count: int) -> list[float]:
+        return [
+            row["lead"] for row in self.execute(
+                "SELECT lead FROM boots ORDER BY date DESC LIMIT ?", (count,)
+            )
+        ]
+
+    def set_state(self, name: str, value: Optional[str]):
+        self.execute(
+            "INSERT OR REPLACE INTO state VALUES (?, ?)", (name, value)
+        )
+
+    def get_state(self, name: str) -> Optional[str]:
+        row = self.execute(
+            "SELECT value FROM state WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else row["value"]
+
+    def add_bitrate(self, channel: str, bitrate: float, count: int = 10):
+        """Adds the bytes per second of a recording of a channel and keeps
+        the count last ones"""
+        with self.batch():
+            self.connection.execute(
+                "INSERT INTO bitrates VALUES (?, ?, ?)",
+                (channel, bitrate, datetime.now().isoformat())
+            )
+            self.connection.execute(
+                "DELETE FROM bitrates WHERE channel = ? AND rowid NOT IN "
+                "(SELECT rowid FROM bitrates WHERE channel = ? "
+                "ORDER BY date DESC LIMIT ?)",
+                (channel, channel, count)
+            )
+
+    def get_bitrates(self, channel: str, count: int) -> list[float]:
+        return [
+            row["bitrate"] for row in self.execute(
+                "SELECT bitrate FROM bitrates WHERE channel = ? "
+                "ORDER BY date DESC LIMIT ?",
+                (channel, count)
+            )
+        ]
+
+    def set_kept(self, filename: str, kept: bool):
+        """Keeps a recorded file from the retention or not"""
+        if kept:
+            self.execute("INSERT OR IGNORE INTO kept VALUES (?)", (filename,))
+        else:
+            self.execute("DELETE FROM kept WHERE filename = ?", (filename,))
+
+    def get_kept(self) -> set[str]:
+        return {row["filename"] for row in self.execute("SELECT * FROM kept")}
+
+    def add_job(self, filename: str, steps: list[str]) -> int:
+        """Adds a post-processing job, steps are the steps left to do"""
+        return int(self.execute(
+            "INSERT INTO jobs (filename, steps, date) VALUES (?, ?, ?)",
+            (filename, ",".join(steps), datetime.now().isoformat())
+        ).lastrowid)
+
+    def update_job(self, id_: int, steps: list[str]):
+        self.execute(
+            "UPDATE jobs SET steps = ? WHERE id = ?", (",".join(steps), id_)
+        )
+
+    def remove_job(self, id_: int):
+        self.execute("DELETE FROM jobs WHERE id = ?", (id_,))
+
+    def get_jobs(self) -> list[tuple[int, str, list[str]]]:
+        """Returns the jobs left to do in the order they were added"""
+        return [
+            (row["id"], row["filename"], row["steps"].split(",") if row["steps"] else [])
+            for row in self.execute("SELECT * FROM jobs ORDER BY id")
+        ]
+
+    def add_files(self, files: list):
+        """Adds or updates files of the library, the channel and the program
+        name given by the recorder are kept"""
+        self.executemany(
+            "INSERT INTO library VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (filename) DO UPDATE SET "
+            "mtime_ns = excluded.mtime_ns, size = excluded.size, "
+            "date = excluded.date, duration = excluded.duration, "
+            "bitrate = excluded.bitrate, thumbnail = excluded.thumbnail, "
+            "channel = coalesce(library.channel, excluded.channel), "
+            "program_name = iif(library.channel IS NULL, "
+            "excluded.program_name, library.program_name)",
+            [
+                (
+                    f.filename, f.mtime_ns, f.size, f.date.isoformat(),
+                    f.program_name, f.channel, f.duration, f.bitrate,
+                    f.thumbnail
+                )
+                for f in files
+            ]
+        )
+
+    def set_file_channel(self, filename: str, channel: str, program_name: str):
+        """Sets the channel and the program name of a recorded file, its
+        other data are updated by the next scan"""
+        self.execute(
+            "INSERT INTO library VALUES (?, 0, 0, ?, ?, ?, NULL, NULL, NULL) "
+            "ON CONFLICT (filename) DO UPDATE SET mtime_ns = 0, "
+            "channel = excluded.channel, program_name = excluded.program_name",
+            (filename, datetime.now().isoformat(), program_name, channel)
+        )
+
+    def remove_files(self, filenames: list[str]):
+        self.executemany(
+            "DELETE FROM library WHERE filename = ?",
+            [(filename,) for filename in filenames]
+        )
+
+    def get_file_states(self) -> dict[str, tuple[int, int]]:
+        """Returns the modification time and the size of the files of the
+        library"""
+        return {
+            row["filename"]: (row["mtime_ns"], row["size"])
+            for row in self.execute(
+                "SELECT filename, mtime_ns, size FROM library"
+            )
+        }
+
+    def search_files(
+        self, words: str, offset: int, limit: int
+    ) -> tuple[list[dict], int]:
+        """Returns a page of the files of the library whose program name has
+        the words, or all of them, the last ones first, and their number"""
+        query = " ".join(
+            '"' + word.replace('"', '""') + '"*' for word in words.split()
+        )
+        if query:
+            where = (
+                "FROM library_name JOIN library "
+                "ON library.rowid = library_name.rowid "
+                "WHERE library_name MATCH ?"
+            )
+            parameters: tuple[str, ...] = (query,)
+        else:
+            where = "FROM library"
+            parameters = ()
+        count = self.execute(
+            f"SELECT count(*) {where}", parameters
+        ).fetchone()[0]
+        rows = self.execute(
+            f"SELECT library.* {where} ORDER BY library.date DESC "
+            "LIMIT ? OFFSET ?",
+            parameters + (limit, offset)
+        )
+        files = []
+        for row in rows:
+            file = dict(row)
+            file["date"] = datetime.fromisoformat(row["date"])
+            files.append(file)
+        return files, count
+
+    def add_events(self, events: list):
+        """Adds or updates events of the programme guide"""
+        self.executemany(
+            "INSERT INTO events VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (service_id, event_id) DO UPDATE SET "
+            "begin_date = excluded.begin_date, end_date = excluded.end_date, "
+            "title = excluded.title, description = excluded.description "
+            "WHERE begin_date != excluded.begin_date "
+            "OR end_date != excluded.end_date OR title != excluded.title "
+            "OR description != excluded.description",
+            [
+                (
+                    e.service_id, e.event_id, e.begin_date.isoformat(),
+                    e.end_date.isoformat(), e.title, e.description
+                )
+                for e in events
+            ]
+        )
+
+    def get_event(self, service_id: int, event_id: int) -> Optional[dict]:
+        row = self.execute(
+            "SELECT * FROM events WHERE service_id = ? AND event_id = ?",
+            (service_id, event_id)
+        ).fetchone()
+        return None if row is None else self.event(row)
+
+    def search_events(
+        self, words: str, after: datetime, limit: int = 100
+    ) -> list[dict]:
+        """Returns the events whose title has all the words, or begins with
+        them, ending after a date, sorted by begin date"""
+        query = " ".join(
+            '"' + word.replace('"', '""') + '"*' for word in words.split()
+        )
+        if not query:
+            return []
+        return [
+            self.event(row) for row in self.execute(
+                "SELECT events.* FROM events_title "
+                "JOIN events ON events.rowid = events_title.rowid "
+                "WHERE events_title MATCH ? AND events.end_date > ? "
+                "ORDER BY events.begin_date LIMIT ?",
+                (query, after.isoformat(), limit)
+            )
+        ]
+
+    def remove_events(self, before: datetime):
+        """Removes the events ended before a date"""
+        self.execute(
+            "DELETE FROM events WHERE end_date < ?", (before.isoformat(),)
+        )
+
+    @staticmethod
+    def event(row: sqlite3.Row) -> dict:
+        event = dict(row)
+        event["begin_date"] = datetime.fromisoformat(row["begin_date"])
+        event["end_date"] = datetime.fromisoformat(row["end_date"])
+        return event
+
+    def checkpoint(self):
+        """Merges the write-ahead log into the database and truncates it"""
+        connection = sqlite3.connect(self.filename)
+        try:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            connection.close()
+
+    async def compact(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(COMPACT_PERIOD)
+            try:
+                await loop.run_in_executor(None, self.checkpoint)
+            except sqlite3.Error as e:
+                logger.warning(f"checkpoint failed: {e}")
+
+    def start(self):
+        self.task = asyncio.create_task(self.compact())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.connection.close()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from pathlib import Path
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "video/mp2t"
+# a growing file is sent by chunks of whole packets
+CHUNK_SIZE = 1024 * 188
+# a growing file is checked for new data at this period (s)
+FOLLOW_PERIOD = 0.5
+
+
+def recording_path(request: web.Request) -> Path:
+    """Returns the path of the requested recording, which must be a file of
+    the recording directory"""
+    directory = Path(request.app.record.recording_directory).resolve()
+    filename = Path(directory, request.match_info["filename"]).resolve()
+    if filename.parent != directory or not filename.is_file():
+        raise web.HTTPNotFound()
+    return filename
+
+
+async def follow(request: web.Request, filename: Path) -> web.StreamResponse:
+    """Sends a file while it is being recorded, like tail -f"""
+    recorder = request.app.record
+    loop = asyncio.get_running_loop()
+
+    response = web.StreamResponse(headers={"Content-Type": CONTENT_TYPE})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    with open(filename, "rb") as f:
+        while True:
+            recording = recorder.is_recording(filename.name)
+            data = await loop.run_in_executor(None, f.read, CHUNK_SIZE)
+            if len(data) != 0:
+                try:
+                    await response.write(data)
+                except ConnectionResetError:
+                    return response
+            elif recording:
+                await asyncio.sleep(FOLLOW_PERIOD)
+            else:
+                # the recording is over and the file entirely sent
+                break
+
+    await response.write_eof()
+    return response
+
+
+async def stream_recording(request: web.Request) -> web.StreamResponse:
+    filename = recording_path(request)
+    if request.app.record.is_recording(filename.name):
+        logger.debug(f"follow {filename.name}")
+        return await follow(request, filename)
+
+    # sendfile with Range and conditional requests support
+    return web.FileResponse(filename, headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,153 @@
+import asyncio
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import re
+from typing import Callable
+from typing import Optional
+from typing import Protocol
+
+from aiohttp_babel.middlewares import _
+
+logger = logging.getLogger(__name__)
+
+# the capture is checked at this period (s)
+CHECK_PERIOD = 1.0
+# fields of a status line of dvbv5-zap, as in
+# "Lock   (0x1f) Signal= -48.00dBm C/N= 29.54dB UCB= 0 postBER= 0"
+STATUS_FIELD = re.compile(r"([\w/]+)=\s*(\S+)")
+LINE_SEPARATOR = re.compile(rb"[\r\n]")
+
+
+@dataclass
+class TunerStatus:
+    lock: bool = False
+    signal: Optional[str] = None
+    snr: Optional[str] = None
+    ber: Optional[str] = None
+    ucb: Optional[int] = None
+
+
+def file_size(filename: Path) -> int:
+    try:
+        return filename.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def parse_status(line: str) -> Optional[TunerStatus]:
+    """Returns the status of a line printed by dvbv5-zap, None for the other
+    lines"""
+    fields = dict(STATUS_FIELD.findall(line))
+    if "Signal" not in fields and "C/N" not in fields:
+        return None
+    ucb = fields.get("UCB", "")
+    return TunerStatus(
+        line.lstrip().startswith("Lock"), fields.get("Signal"),
+        fields.get("C/N"), fields.get("postBER", fields.get("preBER")),
+        int(ucb) if ucb.isdigit() else None
+    )
+
+
+class StatusStream(Protocol):
+    """The standard error of dvbv5-zap or the file of its status lines"""
+
+    async def read(self, n: int) -> bytes:
+        ...
+
+
+class Supervisor:
+    """Watches a capture until its process ends.
+
+    The status lines printed by the tuner on stream are parsed as they come.
+    The capture is stopped if the tuner reports no lock for lock_timeout
+    seconds or if the size of the file does not grow for stall_timeout
+    seconds, 0 disables a check. If recover is given, it is called with the
+    reason of the failure and the capture goes on if it returns False, it is
+    checked again after the timeouts."""
+
+    def __init__(
+        self, stream: Optional[StatusStream], size: Callable[[], int],
+        lock_timeout: float, stall_timeout: float,
+        recover: Optional[Callable[[str], bool]] = None
+    ):
+        self.stream = stream
+        self.size = size
+        self.lock_timeout = lock_timeout
+        self.stall_timeout = stall_timeout
+        self.recover = recover
+        self.status = TunerStatus()
+        # monotonic date since which the tuner has no lock
+        self.unlocked_since = None
+        # bytes per second captured over the last check period
+        self.rate = 0.0
+
+    async def read(self):
+        buffer = b""
+        while True:
+            data = await self.stream.read(4096)
+            if len(data) == 0:
+                break
+            *lines, buffer = LINE_SEPARATOR.split(buffer + data)
+            for line in lines:
+                status = parse_status(line.decode(errors="replace"))
+                if status is None:
+                    continue
+                self.status = status
+                if status.lock:
+                    self.unlocked_since = None
+                elif self.unlocked_since is None:
+                    self.unlocked_since = asyncio.get_running_loop().time()
+
+    async def watch(self) -> str:
+        """Returns the reason of the failure of the capture"""
+        loop = asyncio.get_running_loop()
+        # a tuner which prints no status is only checked by the size
+        size = self.size()
+        grown = checked = loop.time()
+        while True:
+            await asyncio.sleep(CHECK_PERIOD)
+            now = loop.time()
+            previous_size, size = size, self.size()
+            self.rate = (size - previous_size) / (now - checked)
+            checked = now
+            if size != previous_size:
+                grown = now
+            if self.lock_timeout != 0 and self.unlocked_since is not None and \
+                    now - self.unlocked_since >= self.lock_timeout:
+                reason: str = _("pas de verrouillage")
+            elif self.stall_timeout != 0 and now - grown >= self.stall_timeout:
+                reason = _("pas de données")
+            else:
+                continue
+            if self.recover is None or self.recover(reason):
+                return reason
+            grown = now
+            if self.unlocked_since is not None:
+                self.unlocked_since = now
+
+    async def run(self, process) -> Optional[str]:
+        """Waits for the end of process. Returns the reason if it has been
+        terminated because of a failure."""
+        tasks = [asyncio.create_task(self.watch())]
+        if self.stream is not None:
+            tasks.append(asyncio.create_task(self.read()))
+        waiter = asyncio.create_task(process.wait())
+        try:
+            await asyncio.wait(
+                [waiter, tasks[0]], return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            for task in tasks + [waiter]:
+                task.cancel()
+            raise
+        reason = None
+        if waiter.done():
+            tasks[0].cancel()
+        else:
+            reason = tasks[0].result()
+            process.terminate()
+            await waiter
+        # the status stream ends with the process
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return reason
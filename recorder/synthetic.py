@@ -0,0 +1,177 @@
+import argparse
+import os
+from pathlib import Path
+import struct
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from recorder.capture import CHUNK_SIZE
+from recorder.multiplex import crc32_mpeg
+from recorder.multiplex import PAT_PID
+from recorder.multiplex import TS_PACKET_SIZE
+from recorder.multiplex import TS_SYNC_BYTE
+
+BLOCK_PACKETS = CHUNK_SIZE // TS_PACKET_SIZE
+PMT_PID = 0x100
+PCR_FREQUENCY = 90000
+# one packet out of AUDIO_PERIOD is an audio packet
+AUDIO_PERIOD = 10
+# bitrate of a HD channel (bit/s)
+HD_BITRATE = 10_000_000
+
+
+def psi_packet(pid: int, table_id: int, extension: int, body: bytes) -> bytes:
+    """Returns a packet holding a whole PSI section"""
+    length = 5 + len(body) + 4
+    section = bytes([
+        table_id, 0xb0 | (length >> 8), length & 0xff,
+        extension >> 8, extension & 0xff, 0xc1, 0, 0
+    ]) + body
+    section += struct.pack(">I", crc32_mpeg(section))
+    header = bytes([TS_SYNC_BYTE, 0x40 | (pid >> 8), pid & 0xff, 0x10, 0])
+    return (header + section).ljust(TS_PACKET_SIZE, b"\xff")
+
+
+class SyntheticStream:
+    """Transport stream of a single channel, as the dvr device of an adapter
+    tuned to it would deliver: PAT, PMT, then video packets carrying the PCR
+    and audio packets with random payloads.
+
+    The stream is made by blocks of packets built from a template: only the
+    continuity counters and the PCR are updated for each block."""
+
+    def __init__(
+        self, service_id: int = 257, video_pid: int = 120,
+        audio_pid: int = 130, bitrate: int = HD_BITRATE
+    ):
+        self.bitrate = bitrate
+        self.packets = 0
+
+        pat = psi_packet(
+            PAT_PID, 0x00, 1, struct.pack(">HH", service_id, 0xe000 | PMT_PID)
+        )
+        pmt = psi_packet(
+            PMT_PID, 0x02, service_id,
+            struct.pack(">HH", 0xe000 | video_pid, 0xf000)
+            + bytes([0x1b, 0xe0 | (video_pid >> 8), video_pid & 0xff, 0xf0, 0])
+            + bytes([0x03, 0xe0 | (audio_pid >> 8), audio_pid & 0xff, 0xf0, 0])
+        )
+
+        rng = np.random.default_rng(0)
+        self.template = rng.integers(
+            0, 256, (BLOCK_PACKETS, TS_PACKET_SIZE), dtype=np.uint8
+        )
+        pids = np.full(BLOCK_PACKETS, video_pid)
+        pids[AUDIO_PERIOD // 2::AUDIO_PERIOD] = audio_pid
+        self.template[:, 0] = TS_SYNC_BYTE
+        self.template[:, 1] = pids >> 8
+        self.template[:, 2] = pids & 0xff
+        self.template[:, 3] = 0x10
+        self.template[0] = np.frombuffer(pat, dtype=np.uint8)
+        self.template[1] = np.frombuffer(pmt, dtype=np.uint8)
+        pids[:2] = (PAT_PID, PMT_PID)
+
+        # the first video packet carries the PCR in its adaptation field
+        self.pcr_index = 2
+        self.template[self.pcr_index, 1] |= 0x40
+        self.template[self.pcr_index, 3] = 0x30
+        self.template[self.pcr_index, 4:6] = (7, 0x10)
+
+        # indexes of the packets of each PID
+        self.indexes = {
+            pid: np.flatnonzero(pids == pid)
+            for pid in (PAT_PID, PMT_PID, video_pid, audio_pid)
+        }
+        self.counters = dict.fromkeys(self.indexes, 0)
+
+    def block(self) -> bytes:
+        for pid, index in self.indexes.items():
+            counter = self.counters[pid]
+            cc = (counter + np.arange(len(index))) & 0x0f
+            self.template[index, 3] = (self.template[index, 3] & 0xf0) | cc
+            self.counters[pid] = (counter + len(index)) & 0x0f
+
+        if self.bitrate > 0:
+            seconds = self.packets * TS_PACKET_SIZE * 8 / self.bitrate
+            pcr = int(seconds * PCR_FREQUENCY) & ((1 << 33) - 1)
+            self.template[self.pcr_index, 6:12] = np.frombuffer(
+                struct.pack(">Q", (pcr << 15) | (0x3f << 9))[2:], dtype=np.uint8
+            )
+        self.packets += BLOCK_PACKETS
+        return self.template.tobytes()
+
+
+def feed(
+    filename: Path, bitrate: int = HD_BITRATE,
+    stopping: Optional[threading.Event] = None, duration: float = 0
+) -> int:
+    """Writes a synthetic stream into a FIFO or a file at a bitrate, as fast
+    as possible if bitrate is 0. Stops after duration seconds if it is not 0,
+    when the reader of the FIFO goes away or when stopping is set. Returns
+    the number of bytes written."""
+    stream = SyntheticStream(bitrate=bitrate)
+    written = 0
+    start = time.monotonic()
+    with open(filename, "wb", buffering=0) as f:
+        while stopping is None or not stopping.is_set():
+            elapsed = time.monotonic() - start
+            if duration != 0 and elapsed >= duration:
+                break
+            if bitrate > 0:
+                ahead = written * 8 / bitrate - elapsed
+                if ahead > 0:
+                    time.sleep(ahead)
+            try:
+                written += f.write(stream.block())
+            except BrokenPipeError:
+                break
+    return written
+
+
+class SyntheticAdapter(threading.Thread):
+    """Stands for the dvr device of an adapter: a FIFO fed with a synthetic
+    stream each time it is opened by a capture"""
+
+    def __init__(self, filename: Path, bitrate: int = HD_BITRATE):
+        super().__init__(name=f"synthetic {filename.name}", daemon=True)
+        self.filename = filename
+        self.bitrate = bitrate
+        self.stopping = threading.Event()
+        if not filename.exists():
+            os.mkfifo(filename)
+
+    def run(self):
+        while not self.stopping.is_set():
+            # blocks until a capture opens the FIFO
+            feed(self.filename, self.bitrate, self.stopping)
+
+    def stop(self):
+        self.stopping.set()
+        # unblocks the writer waiting for a reader
+        try:
+            fd = os.open(self.filename, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def main():
+    """Writes a synthetic transport stream to a file, a FIFO or stdout"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", help="file or FIFO, - for stdout")
+    parser.add_argument(
+        "-b", "--bitrate", type=int, default=HD_BITRATE,
+        help="bit/s, 0 for as fast as possible"
+    )
+    parser.add_argument("-t", "--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    output = "/dev/stdout" if args.output == "-" else args.output
+    feed(Path(output), args.bitrate, duration=args.duration)
+
+
+if __name__ == "__main__":
+    main()
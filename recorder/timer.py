@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable
+from typing import Hashable
+
+logger = logging.getLogger(__name__)
+
+# the wall clock is checked again at least at this period (s), sleeping
+# with the monotonic clock does not count the time the PC is suspended
+MAX_SLEEP = 5
+
+
+class Timer:
+    """Calls functions at wall clock dates.
+
+    Entries are kept in a heap ordered by date and a single task sleeps
+    until the earliest one. On wake, the real time is read again and every
+    due entry is fired in date order, so a clock change or a suspend only
+    delays the entries by MAX_SLEEP at most. Removed entries are left in the
+    heap and skipped."""
+
+    def __init__(self):
+        self.heap: list[tuple[float, int, Hashable]] = []
+        # entries by key: (timestamp, sequence number, callback)
+        self.entries: dict[Hashable, tuple[float, int, Callable]] = {}
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key: Hashable, date: datetime, callback: Callable):
+        """Calls callback() at date, replacing the entry of the same key"""
+        timestamp = date.timestamp()
+        sequence = next(self.counter)
+        self.entries[key] = (timestamp, sequence, callback)
+        heapq.heappush(self.heap, (timestamp, sequence, key))
+        if self.heap[0][1] == sequence:
+            # the earliest entry changed
+            self.changed.set()
+
+    def remove(self, key: Hashable):
+        self.entries.pop(key, None)
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [
+                (t, s, k) for k, (t, s, _) in self.entries.items()
+            ]
+            heapq.heapify(self.heap)
+
+    def fire(self):
+        """Calls the callbacks of the due entries in date order"""
+        now = time.time()
+        while len(self.heap) != 0 and self.heap[0][0] <= now:
+            _, sequence, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != sequence:
+                # removed or replaced
+                continue
+            del self.entries[key]
+            try:
+                entry[2]()
+            except Exception:
+                logger.exception(f"timer entry {key}")
+
+    async def run(self):
+        while True:
+            self.fire()
+            timeout = MAX_SLEEP
+            if len(self.heap) != 0:
+                timeout = min(max(self.heap[0][0] - time.time(), 0), MAX_SLEEP)
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from dataclasses import field
 # from enum import auto
 # from enum import Enum
 # from enum import IntEnum
@@ -13,3 +14,29 @@ class GeneralConfig:
     language: str
     simulate: bool
     port: int
+    multiplex: bool = False
+    merge_recordings: bool = False
+    native_capture: bool = False
+    ring_buffer: int = 0
+    analyze: bool = False
+    preroll: int = 0
+    adaptive_preroll: bool = False
+    keep_preroll: bool = False
+    auto_awakening: bool = False
+    auto_power_off: bool = False
+    power_off_gap: int = 1800
+    epg: bool = False
+    epg_period: int = 21600
+    epg_duration: int = 60
+    epg_margin: int = 300
+    post_processing: list[str] = field(default_factory=list)
+    post_processing_workers: int = 1
+    remux_format: str = "mkv"
+    min_free_space: int = 1024
+    storage_admission: str = "off"
+    retention: bool = False
+    preallocate: bool = False
+    zap_command: str = "/usr/bin/dvbv5-zap"
+    lock_timeout: int = 10
+    stall_timeout: int = 10
+    reattach: bool = False
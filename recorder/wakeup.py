@@ -1,10 +1,17 @@
+from contextlib import contextmanager
 from datetime import datetime
+from datetime import timedelta
+import heapq
 import logging
 from pathlib import Path
 import pickle
+import time
+from typing import Optional
 
 from aiohttp_babel.middlewares import _
 
+import recorder.config as config
+from recorder.store import Store
 from recorder.utils import set_locale
 from recorder.utils import cancel_awakening
 from recorder.utils import schedule_awakening
@@ -13,12 +20,45 @@ logger = logging.getLogger(__name__)
 
 AWAKENINGS_BIN_FILENAME = "data/awakenings.bin"
 
+# boot lead time (s) used until boots are measured
+BOOT_LEAD = 180
+# the boot lead time is the slowest recent boot plus this margin (s)
+BOOT_MARGIN = 60
+# boot durations kept
+BOOT_HISTORY = 10
+# a boot is an awakening if it happened this close to the planned date (s)
+BOOT_TOLERANCE = 300
+
+
+def boot_time() -> float:
+    """Returns the timestamp of the boot of the PC"""
+    with open("/proc/uptime") as f:
+        return time.time() - float(f.read().split()[0])
+
 
 class Awakenings:
+    """Awakenings of the PC, set by hand or derived from the recordings: the
+    PC is awakened before a recording starts by the time a boot takes.
 
-    def __init__(self, path: Path):
+    The awakenings are kept in a heap, removed or expired entries are
+    skipped when the earliest one is looked for. rtcwake is called only
+    when the earliest awakening changes."""
+
+    def __init__(self, path: Path, store: Store):
         self.awakenings = {}
         self.awakenings_filename = Path(path, AWAKENINGS_BIN_FILENAME)
+        self.store = store
+        self.auto_awakening = config.general.auto_awakening
+        self.power_off_gap = config.general.power_off_gap
+        # (date, key) where key is ("awakening", id), ("recording", id) or
+        # ("series", id)
+        self.heap: list[tuple[datetime, tuple]] = []
+        self.entries: dict[tuple, datetime] = {}
+        # date of the awakening given to rtcwake
+        self.scheduled: Optional[datetime] = None
+        self.boot_lead = timedelta(seconds=BOOT_LEAD)
+        # set at startup, rtcwake is called once the recordings are armed
+        self.deferred = False
 
         self.id = 1
 
@@ -26,63 +66,156 @@ class Awakenings:
         """Returns awakenings sorted by date"""
         return sorted(self.awakenings.items(), key=lambda w: w[1])
 
-    def add_awakening(self, date):
+    def push(self, key: tuple, date: datetime):
+        self.entries[key] = date
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(d, k) for k, d in self.entries.items()]
+            heapq.heapify(self.heap)
+        else:
+            heapq.heappush(self.heap, (date, key))
+
+    def next_awakening(self) -> Optional[datetime]:
+        """Returns the earliest awakening in the future"""
+        now = datetime.now()
+        while len(self.heap) != 0:
+            date, key = self.heap[0]
+            if self.entries.get(key) == date and date > now:
+                return date
+            heapq.heappop(self.heap)
+            if self.entries.get(key) == date:
+                # expired
+                del self.entries[key]
+                if key[0] == "awakening":
+                    del self.awakenings[key[1]]
+                    self.store.remove_awakenings([key[1]])
+        return None
+
+    def add_awakening(self, date) -> int:
+        """Returns the id of the awakening"""
         logger.info(
             _("Ajout du réveil le {} à {} (id={})").format(
                 date.strftime("%d/%m/%Y"), date.strftime("%H:%M"), self.id
             )
         )
-        self.awakenings[self.id] = date
+        id_ = self.id
+        self.awakenings[id_] = date
+        self.store.add_awakening(id_, date)
+        self.push(("awakening", id_), date)
         self.id += 1
         self.setup_awakening()
+        return id_
+
+    def add_awakenings(self, dates: list[datetime]) -> list[int]:
+        """Adds many awakenings with a single write in the store"""
+        with self.store.batch(), self.batch():
+            return [self.add_awakening(date) for date in dates]
+
+    @contextmanager
+    def batch(self):
+        """Calls rtcwake once after many changes"""
+        deferred = self.deferred
+        self.deferred = True
+        try:
+            yield
+        finally:
+            self.deferred = deferred
+            self.setup_awakening()
 
     def cancel_awakening(self, id_):
         if id_ in self.awakenings:
             logger.info(_("Suppression du réveil (id={})").format(id_))
             del self.awakenings[id_]
+            self.entries.pop(("awakening", id_), None)
+            self.store.remove_awakenings([id_])
             self.setup_awakening()
 
-    def setup_awakening(self):
-        # remove expired awakenings
-        now = datetime.now()
-        wus = dict(filter(lambda x: x[1] > now, self.awakenings.items()))
-        self.awakenings = wus
+    def add_recording(self, id_: int, start_date: datetime):
+        """Awakens the PC before a recording starts"""
+        if self.auto_awakening:
+            self.push(("recording", id_), start_date - self.boot_lead)
+            self.setup_awakening()
+
+    def remove_recording(self, id_: int):
+        if self.entries.pop(("recording", id_), None) is not None:
+            self.setup_awakening()
+
+    def add_series(self, id_: int, begin_date: datetime):
+        """Awakens the PC before the next occurrence of a series which is not
+        scheduled yet, it is scheduled when the recorder starts"""
+        if self.auto_awakening:
+            self.push(("series", id_), begin_date - self.boot_lead)
+            self.setup_awakening()
 
-        if len(self.awakenings) == 0:
+    def remove_series(self, id_: int):
+        if self.entries.pop(("series", id_), None) is not None:
+            self.setup_awakening()
+
+    def can_power_off(self) -> bool:
+        """Returns True if the next awakening is far enough to power off the
+        PC, close recordings are grouped in the same power on period. The
+        occurrences of the series not scheduled yet are counted."""
+        wut = self.next_awakening()
+        return wut is None or \
+            (wut - datetime.now()).total_seconds() > self.power_off_gap
+
+    def setup_awakening(self):
+        if self.deferred:
+            return
+        wut = self.next_awakening()
+        if wut == self.scheduled:
+            return
+        self.scheduled = wut
+
+        if wut is None:
             logger.info(_("Annulation du réveil"))
             # utils function, not the method of this class !
             cancel_awakening()
+            self.store.set_state("awakening", None)
         else:
-            # select the nearest awakening...
-            wui, wut = sorted(self.awakenings.items(), key=lambda w: w[1])[0]
-
             logger.info(
-                _("Programmation du réveil le {} à {} (id={})").format(
-                    wut.strftime("%d/%m/%Y"), wut.strftime("%H:%M"), wui
+                _("Programmation du réveil le {} à {}").format(
+                    wut.strftime("%d/%m/%Y"), wut.strftime("%H:%M")
                 )
             )
-            # ...and schedule it
             schedule_awakening(wut)
-
-    @set_locale
-    async def save(self):
-        """Saves the awakenings to a file"""
-        with open(self.awakenings_filename, "wb") as f:
-            pickle.dump(self.awakenings, f)
-
-    @set_locale
-    async def load(self):
-        """Loads the awakenings from a file"""
-
-        # awakenings
+            self.store.set_state("awakening", wut.isoformat())
+
+    def measure_boot(self):
+        """Measures the boot lead time if the PC has been awakened by rtcwake,
+        from the awakening date to now"""
+        planned = self.store.get_state("awakening")
+        if planned is not None:
+            planned_date = datetime.fromisoformat(planned)
+            if abs(boot_time() - planned_date.timestamp()) < BOOT_TOLERANCE:
+                lead = (datetime.now() - planned_date).total_seconds()
+                logger.info(f"boot lead time: {lead:.0f} s")
+                self.store.add_boot(lead, BOOT_HISTORY)
+
+        leads = self.store.get_boots(BOOT_HISTORY)
+        if len(leads) != 0:
+            self.boot_lead = timedelta(seconds=max(leads) + BOOT_MARGIN)
+
+    def import_awakenings(self):
+        """Imports the awakenings saved by the previous versions"""
         try:
             with open(self.awakenings_filename, "rb") as f:
                 wus = pickle.load(f)
-        except FileNotFoundError:
-            wus = {}
+        except (FileNotFoundError, EOFError):
+            return
 
-        if len(wus) == 0:
-            self.setup_awakening()
-        else:
-            for w in wus.values():
-                self.add_awakening(w)
+        for id_, date in wus.items():
+            self.store.add_awakening(id_, date)
+        self.awakenings_filename.unlink()
+
+    @set_locale
+    async def load(self):
+        """Loads the awakenings from the store in one pass"""
+        self.import_awakenings()
+        self.measure_boot()
+
+        self.awakenings = self.store.get_awakenings()
+        if len(self.awakenings) != 0:
+            self.id = max(self.awakenings.keys()) + 1
+        for id_, date in self.awakenings.items():
+            self.push(("awakening", id_), date)
+        self.setup_awakening()
@@ -1,2 +1,3 @@
 #!/usr/bin/env bash
-.venv/bin/python3 recorder/main.py
+# exec: the signals of systemd go to the recorder, not to the shell
+exec .venv/bin/python3 -m recorder.boot
@@ -0,0 +1,43 @@
+from recorder.analyzer import Analyzer
+from recorder.multiplex import TS_PACKET_SIZE
+
+PACKETS = 1000
+
+
+def packet(pid: int, cc: int) -> bytes:
+    header = bytes((0x47, pid >> 8, pid & 0xff, 0x10 | cc))
+    return header + b"\xff" * (TS_PACKET_SIZE - 4)
+
+
+def stream(count: int, first: int = 0) -> bytes:
+    return b"".join(packet(0x100, i % 16) for i in range(first, first + count))
+
+
+def test_resync_inside_block():
+    analyzer = Analyzer()
+    # bytes lost in the middle of a block, then a packet cut short
+    data = stream(300) + b"\x00" * 50 + stream(300, 300) + \
+        packet(0x100, 600 % 16)[:100] + stream(PACKETS - 601, 601)
+    analyzer.feed(data)
+    report = analyzer.finish()
+
+    assert report.sync_errors == 2
+    assert report.packets == PACKETS - 1
+    # the packet after the one cut short is lost with it
+    assert report.cc_errors == 1
+    assert report.lost_packets == 1
+    assert report.pids == {0x100: PACKETS - 1}
+
+
+def test_resync_across_blocks():
+    analyzer = Analyzer()
+    data = stream(PACKETS)
+    data = data[:1000] + data[1010:]
+    for i in range(0, len(data), 4096):
+        analyzer.feed(data[i:i + 4096])
+    report = analyzer.finish()
+
+    assert report.sync_errors == 1
+    assert report.packets == PACKETS - 1
+    assert report.cc_errors == 1
+    assert report.lost_packets == 1
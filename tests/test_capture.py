@@ -0,0 +1,62 @@
+import asyncio
+import os
+import threading
+import time
+
+from recorder.capture import Capture
+from recorder.multiplex import TS_PACKET_SIZE
+
+PACKETS = 16384
+
+
+class SlowCapture(Capture):
+    """Capture whose writes after the first one are slow so that the ring
+    buffer fills while its tail is not on a packet boundary"""
+
+    writes = 0
+
+    def write(self, output, data):
+        self.writes += 1
+        if 1 < self.writes <= 4:
+            time.sleep(0.5)
+        super().write(output, data)
+
+
+def packet(i: int) -> bytes:
+    return b"\x47" + i.to_bytes(4, "big") + b"\xff" * (TS_PACKET_SIZE - 5)
+
+
+def feed(source):
+    stream = b"".join(packet(i) for i in range(PACKETS))
+    with open(source, "wb") as f:
+        # writes which do not match the packets
+        for i in range(0, len(stream), 1001):
+            f.write(stream[i:i + 1001])
+            f.flush()
+
+
+def test_aligned_after_stall(tmp_path):
+    source = tmp_path / "source.ts"
+    os.mkfifo(source)
+    output = tmp_path / "output.ts"
+    capture = SlowCapture(str(source), output, 30, ring_size=1)
+
+    async def run():
+        await capture.start()
+        writer = threading.Thread(target=feed, args=(source,))
+        writer.start()
+        await capture.wait()
+        writer.join()
+
+    asyncio.run(run())
+
+    assert capture.statistics.stalls > 0
+    data = output.read_bytes()
+    assert len(data) % TS_PACKET_SIZE == 0
+    numbers = []
+    for offset in range(0, len(data), TS_PACKET_SIZE):
+        assert data[offset:offset + TS_PACKET_SIZE] == \
+            packet(int.from_bytes(data[offset + 1:offset + 5], "big"))
+        numbers.append(int.from_bytes(data[offset + 1:offset + 5], "big"))
+    assert numbers == sorted(numbers)
+    assert len(numbers) < PACKETS
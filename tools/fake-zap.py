@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Replaces dvbv5-zap to test the supervision of the captures: set
+zap_command to this script and FAKE_ZAP_SCRIPT to a file of lines
+"<adapter> <status line>", as in
+
+    0 Lock   (0x1f) Signal= -48.00dBm C/N= 29.54dB UCB= 0 postBER= 0
+    1        (0x00) Signal= -90.00dBm C/N= 0.00dB UCB= 0 postBER= 0
+
+The status lines of the adapter are printed one per second, the last one is
+repeated. Null packets are written to the output file while the status has
+the lock, nothing is written after a line "<adapter> stall". With "-o -",
+the packets are written to the standard output."""
+import argparse
+import os
+import sys
+import time
+
+NULL_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * 184
+# packets written per second
+PACKETS = 100
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--adapter", default="0")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-t", "--timeout", type=int, default=0)
+    parser.add_argument("-c", "--channels")
+    parser.add_argument("-I", "--input-format")
+    parser.add_argument("-p", action="store_true")
+    parser.add_argument("-P", action="store_true")
+    parser.add_argument("channel")
+    args = parser.parse_args()
+
+    lines = []
+    with open(os.environ["FAKE_ZAP_SCRIPT"]) as f:
+        for line in f:
+            adapter, _, status = line.rstrip("\n").partition(" ")
+            if adapter == args.adapter:
+                lines.append(status)
+    output = None
+    if args.output == "-":
+        output = sys.stdout.buffer
+    elif args.output is not None:
+        output = open(args.output, "wb")
+
+    started = time.monotonic()
+    second = 0
+    while args.timeout == 0 or time.monotonic() - started < args.timeout:
+        status = lines[min(second, len(lines) - 1)] if lines else "stall"
+        if status != "stall":
+            print(status, file=sys.stderr, flush=True)
+        if output is not None and status.startswith("Lock"):
+            output.write(NULL_PACKET * PACKETS)
+            output.flush()
+        second += 1
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()